@@ -1,14 +1,12 @@
+import argparse
 import atexit
+import datetime
+import logging
 from operator import truediv
 import os
 import time
 import json
-import github3
-from distutils.util import strtobool
-import threading
 import sys
-import traceback
-from concurrent.futures import ThreadPoolExecutor
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
@@ -17,22 +15,56 @@ from flask import Flask
 from githubapp import (
     GitHubApp,
     DirectoryClient,
+    directory_backend,
     CRON_INTERVAL,
     TEST_MODE,
     ADD_MEMBER,
     REMOVE_ORG_MEMBERS_WITHOUT_TEAM,
     USER_SYNC_ATTRIBUTE,
     SYNCMAP_ONLY,
+    SYNC_WORKERS,
+    PIPELINE_QUEUE_SIZE,
+    DIRECTORY_BACKEND,
+    DIRECTORY_BATCH_SIZE,
+    DIRECTORY_TIMEOUT,
+    DIRECTORY_WORKERS,
+    ORG_DIRECTORIES,
+    GITHUB_TIMEOUT,
+    SYNC_MODE,
+    SYNC_PLAN,
+    APPLY_WORKERS,
+    PLAN_MAX_CHANGES,
+    SYNC_SCHEDULER,
+    SYNC_TIME_BUDGET,
+    SYNC_BUDGET_MARGIN,
+    INITIAL_SYNC_DELAY,
+    IDENTITY_INDEX,
 )
+from githubapp import logs, metrics, status, tracing
+from githubapp.config import strtobool
+from githubapp.identity import get_identity_index
+from githubapp.pipeline import Pipeline, Stage, cancellable, gather
+from githubapp.plan import PlanWriter, check_plan, read_plan, sync_state
+from githubapp.schedule import priority, run_deadline, single_run
+from githubapp.sharding import get_shard_coordinator
+from githubapp.snapshot import get_snapshot_store
+from githubapp.syncmap import load_syncmap
+
+logs.configure(__name__)
+LOG = logging.getLogger(__name__)
 
 app = Flask(__name__)
 github_app = GitHubApp(app)
 
-# Schedule a full sync
 scheduler = BackgroundScheduler(daemon=True)
+SYNC_TRIGGER = CronTrigger.from_crontab(CRON_INTERVAL)
 scheduler.start()
 atexit.register(lambda: scheduler.shutdown(wait=False))
 
+# Directory users joined to GitHub logins through the identity index are compared
+# with the logins of the GitHub members, whatever USER_SYNC_ATTRIBUTE is
+GITHUB_ATTRIBUTE = "username" if IDENTITY_INDEX else USER_SYNC_ATTRIBUTE
+
 
 @github_app.on("team.created")
 def sync_new_team():
@@ -42,12 +74,8 @@ def sync_new_team():
     """
     owner = github_app.payload["organization"]["login"]
     team_id = github_app.payload["team"]["id"]
-    if os.environ["USER_DIRECTORY"].upper() == "AAD":
-        # Azure APIs don't currently support case insensitive searching
-        slug = github_app.payload["team"]["name"].replace(" ", "-")
-    else:
-        slug = github_app.payload["team"]["slug"]
-    client = github_app.installation_client
+    slug = github_app.payload["team"]["slug"]
+    client = metrics.instrument_github(github_app.installation_client, owner)
     sync_team(client=client, owner=owner, team_id=team_id, slug=slug)
 
 
@@ -60,68 +88,339 @@ def sync_team(client=None, owner=None, team_id=None, slug=None):
     :param slug:
     :return:
     """
-    print("-------------------------------")
-    print(f"Processing Team: {slug}")
-
+    job = {"client": client, "owner": owner, "team_id": team_id, "slug": slug}
+    job["trace"] = tracing.TeamTrace(owner, slug)
     try:
-        org = client.organization(owner)
-        team = org.team(team_id)
-        custom_map, group_prefix, ignore_users = load_custom_map()
-        try:
-            directory_group = get_directory_from_slug(slug, custom_map, org)
-            # If we're filtering on group prefix, skip if the group doesn't match
-            if len(group_prefix) > 0 and not directory_group.startswith(
-                tuple(group_prefix)
-            ):
-                print(f"skipping team {team.slug} - not in group prefix")
-                return
-            directory_members = directory_group_members(group=directory_group)
-        except Exception as e:
-            directory_members = []
-            traceback.print_exc(file=sys.stderr)
-
-        team_members = github_team_members(
-            client=client,
-            owner=owner,
-            team_id=team_id,
+        for phase in SYNC_PHASES:
+            if phase(job) is None:
+                break
+    except Exception as e:
+        fail_team(job, e)
+        raise
+    finally:
+        job["trace"].finish()
+
+
+def prepare_team(job):
+    """
+    Resolve the organization, directory group and directory backend of a team sync job
+    :param job: Dict with the client, owner, team_id and slug of the team
+    :return: The job, or None if the team should be skipped
+    """
+    LOG.info("Processing team %s", job["slug"], extra=log_fields(job))
+    if "org" not in job:
+        job["org"] = job["client"].organization(job["owner"])
+    custom_map, group_prefix, ignore_users = load_custom_map()
+    job["ignore_users"] = ignore_users
+    job["directory_group"] = get_directory_from_slug(
+        job["slug"], custom_map, job["org"]
+    )
+    job["backend"] = get_backend_from_slug(job["slug"], custom_map, job["org"])
+    # If we're filtering on group prefix, skip if the group doesn't match
+    if group_prefix and not group_prefix.matches(job["directory_group"]):
+        LOG.info(
+            "Skipping team %s: not in group prefix", job["slug"], extra=log_fields(job)
+        )
+        metrics.count_team("skipped")
+        return None
+    return job
+
+
+@metrics.timed_phase("directory")
+@tracing.phase("directory")
+def fetch_directory(job):
+    """
+    Look up the members of the job's directory group
+    :param job:
+    :return: job
+    """
+    metrics.count_directory_call(job["backend"], job["owner"])
+    job["directory"] = directory_group_members(
+        group=job["directory_group"],
+        attribute=USER_SYNC_ATTRIBUTE,
+        backend=job["backend"],
+    )
+    return job
+
+
+def fetch_directories(jobs):
+    """
+    Look up the directory groups of several jobs with one bulk lookup per
+    directory backend. Groups the bulk lookup didn't return are left to
+    fetch_members.
+    :param jobs:
+    :return: jobs
+    """
+    by_backend = {}
+    for job in jobs:
+        by_backend.setdefault(job["backend"], []).append(job)
+    for backend, backend_jobs in by_backend.items():
+        start = time.monotonic()
+        prefetched = directory_groups_members(
+            {job["directory_group"] for job in backend_jobs},
             attribute=USER_SYNC_ATTRIBUTE,
-            ignore_users=ignore_users,
+            backend=backend,
+        )
+        elapsed = time.monotonic() - start
+        metrics.observe_phase("directory_batch", elapsed)
+        # Each team found is charged an even share of the lookup
+        found = [job for job in backend_jobs if job["directory_group"] in prefetched]
+        for job in found:
+            metrics.count_directory_call(backend, job["owner"])
+            metrics.observe_phase("directory", elapsed / len(found))
+            job["trace"].add_phase("directory", elapsed / len(found))
+            job["directory"] = prefetched[job["directory_group"]]
+    return jobs
+
+
+def fetch_members(job):
+    """
+    Look up the job's directory group, unless it was already looked up, and its
+    GitHub team at the same time. If either lookup fails or takes longer than its
+    timeout, the other is cancelled and the team fails with that error.
+    :param job:
+    :return: job
+    """
+    calls = {"github": lambda: fetch_github(job)}
+    if "directory" not in job:
+        calls["directory"] = lambda: fetch_directory(job)
+    gather(calls, timeouts={"directory": DIRECTORY_TIMEOUT, "github": GITHUB_TIMEOUT})
+    return job
+
+
+@metrics.timed_phase("github")
+@tracing.phase("github")
+def fetch_github(job):
+    """
+    Look up the members of the job's GitHub team
+    :param job:
+    :return: job
+    """
+    job["team"] = team = job["org"].team(job["team_id"])
+    job["identities"] = get_identity_index(job["client"], job["owner"])
+    # Reuse the last-known GitHub membership while GitHub reports the listing
+    # unchanged, instead of reading (and in email mode, looking up) everyone
+    store = get_snapshot_store()
+    job["github"] = job["github_etag"] = members = None
+    if store:
+        snapshot = store.github_members(
+            job["owner"], job["slug"], team.members_count, GITHUB_ATTRIBUTE
         )
-        compare = compare_members(
-            group=directory_members, team=team_members, attribute=USER_SYNC_ATTRIBUTE
+        github, etag = snapshot or (None, None)
+        members, job["github_etag"] = list_team_members(team, etag)
+        if members is None:
+            LOG.info("Using GitHub membership snapshot for team %s", team.slug)
+            job["github"] = github
+    if job["github"] is None:
+        job["github"] = github_team_members(
+            client=job["client"],
+            owner=job["owner"],
+            team_id=job["team_id"],
+            attribute=GITHUB_ATTRIBUTE,
+            team=team,
+            members=members,
         )
-        if TEST_MODE:
-            print(f"TEST_MODE: Pending changes for team {team.slug}:")
-            print(json.dumps(compare, indent=2))
-        else:
-            try:
-                execute_sync(org=org, team=team, slug=slug, state=compare)
-            except (AssertionError, ValueError) as e:
-                if strtobool(os.environ["OPEN_ISSUE_ON_FAILURE"]):
-                    open_issue(client=client, slug=slug, message=e)
-                raise Exception(f"Team {team.slug} sync failed: {e}")
-        print(f"Processing Team Successful: {team.slug}")
-    except Exception:
-        traceback.print_exc(file=sys.stderr)
-        raise
+    return job
+
+
+@metrics.timed_phase("compare")
+@tracing.phase("compare")
+def diff_team(job):
+    """
+    Compare both sides of the job's team
+    :param job:
+    :return: job
+    """
+    team_members = (
+        m for m in job["github"] if m["username"] not in job["ignore_users"]
+    )
+    job["state"] = state = compare_members(
+        group=job["directory"],
+        team=team_members,
+        attribute=GITHUB_ATTRIBUTE,
+        identities=job.get("identities"),
+    )
+    if state.get("unresolved"):
+        LOG.warning(
+            "Skipping %d members of %s without a GitHub identity: %s",
+            len(state["unresolved"]),
+            job["directory_group"],
+            ", ".join(state["unresolved"]),
+        )
+    job["trace"].directory_members = state["directory_count"]
+    job["trace"].github_members = state["github_count"]
+    return job
+
+
+@metrics.timed_phase("apply")
+@tracing.phase("apply")
+def apply_team(job):
+    """
+    Apply (or in TEST_MODE, log) the changes computed for the job's team
+    :param job:
+    :return: job
+    """
+    org, team, slug, compare = job["org"], job["team"], job["slug"], job["state"]
+    store = get_snapshot_store()
+    # Teams applied from a plan keep the directory side stored when they were planned
+    directory = job.get("directory")
+    if directory is not None:
+        directory = key_members(directory, USER_SYNC_ATTRIBUTE)
+    if TEST_MODE:
+        LOG.info(
+            "TEST_MODE: Pending changes for team %s: %s", team.slug, json.dumps(compare)
+        )
+        if store:
+            # Teams applied from a plan were neither read from GitHub nor changed,
+            # so their GitHub side is left as it was stored
+            planned = job.get("planned", False)
+            store.save_team(
+                job["owner"],
+                slug,
+                team_id=job["team_id"],
+                directory_group=job["directory_group"],
+                attribute=GITHUB_ATTRIBUTE,
+                github=None if planned else job["github"],
+                directory=directory,
+                github_count=None if planned else team.members_count,
+                github_etag=job.get("github_etag"),
+                status="pending",
+            )
+    else:
+        try:
+            execute_sync(org=org, team=team, slug=slug, state=compare)
+        except (AssertionError, ValueError) as e:
+            if strtobool(os.environ["OPEN_ISSUE_ON_FAILURE"]):
+                open_issue(client=job["client"], slug=slug, message=e)
+            raise Exception(f"Team {team.slug} sync failed: {e}")
+        if store:
+            changed = bool(compare["action"]["add"] or compare["action"]["remove"])
+            store.save_team(
+                job["owner"],
+                slug,
+                team_id=job["team_id"],
+                directory_group=job["directory_group"],
+                attribute=GITHUB_ATTRIBUTE,
+                github=synced_members(job["github"], compare, GITHUB_ATTRIBUTE),
+                directory=directory,
+                # Adds can silently fail, so re-read GitHub after any change
+                github_count=None if changed else team.members_count,
+                github_etag=job.get("github_etag"),
+                changed=changed,
+            )
+    LOG.info("Processing team %s successful", team.slug)
+    metrics.count_team("synced")
+    return job
+
+
+def fail_team(job, error):
+    """
+    Record a failed team sync
+    :param job:
+    :param error:
+    :return:
+    """
+    metrics.count_team("failed")
+    if "trace" in job:
+        job["trace"].finish(error)
+    store = get_snapshot_store()
+    if store:
+        store.record_failure(job["owner"], job["slug"], error)
+    LOG.error(
+        "Unable to sync team %s: %s",
+        job["slug"],
+        error,
+        exc_info=error,
+        extra=log_fields(job),
+    )
+
+
+def log_fields(job):
+    """
+    The org and team of log records about a job logged outside its sync phases
+    :param job:
+    :return:
+    :rtype: dict
+    """
+    return {"org": job["owner"], "team": job["slug"]}
+
+
+# The phases of a team sync, in order. Each takes the job dict and returns it,
+# or None to stop processing the team.
+SYNC_PHASES = [prepare_team, fetch_members, diff_team, apply_team]
+
+
+def synced_members(github, state, attribute="username"):
+    """
+    Work out the GitHub membership of a team after a sync has been applied
+    :param github: GitHub members before the sync
+    :param state: The sync state returned by compare_members
+    :param attribute:
+    :return: members
+    :rtype: list
+    """
+    remove_users = set(state["action"]["remove"])
+    members = [m for m in github if m[attribute].casefold() not in remove_users]
+    members += key_members(state["action"]["add"], attribute)
+    return members
+
+
+def member_keys(members, attribute="username"):
+    """
+    Consume a stream of members into the set of their casefolded ``attribute``
+    :param members: Member dicts, or a set already returned by member_keys
+    :param attribute:
+    :return: keys
+    :rtype: frozenset
+    """
+    if isinstance(members, frozenset):
+        return members
+    return frozenset(m[attribute].casefold() for m in members if m[attribute])
+
 
+def key_members(keys, attribute="username"):
+    """
+    Turn keys from member_keys back into member dicts
+    :param keys:
+    :param attribute:
+    :return: members
+    :rtype: list
+    """
+    return [{"username": None, "email": None, attribute: key} for key in keys]
 
-def directory_group_members(group=None):
+
+@tracing.traced("directory_group_members")
+def directory_group_members(group=None, attribute="username", backend=None):
     """
     Look up members of a group in your user directory
     :param group: The name of the group to query in your directory server
+    :param attribute: The member attribute the sync compares
+    :param backend: The directory backend holding the group. Default: USER_DIRECTORY
     :type group: str
-    :return: group_members
-    :rtype: list
+    :return: group_members, as the keys returned by member_keys
+    :rtype: frozenset
+    """
+    directory = DirectoryClient(backend=backend)
+    members = directory.iter_group_members(group_name=group)
+    return member_keys(cancellable(members), attribute)
+
+
+def directory_groups_members(groups, attribute="username", backend=None):
+    """
+    Look up the members of several groups in your user directory at once
+    :param groups: The names of the groups to query in your directory server
+    :param attribute: The member attribute the sync compares
+    :param backend: The directory backend holding the groups. Default: USER_DIRECTORY
+    :return: The keys returned by member_keys for each group found, by name
+    :rtype: dict
     """
     try:
-        directory = DirectoryClient()
-        members = directory.get_group_members(group_name=group)
-        group_members = [member for member in members]
-    except Exception as e:
-        group_members = []
-        traceback.print_exc(file=sys.stderr)
-    return group_members
+        directory = DirectoryClient(backend=backend)
+        found = directory.get_groups_members(list(groups))
+        return {name: member_keys(found[name], attribute) for name in found}
+    except Exception:
+        LOG.exception("Unable to look up %d directory groups at once", len(groups))
+        return {}
 
 
 def github_team_info(client=None, owner=None, team_id=None):
@@ -136,8 +435,15 @@ def github_team_info(client=None, owner=None, team_id=None):
     return org.team(team_id)
 
 
+@tracing.traced("github_team_members")
 def github_team_members(
-    client=None, owner=None, team_id=None, attribute="username", ignore_users=[]
+    client=None,
+    owner=None,
+    team_id=None,
+    attribute="username",
+    ignore_users=[],
+    team=None,
+    members=None,
 ):
     """
     Look up members of a given team in GitHub
@@ -145,6 +451,8 @@ def github_team_members(
     :param owner:
     :param team_id:
     :param attribute:
+    :param team: The team, if it was already looked up
+    :param members: The team's members, if they were already listed
     :type owner: str
     :type team_id: int
     :type attribute: str
@@ -152,9 +460,12 @@ def github_team_members(
     :rtype: list
     """
     team_members = []
-    team = github_team_info(client=client, owner=owner, team_id=team_id)
+    if team is None:
+        team = github_team_info(client=client, owner=owner, team_id=team_id)
+    if members is None:
+        members = cancellable(team.members())
     if attribute == "email":
-        for m in team.members():
+        for m in members:
             user = client.user(m.login)
             team_members.append(
                 {
@@ -163,32 +474,62 @@ def github_team_members(
                 }
             )
     else:
-        for member in team.members():
+        for member in members:
             team_members.append({"username": str(member), "email": ""})
     return [m for m in team_members if m["username"] not in ignore_users]
 
 
-def compare_members(group, team, attribute="username"):
+def list_team_members(team, etag=None):
     """
-    Compare users in GitHub and the User Directory to see which users need to be added or removed
-    :param group:
+    List the members of a team, unless the listing is unchanged since ``etag``.
+    GitHub doesn't count unchanged conditional requests against the rate limit.
     :param team:
+    :param etag: ETag of a previous listing of the team's members
+    :return: The members, or None if the listing is unchanged, and the ETag of the
+             listing, or None if it spans several pages, whose ETags only cover the
+             page they come with
+    :rtype: tuple
+    """
+    listing = team.members(etag=etag)
+    members = list(cancellable(listing))
+    if listing.last_status == 304:
+        return None, etag
+    if listing.last_response is None or "prev" in listing.last_response.links:
+        return members, None
+    return members, listing.etag
+
+
+def compare_members(group, team, attribute="username", identities=None):
+    """
+    Compare users in GitHub and the User Directory to see which users need to be added or removed
+    :param group: Directory members, as an iterable of member dicts or from member_keys
+    :param team: GitHub members, likewise
     :param attribute:
-    :return: sync_state
+    :param identities: IdentityIndex joining the directory members, as keys from
+                       member_keys, to the logins of the GitHub members
+    :return: sync_state, with the member counts of both sides and the changes, and
+             with ``identities`` the directory members without a GitHub identity
     :rtype: dict
     """
-    directory_list = [x[attribute].casefold() for x in group]
-    github_list = [x[attribute].casefold() for x in team]
-    add_users = list(set(directory_list) - set(github_list))
-    remove_users = list(set(github_list) - set(directory_list))
+    directory_keys = member_keys(group, attribute)
+    github_keys = member_keys(team, attribute)
+    unresolved = None
+    if identities is not None:
+        directory_keys, unresolved = identities.logins(directory_keys)
     sync_state = {
-        "directory": group,
-        "github": team,
-        "action": {"add": add_users, "remove": remove_users},
+        "directory_count": len(directory_keys),
+        "github_count": len(github_keys),
+        "action": {
+            "add": sorted(directory_keys - github_keys),
+            "remove": sorted(github_keys - directory_keys),
+        },
     }
+    if unresolved is not None:
+        sync_state["unresolved"] = unresolved
     return sync_state
 
 
+@tracing.traced("execute_sync")
 def execute_sync(org, team, slug, state):
     """
     Perform the synchronization
@@ -198,8 +539,10 @@ def execute_sync(org, team, slug, state):
     :param state:
     :return:
     """
+    from github3.exceptions import NotFoundError
+
     total_changes = len(state["action"]["remove"]) + len(state["action"]["add"])
-    if len(state["directory"]) == 0:
+    if state["directory_count"] == 0:
         message = f"{os.environ.get('USER_DIRECTORY', 'LDAP').upper()} group returned empty: {slug}"
         raise ValueError(message)
     elif int(total_changes) > int(os.environ.get("CHANGE_THRESHOLD", 25)):
@@ -214,16 +557,16 @@ def execute_sync(org, team, slug, state):
             # Validate that user is in org
             if org.is_member(user) or ADD_MEMBER:
                 try:
-                    print(f"Adding {user} to {slug}")
+                    LOG.info("Adding %s to %s", user, slug)
                     team.add_or_update_membership(user)
-                except github3.exceptions.NotFoundError:
-                    print(f"User: {user} not found")
+                except NotFoundError:
+                    LOG.warning("User %s not found", user)
                     pass
             else:
-                print(f"Skipping {user} as they are not part of the org")
+                LOG.info("Skipping %s as they are not part of the org", user)
 
         for user in state["action"]["remove"]:
-            print(f"Removing {user} from {slug}")
+            LOG.info("Removing %s from %s", user, slug)
             team.revoke_membership(user)
 
 
@@ -252,28 +595,9 @@ def load_custom_map(file="syncmap.yml"):
     """
     Custom team synchronization
     :param file:
-    :return:
+    :return: (syncmap, group_prefix, ignore_users), compiled once per file change
     """
-    syncmap = {}
-    ignore_users = []
-    group_prefix = []
-    if os.path.isfile(file):
-        from yaml import load, Loader
-
-        with open(file, "r") as f:
-            data = load(f, Loader=Loader)
-        if "mapping" in data:
-            for d in data["mapping"]:
-                if "org" in d:
-                    syncmap[(d["org"], d["github"])] = d["directory"]
-                else:
-                    syncmap[d["github"]] = d["directory"]
-        else:
-            syncmap = {}
-        group_prefix = data.get("group_prefix", [])
-        ignore_users = data.get("ignore_users", [])
-
-    return (syncmap, group_prefix, ignore_users)
+    return load_syncmap(file)
 
 
 def get_app_installations():
@@ -291,47 +615,389 @@ def get_app_installations():
     return installations
 
 
-@scheduler.scheduled_job(
-    trigger=CronTrigger.from_crontab(CRON_INTERVAL), id="sync_all_teams"
-)
-def sync_all_teams():
+@single_run
+def sync_all_teams(
+    plan=None, orgs=None, teams=None, syncmap_only=SYNCMAP_ONLY, workers=SYNC_WORKERS
+):
     """
     Lookup teams in a GitHub org and synchronize all teams with your user directory
+    :param plan: A PlanWriter to write the changes to instead of making them
+    :param orgs: Only sync the teams of these organizations
+    :param teams: Only sync these teams, as "org/slug" or "slug" for the team of
+                  that slug in every organization. They are looked up by slug
+                  instead of listing every team.
+    :param syncmap_only: Only sync teams in syncmap.yml
+    :param workers: Teams processed concurrently by each stage
     :return:
     """
 
-    print(f'Syncing all teams: {time.strftime("%A, %d. %B %Y %I:%M:%S %p")}')
+    LOG.info("Syncing all teams")
 
+    reset_group_indexes()
+    deadline = None
+    if SYNC_SCHEDULER == "priority":
+        deadline = run_deadline(SYNC_TRIGGER, SYNC_TIME_BUDGET, SYNC_BUDGET_MARGIN)
     installations = get_app_installations()
     custom_map, _, _ = load_custom_map()
-    futures = []
+    coordinator = get_shard_coordinator()
+    if coordinator:
+        coordinator.start()
     install_count = 0
-    with ThreadPoolExecutor(max_workers=10) as exe:
+    deferred = []
+    carried_over = []
+    traces = tracing.TraceRun()
+
+    def discover_installations():
+        nonlocal install_count
         for i in installations():
+            if not org_selected(i.account["login"], orgs, teams):
+                continue
             install_count += 1
-            print("========================================================")
-            print(f"## Processing Organization: {i.account['login']}")
-            print("========================================================")
-            with app.app_context() as ctx:
-                try:
-                    gh = GitHubApp(ctx.push())
-                    client = gh.app_installation(installation_id=i.id)
-                    org = client.organization(i.account["login"])
-                    for team in org.teams():
-                        futures.append(
-                            exe.submit(sync_team_helper, team, custom_map, client, org)
+            yield i
+
+    def list_teams(installation):
+        """
+        Authenticate as an installation and queue a job for each of its teams
+        """
+        LOG.info(
+            "Processing organization %s",
+            installation.account["login"],
+            extra={"org": installation.account["login"]},
+        )
+        progress.listing_started(installation.account["login"])
+        with app.app_context() as ctx:
+            try:
+                gh = GitHubApp(ctx.push())
+                client = metrics.instrument_github(
+                    gh.app_installation(installation_id=installation.id),
+                    installation.account["login"],
+                )
+                org = client.organization(installation.account["login"])
+                slugs = team_selection(teams, org.login)
+                listed = org.teams() if slugs is None else find_teams(org, slugs)
+                for team in listed:
+                    if syncmap_only and not is_team_in_map(team.slug, custom_map, org):
+                        LOG.info(
+                            "Skipping team %s: not in sync map",
+                            team.slug,
+                            extra={"org": org.login, "team": team.slug},
                         )
-                except Exception as e:
-                    print(f"DEBUG: {e}")
-                finally:
-                    ctx.pop()
-    if not install_count:
-        raise Exception(f"No installation defined for APP_ID {os.getenv('APP_ID')}")
-    for future in futures:
-        future.result()
-    if REMOVE_ORG_MEMBERS_WITHOUT_TEAM:
+                        metrics.count_team("skipped")
+                        continue
+                    progress.add_team(org.login, team.slug)
+                    yield {
+                        "client": client,
+                        "org": org,
+                        "owner": org.login,
+                        "team_id": team.id,
+                        "slug": team.slug,
+                    }
+            finally:
+                progress.listing_finished(installation.account["login"])
+                ctx.pop()
+
+    def list_all_teams():
+        """
+        List the teams of every installation, most in need of a sync first
+        """
+        jobs = []
+        for installation in discover_installations():
+            try:
+                jobs.extend(list_teams(installation))
+            except Exception as e:
+                on_error("teams", installation, e)
+        store = get_snapshot_store()
+        states = store.get_teams() if store else {}
+        jobs.sort(key=lambda job: priority(states.get((job["owner"], job["slug"]))))
+        return jobs
+
+    def out_of_time(job):
+        """
+        Leave the job for the next run if the time budget is spent
+        """
+        if deadline is None or time.monotonic() <= deadline:
+            return False
+        carried_over.append(job)
+        metrics.count_team("carried_over")
+        if job.get("claimed"):
+            coordinator.release(f"{job['owner']}/{job['slug']}")
+        return True
+
+    def start_team(job):
+        if out_of_time(job) or prepare_team(job) is None:
+            progress.team_done(job["owner"], job["slug"])
+            return None
+        if coordinator:
+            if not coordinator.claim(f"{job['owner']}/{job['slug']}"):
+                # Owned by another worker, unless it stops heartbeating
+                deferred.append(job)
+                progress.team_done(job["owner"], job["slug"])
+                return None
+            job["claimed"] = True
+        job["trace"] = traces.start(job["owner"], job["slug"])
+        return job
+
+    def fetch_team_directory(job):
+        gather(
+            {"directory": lambda: fetch_directory(job)},
+            {"directory": DIRECTORY_TIMEOUT},
+        )
+        return job
+
+    def fetch_team(job):
+        # Teams can wait in the queues for a while; nothing was changed yet
+        if out_of_time(job):
+            job["trace"].discard()
+            progress.team_done(job["owner"], job["slug"])
+            return None
+        return fetch_members(job)
+
+    def finish_team(job):
+        if plan is None:
+            apply_team(job)
+        else:
+            plan.add(
+                job["owner"],
+                job["slug"],
+                job["team_id"],
+                job["directory_group"],
+                job["state"],
+            )
+        job["trace"].finish()
+        progress.team_done(job["owner"], job["slug"])
+        if job.get("claimed"):
+            coordinator.complete(f"{job['owner']}/{job['slug']}", success=True)
+
+    def on_error(stage, item, error):
+        if stage == "teams":
+            LOG.error("Unable to list teams: %s", error, exc_info=error)
+            return
+        fail_team(item, error)
+        progress.team_done(item["owner"], item["slug"], failed=True)
+        if plan is not None:
+            plan.add_failure(item["owner"], item["slug"], error)
+        if item.get("claimed"):
+            coordinator.complete(f"{item['owner']}/{item['slug']}", success=False)
+
+    def team_stages():
+        stages = [Stage("prepare", start_team, workers=workers)]
+        # Each directory backend gets its own workers, so a slow or throttled
+        # backend only holds up the teams using it
+        pools = {
+            backend: DIRECTORY_WORKERS.get(backend, workers)
+            for backend in directory_backends()
+        }
+        if DIRECTORY_BATCH_SIZE > 1:
+            stages.append(
+                Stage(
+                    "directory",
+                    fetch_directories,
+                    batch=DIRECTORY_BATCH_SIZE,
+                    partition=lambda job: job["backend"],
+                    pools=pools,
+                )
+            )
+        elif len(pools) > 1:
+            stages.append(
+                Stage(
+                    "directory",
+                    fetch_team_directory,
+                    partition=lambda job: job["backend"],
+                    pools=pools,
+                )
+            )
+        # Looks up the GitHub team, and the directory group if it wasn't batched
+        return stages + [
+            Stage("fetch", fetch_team, workers=workers),
+            Stage("diff", diff_team, workers=1),
+            Stage("apply", finish_team, workers=workers),
+        ]
+
+    with metrics.track_run(), status.track_run(
+        "sync" if plan is None else "plan"
+    ) as progress:
+        if SYNC_SCHEDULER == "priority":
+            progress.set_phase("listing teams")
+            stages, source = team_stages(), list_all_teams()
+        else:
+            stages = [Stage("teams", list_teams, workers=2, fanout=True)]
+            stages += team_stages()
+            source = discover_installations()
+        pipeline = Pipeline(stages, maxsize=PIPELINE_QUEUE_SIZE, on_error=on_error)
+        metrics.track_pipeline(pipeline)
+        progress.set_phase("syncing teams")
+        pipeline.run(source)
+        if not install_count and (orgs or teams):
+            raise Exception(
+                f"No installation of APP_ID {os.getenv('APP_ID')} matches the selection"
+            )
+        if not install_count:
+            raise Exception(f"No installation defined for APP_ID {os.getenv('APP_ID')}")
+        if coordinator:
+            if deferred:
+                # Pick up the teams of workers that stopped heartbeating during the run
+                coordinator.heartbeat()
+                orphaned, left = [], []
+                for job in deferred:
+                    if coordinator.owns(f"{job['owner']}/{job['slug']}"):
+                        orphaned.append(job)
+                    else:
+                        left.append(job)
+                deferred.clear()
+                progress.set_phase("syncing orphaned teams")
+                pipeline = Pipeline(
+                    team_stages(), maxsize=PIPELINE_QUEUE_SIZE, on_error=on_error
+                )
+                metrics.track_pipeline(pipeline)
+                pipeline.run(orphaned)
+                # Orphaned teams another worker claimed in the meantime
+                deferred[:0] = left
+            for _ in deferred:
+                metrics.count_team("deferred")
+            coordinator.stop()
+            coordinator.report()
+            if deferred:
+                LOG.info(
+                    "%d teams were left to the other %d shard workers",
+                    len(deferred),
+                    len(coordinator.live_workers) - 1,
+                )
+    traces.report()
+    if carried_over:
+        LOG.warning(
+            "%d teams did not fit in the time budget and carry over to the next run",
+            len(carried_over),
+        )
+    # Organization members are only swept by full runs
+    if REMOVE_ORG_MEMBERS_WITHOUT_TEAM and plan is None and not (orgs or teams):
         remove_org_members_without_team(installations)
-    print(f'Syncing all teams successful: {time.strftime("%A, %d. %B %Y %I:%M:%S %p")}')
+    if coordinator and deferred and not coordinator.assigned:
+        LOG.warning(
+            "Syncing all teams finished without syncing any team: all %d teams "
+            "were left to other shard workers",
+            len(deferred),
+        )
+        return
+    LOG.info("Syncing all teams successful")
+
+
+@single_run
+def plan_all_teams(path=SYNC_PLAN, **selection):
+    """
+    Compare every team with your user directory and write the changes to a plan
+    file instead of making them. The plan file is only replaced once the run
+    finishes.
+    :param path:
+    :param selection: The orgs, teams, syncmap_only and workers of sync_all_teams
+    :return:
+    """
+    plan = PlanWriter(path, GITHUB_ATTRIBUTE)
+    try:
+        sync_all_teams(plan=plan, **selection)
+    except BaseException:
+        plan.close(complete=False)
+        raise
+    plan.close()
+
+
+@single_run
+def apply_plan(path=SYNC_PLAN, orgs=None, teams=None, workers=APPLY_WORKERS):
+    """
+    Make the changes listed in a plan file written by plan_all_teams. The whole plan
+    is checked before any team is changed.
+    :param path:
+    :param orgs: Only change the teams of these organizations
+    :param teams: Only change these teams, as "org/slug" or "slug"
+    :param workers: Teams changed concurrently
+    :return:
+    """
+    header, planned = read_plan(path)
+    planned = [t for t in planned if team_selected(t["owner"], t["slug"], orgs, teams)]
+    total = check_plan(header, planned, GITHUB_ATTRIBUTE, PLAN_MAX_CHANGES)
+    to_apply = [t for t in planned if "error" not in t]
+    minutes = (time.time() - header["created_at"]) / 60
+    LOG.info(
+        "Applying %d changes to %d teams from %s, planned %.0f minutes ago",
+        total,
+        len(to_apply),
+        path,
+        minutes,
+    )
+    threshold = int(os.environ.get("CHANGE_THRESHOLD", 25))
+    for team in to_apply:
+        changes = len(team["add"]) + len(team["remove"])
+        if changes > threshold:
+            LOG.warning(
+                "Team %s has %d changes, more than CHANGE_THRESHOLD (%d); it will "
+                "not be changed",
+                team["slug"],
+                changes,
+                threshold,
+                extra={"org": team["owner"], "team": team["slug"]},
+            )
+    owners = {team["owner"] for team in to_apply}
+    traces = tracing.TraceRun()
+    store = get_snapshot_store()
+
+    def list_jobs(installation):
+        owner = installation.account["login"]
+        if owner not in owners:
+            return
+        with app.app_context() as ctx:
+            try:
+                gh = GitHubApp(ctx.push())
+                client = metrics.instrument_github(
+                    gh.app_installation(installation_id=installation.id), owner
+                )
+                org = client.organization(owner)
+            finally:
+                ctx.pop()
+        for team in to_apply:
+            if team["owner"] != owner:
+                continue
+            github = store.get_members(owner, team["slug"], "github") if store else []
+            yield {
+                "client": client,
+                "org": org,
+                "owner": owner,
+                "slug": team["slug"],
+                "team_id": team["team_id"],
+                "directory_group": team["directory_group"],
+                "state": sync_state(team),
+                "github": github,
+                "planned": True,
+                "trace": traces.start(owner, team["slug"]),
+            }
+
+    def apply_job(job):
+        job["team"] = job["org"].team(job["team_id"])
+        apply_team(job)
+        job["trace"].finish()
+        progress.team_done(job["owner"], job["slug"])
+
+    def on_error(stage, item, error):
+        if stage == "teams":
+            LOG.error("Unable to list teams: %s", error, exc_info=error)
+            return
+        fail_team(item, error)
+        progress.team_done(item["owner"], item["slug"], failed=True)
+
+    with metrics.track_run(), status.track_run("apply") as progress:
+        for team in to_apply:
+            progress.add_team(team["owner"], team["slug"])
+        progress.set_phase("applying changes")
+        pipeline = Pipeline(
+            [
+                Stage("teams", list_jobs, workers=1, fanout=True),
+                Stage("apply", apply_job, workers=workers),
+            ],
+            maxsize=PIPELINE_QUEUE_SIZE,
+            on_error=on_error,
+        )
+        metrics.track_pipeline(pipeline)
+        pipeline.run(get_app_installations()())
+    traces.report()
+    LOG.info("Applying plan successful")
 
 
 def remove_org_members_without_team(installations):
@@ -347,60 +1013,235 @@ def remove_org_members_without_team(installations):
                 ]
                 remove_members = list(set(org_members) - set(team_members))
                 for member in remove_members:
-                    print(f"Removing {member}")
+                    LOG.info("Removing %s from %s", member, org.login)
                     if not TEST_MODE:
                         org.remove_membership(str(member))
-            except Exception as e:
-                print(f"DEBUG: {e}")
+            except Exception:
+                LOG.exception("Unable to remove members of %s", i.account["login"])
             finally:
                 ctx.pop()
 
 
-def sync_team_helper(team, custom_map, client, org):
-    print(f"Organization: {org.login}")
-    try:
-        if SYNCMAP_ONLY and not is_team_in_map(team.slug, custom_map, org):
-            print(f"skipping team {team.slug} - not in sync map")
-            return
-        sync_team(
-            client=client,
-            owner=org.login,
-            team_id=team.id,
-            slug=team.slug,
-        )
-    except Exception as e:
-        print(f"Organization: {org.login}")
-        print(f"Unable to sync team: {team.slug}")
-        print(f"DEBUG: {e}")
+def team_selection(teams, owner):
+    """
+    The slugs of an organization's teams among the selected teams
+    :param teams: Teams as "org/slug", or "slug" for the team of that slug in every
+                  organization. None selects every team.
+    :param owner: Organization login
+    :return: The slugs, or None if every team of the organization is selected
+    :rtype: list
+    """
+    if not teams:
+        return None
+    slugs = []
+    for team in teams:
+        org, _, slug = team.rpartition("/")
+        if not org or org.casefold() == owner.casefold():
+            slugs.append(slug)
+    return slugs
 
 
-def is_team_in_map(slug, custom_map, org):
-    key_with_org = (org.login, slug)
-    key_without_org = slug
-    if key_with_org in custom_map or key_without_org in custom_map:
-        return True
-    else:
+def org_selected(owner, orgs=None, teams=None):
+    """
+    Check whether any team of an organization is selected
+    :param owner: Organization login
+    :param orgs: Selected organizations, or None for every organization
+    :param teams: Selected teams, as for team_selection
+    :rtype: bool
+    """
+    if orgs and owner.casefold() not in {org.casefold() for org in orgs}:
+        return False
+    slugs = team_selection(teams, owner)
+    return slugs is None or bool(slugs)
+
+
+def team_selected(owner, slug, orgs=None, teams=None):
+    """
+    Check whether a team is selected
+    :param owner: Organization login
+    :param slug: Team slug
+    :param orgs: Selected organizations, or None for every organization
+    :param teams: Selected teams, as for team_selection
+    :rtype: bool
+    """
+    if not org_selected(owner, orgs, teams):
         return False
+    slugs = team_selection(teams, owner)
+    return slugs is None or slug in slugs
+
+
+def find_teams(org, slugs):
+    """
+    Look up teams of an organization by slug, without listing all of its teams
+    :param org:
+    :param slugs:
+    :return: The teams found
+    :rtype: generator
+    """
+    from github3.exceptions import NotFoundError
+
+    for slug in slugs:
+        try:
+            yield org.team_by_name(slug)
+        except NotFoundError:
+            LOG.warning(
+                "Team %s not found", slug, extra={"org": org.login, "team": slug}
+            )
+
+
+def is_team_in_map(slug, custom_map, org):
+    return custom_map.lookup(org.login, slug) is not None
 
 
 def get_directory_from_slug(slug, custom_map, org):
-    if not is_team_in_map(slug, custom_map, org):
-        return slug
-    elif (org.login, slug) in custom_map:
-        return custom_map[(org.login, slug)]
-    elif slug in custom_map:
-        return custom_map[slug]
+    directory_group = custom_map.lookup(org.login, slug)
+    return slug if directory_group is None else directory_group
 
 
-if "FLASK_APP" in os.environ:
-    thread = threading.Thread(target=sync_all_teams)
-    thread.start()
+def get_backend_from_slug(slug, custom_map, org):
+    """
+    The directory backend of a team: the one its syncmap entry names, else its
+    organization's from ORG_DIRECTORIES, else USER_DIRECTORY
+    """
+    backend = custom_map.resolve(org.login, slug)[1]
+    return backend or ORG_DIRECTORIES.get(org.login, DIRECTORY_BACKEND)
 
-if __name__ == "__main__":
-    if "FLASK_APP" in os.environ:
+
+def directory_backends():
+    """
+    The directory backends teams can be synced with
+    :rtype: set
+    """
+    custom_map = load_custom_map()[0]
+    return {DIRECTORY_BACKEND, *ORG_DIRECTORIES.values(), *custom_map.backends}
+
+
+def reset_group_indexes():
+    """
+    Make the directory backends that index their groups list them again, so each
+    run finds the current ID of every group
+    """
+    for backend in directory_backends():
+        reset = getattr(directory_backend(backend), "reset_group_index", None)
+        if reset:
+            reset()
+
+
+RUN_MODES = {"sync": sync_all_teams, "plan": plan_all_teams, "apply": apply_plan}
+if SYNC_MODE not in RUN_MODES:
+    raise ValueError(f"SYNC_MODE must be one of {', '.join(RUN_MODES)}")
+
+# Schedule a full sync, or a new plan. A plan is only applied once. A tick that
+# comes while the previous run is still going is dropped, not queued.
+if SYNC_MODE != "apply":
+    scheduler.add_job(
+        RUN_MODES[SYNC_MODE],
+        trigger=SYNC_TRIGGER,
+        id="sync_all_teams",
+        max_instances=1,
+        coalesce=True,
+    )
+    status.track_schedule(scheduler, "sync_all_teams")
+    # Join the shard ring now, so every worker counts the others from the first tick
+    if get_shard_coordinator():
+        get_shard_coordinator().join()
+
+if "FLASK_APP" in os.environ and INITIAL_SYNC_DELAY >= 0:
+    # Run once soon after starting, leaving the web server time to bind first
+    scheduler.add_job(
+        RUN_MODES[SYNC_MODE],
+        trigger="date",
+        run_date=datetime.datetime.now()
+        + datetime.timedelta(seconds=INITIAL_SYNC_DELAY),
+        id="initial_sync",
+        misfire_grace_time=None,
+    )
+
+
+def main(argv=None):
+    """
+    Run the web server, or with no FLASK_APP or with any option, one sync
+    :param argv: Default: sys.argv[1:]
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        description="Sync GitHub teams with your user directory. Without options, "
+        "runs the web server if FLASK_APP is set, else one run in SYNC_MODE."
+    )
+    parser.add_argument(
+        "--org",
+        action="append",
+        dest="orgs",
+        metavar="ORG",
+        help="only sync the teams of this organization; repeatable",
+    )
+    parser.add_argument(
+        "--team",
+        action="append",
+        dest="teams",
+        metavar="[ORG/]SLUG",
+        help="only sync this team, looked up by slug in ORG or in every "
+        "organization; repeatable",
+    )
+    parser.add_argument(
+        "--syncmap-only",
+        action="store_true",
+        default=SYNCMAP_ONLY,
+        help="only sync teams in syncmap.yml",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="teams processed concurrently by each stage "
+        "(default: SYNC_WORKERS, or APPLY_WORKERS with --apply)",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--plan",
+        nargs="?",
+        const=SYNC_PLAN,
+        metavar="FILE",
+        help="write the changes to a plan instead of making them (default: SYNC_PLAN)",
+    )
+    mode.add_argument(
+        "--apply",
+        nargs="?",
+        const=SYNC_PLAN,
+        metavar="FILE",
+        help="make the changes of a plan (default: SYNC_PLAN)",
+    )
+    mode.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="report the slowest imports of the app",
+    )
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+
+    if args.profile_startup:
+        from githubapp.startup import report
+
+        report()
+        return
+    if "FLASK_APP" in os.environ and not argv:
         app.run(
             host=os.environ.get("FLASK_RUN_HOST", "0.0.0.0"),
             port=os.environ.get("FLASK_RUN_PORT", "5000"),
         )
+        return
+    mode = "plan" if args.plan else "apply" if args.apply else SYNC_MODE
+    selection = {"orgs": args.orgs, "teams": args.teams}
+    if args.workers:
+        selection["workers"] = args.workers
+    if mode == "apply":
+        apply_plan(args.apply or SYNC_PLAN, **selection)
+        return
+    selection["syncmap_only"] = args.syncmap_only
+    if mode == "plan":
+        plan_all_teams(args.plan or SYNC_PLAN, **selection)
     else:
-        sync_all_teams()
+        sync_all_teams(**selection)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+"""
+Record the GitHub traffic and directory lookups of a real full sync, and replay
+them offline with the recorded latencies.
+
+    python -m benchmarks.cassette record prod.cassette.gz --dry-run
+    python -m benchmarks.cassette replay prod.cassette.gz --latency-scale 1
+    python -m benchmarks.cassette replay prod.cassette.gz --latency-scale 0 --output after.json
+
+GitHub is recorded at the HTTP transport, below github3. The directory is
+recorded at ``DirectoryClient.iter_group_members``, so the same cassette format
+covers every backend, whether it talks LDAP, plain HTTP or an SDK.
+"""
+
+import argparse
+import collections
+import datetime
+import gzip
+import http.client
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+VERSION = 1
+# Response headers kept in the cassette; everything else is dropped
+KEPT_HEADERS = [
+    "Content-Type",
+    "Link",
+    "ETag",
+    "Last-Modified",
+    "X-RateLimit-Limit",
+    "X-RateLimit-Remaining",
+    "X-RateLimit-Reset",
+    "X-RateLimit-Used",
+    "X-RateLimit-Resource",
+]
+# JSON keys whose values are replaced wherever they appear in a response body
+SECRET_KEYS = {
+    "token",
+    "access_token",
+    "refresh_token",
+    "id_token",
+    "client_secret",
+    "private_key",
+    "password",
+}
+# Settings that change which requests a sync makes, copied from the recording
+# environment into the replay one
+REPLAYED_SETTINGS = [
+    "USER_DIRECTORY",
+    "USER_SYNC_ATTRIBUTE",
+    "TEST_MODE",
+    "ADD_MEMBER",
+    "CHANGE_THRESHOLD",
+    "SYNCMAP_ONLY",
+    "REMOVE_ORG_MEMBERS_WITHOUT_TEAM",
+]
+SECRET_PATTERN = re.compile(r"\b(gh[pousr]_|github_pat_)[A-Za-z0-9_]{20,}")
+SCRUBBED = "<scrubbed>"
+
+
+def scrub(value):
+    """
+    Replace credentials in a decoded JSON document
+    :param value:
+    :return: A scrubbed copy
+    """
+    if isinstance(value, dict):
+        return {
+            k: SCRUBBED if k.lower() in SECRET_KEYS and v else scrub(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [scrub(v) for v in value]
+    if isinstance(value, str):
+        return SECRET_PATTERN.sub(SCRUBBED, value)
+    return value
+
+
+def scrub_body(text):
+    try:
+        return json.dumps(scrub(json.loads(text)))
+    except ValueError:
+        return SECRET_PATTERN.sub(SCRUBBED, text)
+
+
+def github_api_host():
+    return os.environ.get("GHE_HOST", "api.github.com")
+
+
+class Recorder:
+    """
+    Appends every GitHub API exchange and directory group lookup of the process
+    to a gzipped JSON lines cassette. Request headers are never written, response
+    headers are limited to KEPT_HEADERS and credentials are scrubbed from bodies.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, "wt")
+        self.host = github_api_host()
+        self.counts = collections.Counter()
+        self._write(
+            {
+                "version": VERSION,
+                "ghe_host": os.environ.get("GHE_HOST"),
+                "settings": {
+                    k: os.environ[k] for k in REPLAYED_SETTINGS if k in os.environ
+                },
+                "recorded_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            }
+        )
+
+    def _write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+
+    def install(self, app):
+        """
+        Start recording the traffic of ``app`` (the imported app module)
+        :return:
+        """
+        from githubapp import directory_backend
+        from githubapp.directory import BulkGroupsMixin
+
+        recorder = self
+        backend = directory_backend()
+        send = HTTPAdapter.send
+
+        def recording_send(adapter, request, **kwargs):
+            start = time.perf_counter()
+            response = send(adapter, request, **kwargs)
+            if urlsplit(request.url).netloc == recorder.host:
+                recorder.record_http(request, response, time.perf_counter() - start)
+            return response
+
+        HTTPAdapter.send = recording_send
+
+        # Records the USER_DIRECTORY backend, whichever backend a team uses
+        class RecordingDirectoryClient(backend):
+            def __init__(self, *args, backend=None, **kwargs):
+                super().__init__(*args, **kwargs)
+
+            def iter_group_members(self, *args, **kwargs):
+                group = kwargs.get("group_name", args[-1] if args else None)
+                start = time.perf_counter()
+                try:
+                    members = list(super().iter_group_members(*args, **kwargs))
+                except Exception as e:
+                    recorder.record_directory(
+                        group, None, time.perf_counter() - start, repr(e)
+                    )
+                    raise
+                recorder.record_directory(group, members, time.perf_counter() - start)
+                yield from members
+
+            def get_groups_members(self, names):
+                if backend.get_groups_members is BulkGroupsMixin.get_groups_members:
+                    # Looks the groups up one by one, already recorded above
+                    return super().get_groups_members(names)
+                start = time.perf_counter()
+                found = super().get_groups_members(names)
+                # One entry per group, sharing the time of the bulk lookup
+                elapsed = (time.perf_counter() - start) / max(len(names), 1)
+                for group, members in found.items():
+                    recorder.record_directory(group, list(members), elapsed)
+                return found
+
+        app.DirectoryClient = RecordingDirectoryClient
+
+    def record_http(self, request, response, elapsed):
+        self.counts["http"] += 1
+        self._write(
+            {
+                "kind": "http",
+                "method": request.method,
+                "url": request.url,
+                "status": response.status_code,
+                "headers": {
+                    h: response.headers[h]
+                    for h in KEPT_HEADERS
+                    if h in response.headers
+                },
+                "body": scrub_body(response.text) if response.content else "",
+                "elapsed": elapsed,
+            }
+        )
+
+    def record_directory(self, group, members, elapsed, error=None):
+        self.counts["directory"] += 1
+        self._write(
+            {
+                "kind": "directory",
+                "group": group,
+                "members": members,
+                "elapsed": elapsed,
+                "error": error,
+            }
+        )
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load(path):
+    """
+    Read a cassette
+    :return: The header, and the HTTP and directory entries
+    :rtype: tuple
+    """
+    exchanges = collections.defaultdict(list)
+    directory = collections.defaultdict(list)
+    with gzip.open(path, "rt") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != VERSION:
+            raise ValueError(f"Unsupported cassette version {header.get('version')}")
+        for line in f:
+            entry = json.loads(line)
+            if entry["kind"] == "http":
+                exchanges[(entry["method"], entry["url"])].append(entry)
+            else:
+                directory[entry["group"]].append(entry)
+    return header, exchanges, directory
+
+
+class Player:
+    """
+    Answers GitHub requests and directory lookups from a cassette. Repeated
+    requests get the recorded responses in order, then the last one again.
+    Each answer is delayed by its recorded latency times ``latency_scale``.
+    """
+
+    def __init__(self, path, latency_scale=1.0):
+        self.header, self.http, self.directory = load(path)
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.misses = collections.Counter()
+
+    def _next(self, entries):
+        with self.lock:
+            return entries.pop(0) if len(entries) > 1 else entries[0]
+
+    def _wait(self, entry):
+        if self.latency_scale:
+            time.sleep(entry["elapsed"] * self.latency_scale)
+
+    def send(self, request):
+        key = (request.method, request.url)
+        entries = self.http.get(key)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = "utf-8"
+        if not entries:
+            with self.lock:
+                self.misses[f"{request.method} {urlsplit(request.url).path}"] += 1
+            response.status_code = 404
+            response.reason = "Not in cassette"
+            response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+            response._content = b'{"message": "Not in cassette"}'
+            return response
+        entry = self._next(entries)
+        with self.lock:
+            self.calls["github"] += 1
+        self._wait(entry)
+        response.status_code = entry["status"]
+        response.reason = http.client.responses.get(entry["status"], "")
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = entry["body"].encode("utf-8")
+        response.elapsed = datetime.timedelta(seconds=entry["elapsed"])
+        return response
+
+    def get_group_members(self, group):
+        entries = self.directory.get(group)
+        if not entries:
+            with self.lock:
+                self.misses[f"directory {group}"] += 1
+            return []
+        entry = self._next(entries)
+        with self.lock:
+            self.calls["directory"] += 1
+        self._wait(entry)
+        if entry["error"]:
+            raise Exception(f"Recorded directory error: {entry['error']}")
+        return entry["members"]
+
+    def get_groups_members(self, groups):
+        """
+        Answer a bulk lookup with the next recorded lookup of each group. Groups
+        that weren't recorded, or whose next lookup failed, are left out, so the sync
+        looks them up one by one as it does after a live bulk lookup.
+        :param groups:
+        :return: Members of each group by name
+        :rtype: dict
+        """
+        found = {}
+        elapsed = 0
+        for group in groups:
+            with self.lock:
+                entries = self.directory.get(group)
+                if not entries or entries[0]["error"]:
+                    continue
+                entry = entries.pop(0) if len(entries) > 1 else entries[0]
+                self.calls["directory"] += 1
+            found[group] = entry["members"]
+            elapsed += entry["elapsed"]
+        if self.latency_scale:
+            time.sleep(elapsed * self.latency_scale)
+        return found
+
+    def install(self, app):
+        """
+        Serve the traffic of ``app`` (the imported app module) from the cassette
+        :return:
+        """
+        player = self
+
+        def replaying_send(adapter, request, **kwargs):
+            return player.send(request)
+
+        HTTPAdapter.send = replaying_send
+
+        class ReplayDirectoryClient:
+            def __init__(self, *args, backend=None, **kwargs):
+                pass
+
+            def iter_group_members(self, *args, **kwargs):
+                group = kwargs.get("group_name", args[-1] if args else None)
+                yield from player.get_group_members(group)
+
+            def get_groups_members(self, names):
+                return player.get_groups_members(names)
+
+        app.DirectoryClient = ReplayDirectoryClient
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "misses": sum(self.misses.values()),
+                "missed": dict(self.misses.most_common(10)),
+            }
+
+
+def record(args):
+    if args.dry_run:
+        os.environ["TEST_MODE"] = "true"
+    os.environ.pop("FLASK_APP", None)
+    import app
+
+    recorder = Recorder(args.cassette)
+    recorder.install(app)
+    try:
+        app.sync_all_teams()
+    finally:
+        recorder.close()
+    print(
+        f"Recorded {recorder.counts['http']} GitHub requests and "
+        f"{recorder.counts['directory']} directory lookups to {args.cassette}"
+    )
+
+
+def replay(args):
+    from . import run
+    from .servers import write_private_key
+
+    header, _, _ = load(args.cassette)
+    workdir = tempfile.mkdtemp(prefix="team-sync-replay-")
+    try:
+        app_key = os.path.join(workdir, "app.pem")
+        write_private_key(app_key)
+        env = dict(
+            APP_ID="1",
+            WEBHOOK_SECRET="replay",
+            PRIVATE_KEY_PATH=app_key,
+            OPEN_ISSUE_ON_FAILURE="false",
+            TRACE_TOP_N="0",
+        )
+        for setting in REPLAYED_SETTINGS:
+            os.environ.pop(setting, None)
+        env.update(header["settings"])
+        if header.get("ghe_host"):
+            env["GHE_HOST"] = header["ghe_host"]
+        else:
+            os.environ.pop("GHE_HOST", None)
+        if args.workers:
+            env["SYNC_WORKERS"] = str(args.workers)
+        os.environ.pop("FLASK_APP", None)
+        os.environ.update(env)
+
+        log_file = os.path.join(workdir, "sync.log")
+        result = {
+            "commit": run._commit(),
+            "cassette": os.path.basename(args.cassette),
+            "latency_scale": args.latency_scale,
+            "workers": args.workers,
+            "runs": [],
+        }
+        for number in range(1, args.runs + 1):
+            measured = run.spawn_sync(
+                Player, (args.cassette, args.latency_scale), log_file
+            )
+            stats = measured.pop("stats")
+            measured.update(
+                github_calls=stats["calls"].get("github", 0),
+                github_calls_by_route={},
+                directory_calls=stats["calls"].get("directory", 0),
+                directory_calls_by_route={},
+                cassette_misses=stats["misses"],
+            )
+            result["runs"].append(measured)
+            run.print_run(number, measured)
+            if stats["misses"]:
+                print(f"  {stats['misses']} requests were not in the cassette:")
+                for request, count in stats["missed"].items():
+                    print(f"    {request}: {count}")
+        if args.keep:
+            print(f"Sync output: {log_file}")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                run.compare(result, json.load(f))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    recording = commands.add_parser(
+        "record", help="Run a full sync with the current environment and record it"
+    )
+    recording.add_argument("cassette")
+    recording.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Set TEST_MODE so the recorded sync makes no changes",
+    )
+    replaying = commands.add_parser("replay", help="Run a full sync from a cassette")
+    replaying.add_argument("cassette")
+    replaying.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="Multiplier of the recorded latencies; 0 replays without delays",
+    )
+    replaying.add_argument("--runs", type=int, default=1)
+    replaying.add_argument("--workers", type=int, help="SYNC_WORKERS for the sync")
+    replaying.add_argument("--output", help="Write the results to this JSON file")
+    replaying.add_argument("--baseline", help="Compare with results from --output")
+    replaying.add_argument("--keep", action="store_true")
+    args = parser.parse_args(argv)
+    if args.command == "record":
+        record(args)
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main()
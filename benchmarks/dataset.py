@@ -0,0 +1,77 @@
+"""
+Synthetic organizations, teams and directory groups for the benchmarks
+"""
+
+import random
+
+
+class Dataset:
+    """
+    A deterministic set of GitHub organizations and matching directory groups.
+
+    Every team has a directory group named after its slug. Group sizes follow a
+    Pareto distribution, so most groups are small and a few are very large, as in
+    real directories. The GitHub side of each team starts out as its directory
+    group with ``drift`` of the members removed and as many strangers added, so a
+    full sync has both additions and removals to make.
+
+    The same parameters always build the same data, which lets the stand-in
+    servers (in their own processes) and the benchmark agree on it.
+    """
+
+    def __init__(
+        self,
+        orgs=2,
+        teams=1000,
+        users=10000,
+        skew=1.2,
+        min_group=2,
+        max_group=2000,
+        drift=0.05,
+        seed=1,
+    ):
+        self.params = dict(
+            orgs=orgs,
+            teams=teams,
+            users=users,
+            skew=skew,
+            min_group=min_group,
+            max_group=max_group,
+            drift=drift,
+            seed=seed,
+        )
+        rng = random.Random(seed)
+        self.users = [f"user{n:06d}" for n in range(users)]
+        self.orgs = [f"bench-org-{n}" for n in range(orgs)]
+        # (org, team_id, slug)
+        self.teams = []
+        # slug -> directory members (indexes into users)
+        self.groups = {}
+        # team_id -> GitHub members (logins)
+        self.github = {}
+        for n in range(teams):
+            org = self.orgs[n % orgs]
+            team_id = 1000 + n
+            slug = f"team-{n:05d}"
+            size = min(int(min_group * rng.paretovariate(skew)), max_group, users)
+            members = rng.sample(range(users), size)
+            self.teams.append((org, team_id, slug))
+            self.groups[slug] = members
+            changed = int(size * drift)
+            github = set(self.users[i] for i in members[changed:])
+            github.update(self.users[i] for i in rng.sample(range(users), changed))
+            self.github[team_id] = github
+
+    def email(self, login):
+        return f"{login}@bench.example.com"
+
+    def memberships(self):
+        return sum(len(m) for m in self.groups.values())
+
+    def describe(self):
+        sizes = sorted(len(m) for m in self.groups.values())
+        return (
+            f"{len(self.orgs)} orgs, {len(self.teams)} teams, {len(self.users)} users, "
+            f"{self.memberships()} memberships "
+            f"(group size median {sizes[len(sizes) // 2]}, max {sizes[-1]})"
+        )
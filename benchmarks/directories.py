@@ -0,0 +1,499 @@
+"""
+Stand-ins for the user directories: an in-memory LDAP server built with ldap3's
+MOCK_SYNC strategy, and fake Microsoft Graph, Okta and Google Workspace endpoints
+"""
+
+import email
+import json
+import os
+import threading
+import time
+from http.client import responses
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+from .servers import MockAPI, Response
+
+LDAP_BIND_DN = "cn=bench,dc=bench,dc=example"
+LDAP_PASSWORD = "bench"
+LDAP_USERS = "ou=people,dc=bench,dc=example"
+LDAP_GROUPS = "ou=groups,dc=bench,dc=example"
+
+
+class LDAPDirectory:
+    """
+    Populates an ldap3 mock server with the dataset and points the LDAP backend
+    at it. The mock runs in the sync's own process, so its memory counts towards
+    the sync's, and it scans every entry on each subtree search: keep LDAP runs
+    to a few thousand users.
+    """
+
+    name = "ldap"
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.searches = 0
+        self.lock = threading.Lock()
+
+    def env(self, workdir=None):
+        return {
+            "USER_DIRECTORY": "LDAP",
+            "LDAP_SERVER_HOST": "bench-ldap",
+            "LDAP_SERVER_PORT": "389",
+            # Groups live under their own OU so group searches don't also scan
+            # every user entry of the mock
+            "LDAP_BASE_DN": LDAP_GROUPS,
+            "LDAP_USER_BASE_DN": LDAP_USERS,
+            "LDAP_GROUP_BASE_DN": LDAP_GROUPS,
+            "LDAP_USER_ATTRIBUTE": "sAMAccountName",
+            "LDAP_USER_MAIL_ATTRIBUTE": "mail",
+            "LDAP_USER_FILTER": "(&(objectClass=person)(distinguishedName={username}))",
+            "LDAP_GROUP_FILTER": "(&(objectClass=group)(cn={group_name}))",
+            "LDAP_GROUP_MEMBER_ATTRIBUTE": "member",
+            "LDAP_BIND_USER": LDAP_BIND_DN,
+            "LDAP_BIND_PASSWORD": LDAP_PASSWORD,
+        }
+
+    def install(self, app):
+        """
+        Build the mock directory and make LDAPClient connect to it
+        :param app: The imported app module
+        :return:
+        """
+        from ldap3 import MOCK_SYNC, Connection, Server
+
+        import githubapp.ldap
+
+        server = Server("bench-ldap")
+        setup = Connection(
+            server, user=LDAP_BIND_DN, password=LDAP_PASSWORD, client_strategy=MOCK_SYNC
+        )
+        setup.strategy.add_entry(
+            LDAP_BIND_DN, {"objectClass": ["person"], "userPassword": LDAP_PASSWORD}
+        )
+        for login in self.dataset.users:
+            dn = f"cn={login},{LDAP_USERS}"
+            setup.strategy.add_entry(
+                dn,
+                {
+                    "objectClass": ["top", "person", "user"],
+                    "cn": login,
+                    "sAMAccountName": login,
+                    "mail": self.dataset.email(login),
+                    "distinguishedName": dn,
+                },
+                validate=False,
+            )
+        for slug, members in self.dataset.groups.items():
+            setup.strategy.add_entry(
+                f"cn={slug},{LDAP_GROUPS}",
+                {
+                    "objectClass": ["top", "group"],
+                    "cn": slug,
+                    "member": [
+                        f"cn={self.dataset.users[i]},{LDAP_USERS}" for i in members
+                    ],
+                },
+                validate=False,
+            )
+
+        directory = self
+
+        class CountingConnection(Connection):
+            def search(self, *args, **kwargs):
+                with directory.lock:
+                    directory.searches += 1
+                return super().search(*args, **kwargs)
+
+        def connect(*args, **kwargs):
+            kwargs["client_strategy"] = MOCK_SYNC
+            conn = CountingConnection(*args, **kwargs)
+            # Mock strategies ignore auto_bind
+            if kwargs.get("auto_bind"):
+                conn.bind()
+            return conn
+
+        githubapp.ldap.Server = lambda *args, **kwargs: server
+        githubapp.ldap.Connection = connect
+
+    def stats(self):
+        return {"calls": {"search": self.searches}, "total": self.searches}
+
+
+class MockGraph(MockAPI):
+    """
+    Microsoft identity platform token endpoints and the Graph group and user APIs
+    used by the AAD backend
+    """
+
+    name = "aad"
+
+    def __init__(self, dataset, latency=0.0):
+        super().__init__(latency)
+        self.dataset = dataset
+        self.group_ids = {slug: f"g-{slug}" for slug in dataset.groups}
+        self.route(
+            "GET",
+            r"/(?P<tenant>[^/]+)/v2.0/.well-known/openid-configuration",
+            self.openid_configuration,
+        )
+        self.route("POST", r"/(?P<tenant>[^/]+)/oauth2/v2.0/token", self.token)
+        self.route("GET", r"/v1.0/groups", self.groups)
+        self.route(
+            "GET",
+            r"/v1.0/groups/g-(?P<slug>[^/]+)/(?P<kind>members|transitiveMembers)",
+            self.members,
+        )
+        self.route("GET", r"/v1.0/users/(?P<user>[^/]+)", self.user)
+        self.route("POST", r"/v1\.0/\$batch", self.batch)
+
+    def env(self, workdir=None):
+        host = self.base_url.split("://", 1)[1]
+        return {
+            "USER_DIRECTORY": "AAD",
+            "AZURE_TENANT_ID": "bench",
+            "AZURE_CLIENT_ID": "bench",
+            "AZURE_CLIENT_SECRET": "bench",
+            "AZURE_APP_SCOPE": ".default",
+            "AZURE_AUTHORITY_HOST": host,
+            "AZURE_API_ENDPOINT": f"{self.base_url}/v1.0",
+            "AZURE_USERNAME_ATTRIBUTE": "userPrincipalName",
+            "AZURE_USER_IS_UPN": "true",
+        }
+
+    def openid_configuration(self, tenant, **kwargs):
+        return {
+            "issuer": f"{self.base_url}/{tenant}/v2.0",
+            "authorization_endpoint": f"{self.base_url}/{tenant}/oauth2/v2.0/authorize",
+            "token_endpoint": f"{self.base_url}/{tenant}/oauth2/v2.0/token",
+        }
+
+    def token(self, **kwargs):
+        return {"token_type": "Bearer", "expires_in": 3599, "access_token": "bench"}
+
+    def groups(self, query, **kwargs):
+        # $filter=displayName eq 'name' or startswith(displayName,'prefix'), or
+        # no filter to list every group
+        condition = query.get("$filter", [""])[0]
+        value = condition.split("'")[1::2]
+        value = value[0] if value else ""
+        if condition.startswith("displayName eq"):
+            slugs = [value] if value in self.group_ids else []
+        else:
+            slugs = [slug for slug in self.group_ids if slug.startswith(value)]
+        size = int(query.get("$top", ["100"])[0])
+        start = int(query.get("$skiptoken", ["0"])[0])
+        body = {
+            "value": [
+                {"id": self.group_ids[slug], "displayName": slug}
+                for slug in slugs[start : start + size]
+            ]
+        }
+        if start + size < len(slugs):
+            body["@odata.nextLink"] = (
+                f"{self.base_url}/v1.0/groups?$select=id,displayName"
+                f"&$top={size}&$skiptoken={start + size}"
+                + (f"&$filter={quote(condition)}" if condition else "")
+            )
+        return body
+
+    def members(self, slug, kind, query, **kwargs):
+        members = self.dataset.groups.get(slug, [])
+        size = int(query.get("$top", ["100"])[0])
+        start = int(query.get("$skiptoken", ["0"])[0])
+        body = {
+            "value": [
+                {"@odata.type": "#microsoft.graph.user", "id": self.dataset.users[i]}
+                for i in members[start : start + size]
+            ]
+        }
+        if start + size < len(members):
+            body["@odata.nextLink"] = (
+                f"{self.base_url}/v1.0/groups/g-{slug}/{kind}"
+                f"?$top={size}&$skiptoken={start + size}"
+            )
+        return body
+
+    def user(self, user, **kwargs):
+        email = self.dataset.email(user)
+        return {"id": user, "mail": email, "userPrincipalName": email}
+
+    def batch(self, body, headers, **kwargs):
+        # JSON batching: every request is answered in one round trip
+        responses = []
+        for request in body["requests"]:
+            url = urlsplit(request["url"])
+            response = self.dispatch(
+                request["method"],
+                "/v1.0" + url.path,
+                parse_qs(url.query),
+                request.get("body"),
+                headers,
+                batched=True,
+            )
+            responses.append(
+                {
+                    "id": request["id"],
+                    "status": response.status,
+                    "headers": response.headers,
+                    "body": response.body,
+                }
+            )
+        return {"responses": responses}
+
+
+class MockOkta(MockAPI):
+    """
+    Okta groups and group membership APIs used by the Okta backend. Every endpoint
+    shares a budget of ``rate_limit`` requests per ``window`` seconds, and requests
+    over it get 429 responses.
+    """
+
+    name = "okta"
+
+    def __init__(self, dataset, latency=0.0, rate_limit=600, window=1.0):
+        super().__init__(latency)
+        self.dataset = dataset
+        self.rate_limit = rate_limit
+        self.window = window
+        self.remaining = rate_limit
+        self.reset = 0
+        self.route("GET", r"/api/v1/groups", self.groups)
+        self.route("GET", r"/api/v1/groups/(?P<slug>[^/]+)/users", self.members)
+
+    def env(self, workdir=None):
+        return {
+            "USER_DIRECTORY": "OKTA",
+            "OKTA_ORG_URL": self.base_url,
+            "OKTA_ACCESS_TOKEN": "bench",
+            "OKTA_USERNAME_ATTRIBUTE": "login",
+        }
+
+    def dispatch(self, method, path, query, body, headers, batched=False):
+        now = time.time()
+        with self.lock:
+            if now >= self.reset:
+                # Windows end on whole seconds, like X-Rate-Limit-Reset
+                self.reset = int(now + self.window) + 1
+                self.remaining = self.rate_limit
+            allowed = self.remaining > 0
+            self.remaining = max(self.remaining - 1, 0)
+            remaining, reset = self.remaining, self.reset
+            if not allowed:
+                self.calls["rate_limited"] += 1
+        if allowed:
+            response = super().dispatch(method, path, query, body, headers, batched)
+        else:
+            response = Response(
+                429,
+                {
+                    "errorCode": "E0000047",
+                    "errorSummary": "API call exceeded rate limit due to too many "
+                    "requests.",
+                    "errorLink": "E0000047",
+                    "errorId": "bench",
+                    "errorCauses": [],
+                },
+            )
+        response.headers["X-Rate-Limit-Limit"] = str(self.rate_limit)
+        response.headers["X-Rate-Limit-Remaining"] = str(remaining)
+        response.headers["X-Rate-Limit-Reset"] = str(reset)
+        return response
+
+    def group(self, slug):
+        return {
+            "id": slug,
+            "type": "OKTA_GROUP",
+            "profile": {"name": slug, "description": None},
+            "_links": {},
+        }
+
+    def groups(self, query, **kwargs):
+        # search=profile.name eq "name" or profile.name sw "prefix"
+        search = query.get("search", [""])[0]
+        value = search.split('"')[1] if '"' in search else ""
+        if " eq " in search:
+            slugs = [value] if value in self.dataset.groups else []
+        else:
+            slugs = [slug for slug in self.dataset.groups if slug.startswith(value)]
+        size = min(int(query.get("limit", ["10000"])[0]), 10000)
+        start = int(query.get("after", ["0"])[0])
+        headers = {}
+        if start + size < len(slugs):
+            headers["Link"] = (
+                f"<{self.base_url}/api/v1/groups?"
+                f"{urlencode({'search': search, 'limit': size, 'after': start + size})}"
+                '>; rel="next"'
+            )
+        return Response(
+            body=[self.group(slug) for slug in slugs[start : start + size]],
+            headers=headers,
+        )
+
+    def members(self, slug, query, **kwargs):
+        items = [
+            {
+                "id": self.dataset.users[i],
+                "status": "ACTIVE",
+                "profile": {
+                    "login": self.dataset.email(self.dataset.users[i]),
+                    "email": self.dataset.email(self.dataset.users[i]),
+                },
+                "_links": {},
+            }
+            for i in self.dataset.groups.get(slug, [])
+        ]
+        size = min(int(query.get("limit", ["1000"])[0]), 10000)
+        start = int(query.get("after", ["0"])[0])
+        headers = {}
+        if start + size < len(items):
+            headers["Link"] = (
+                f"<{self.base_url}/api/v1/groups/{slug}/users"
+                f'?limit={size}&after={start + size}>; rel="next"'
+            )
+        return Response(body=items[start : start + size], headers=headers)
+
+
+class MockGoogle(MockAPI):
+    """
+    Google OAuth token endpoint and the Admin SDK Directory groups, members and
+    users APIs used by the Google Workspace backend
+    """
+
+    name = "google"
+
+    def __init__(self, dataset, latency=0.0):
+        super().__init__(latency)
+        self.dataset = dataset
+        self.route("POST", r"/token", self.token)
+        self.route("GET", r"/admin/directory/v1/groups", self.groups)
+        self.route(
+            "GET", r"/admin/directory/v1/groups/(?P<slug>[^/]+)/members", self.members
+        )
+        self.route("GET", r"/admin/directory/v1/users/(?P<user>[^/]+)", self.user)
+        self.route("POST", r"/batch/admin/directory_v1", self.batch)
+
+    def env(self, workdir):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        creds = os.path.join(workdir, "google-sa.json")
+        with open(creds, "w") as f:
+            json.dump(
+                {
+                    "type": "service_account",
+                    "project_id": "bench",
+                    "private_key_id": "bench",
+                    "private_key": key.private_bytes(
+                        serialization.Encoding.PEM,
+                        serialization.PrivateFormat.PKCS8,
+                        serialization.NoEncryption(),
+                    ).decode(),
+                    "client_email": "bench@bench.iam.gserviceaccount.com",
+                    "client_id": "1",
+                    "token_uri": f"{self.base_url}/token",
+                },
+                f,
+            )
+        return {
+            "USER_DIRECTORY": "GOOGLE_WORKSPACE",
+            "GOOGLE_WORKSPACE_SA_CREDS_FILE": creds,
+            "GOOGLE_WORKSPACE_ADMIN_EMAIL": "admin@bench.example.com",
+            "GOOGLE_WORKSPACE_API_ENDPOINT": self.base_url,
+            "GOOGLE_WORKSPACE_USERNAME_CUSTOM_SCHEMA_NAME": "GitHub",
+            "GOOGLE_WORKSPACE_USERNAME_FIELD": "username",
+        }
+
+    def token(self, **kwargs):
+        return {"access_token": "bench", "expires_in": 3600, "token_type": "Bearer"}
+
+    def _page(self, key, items, query):
+        size = min(int(query.get("maxResults", ["200"])[0]), 200)
+        start = int(query.get("pageToken", ["0"])[0])
+        body = {key: items[start : start + size]}
+        if start + size < len(items):
+            body["nextPageToken"] = str(start + size)
+        return body
+
+    def groups(self, query, **kwargs):
+        items = [
+            {"id": slug, "name": slug, "email": f"{slug}@bench.example.com"}
+            for slug in self.dataset.groups
+        ]
+        return self._page("groups", items, query)
+
+    def members(self, slug, query, **kwargs):
+        items = [
+            {
+                "id": self.dataset.users[i],
+                "email": self.dataset.email(self.dataset.users[i]),
+                "role": "MEMBER",
+                "type": "USER",
+                "status": "ACTIVE",
+            }
+            for i in self.dataset.groups.get(slug, [])
+        ]
+        return self._page("members", items, query)
+
+    def user(self, user, **kwargs):
+        return {
+            "id": user,
+            "primaryEmail": self.dataset.email(user),
+            "suspended": False,
+            "archived": False,
+            "customSchemas": {"GitHub": {"username": user}},
+        }
+
+    def batch(self, body, headers, **kwargs):
+        # Batch requests: a multipart/mixed body of application/http requests,
+        # answered in one round trip
+        message = email.message_from_bytes(
+            f"Content-Type: {headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        boundary = "batch_bench"
+        parts = []
+        for part in message.get_payload():
+            method, target, _ = part.get_payload().split("\n", 1)[0].split(" ")
+            url = urlsplit(target)
+            response = self.dispatch(
+                method, url.path, parse_qs(url.query), None, headers, batched=True
+            )
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:]}\r\n\r\n"
+                f"HTTP/1.1 {response.status} {responses[response.status]}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(response.body)}\r\n"
+            )
+        return Response(
+            body=("".join(parts) + f"--{boundary}--\r\n").encode(),
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+        )
+
+
+def prepare(backend, dataset):
+    """
+    Point the directory backend at its stand-in, in the process running the sync
+    :param backend: Key of BACKENDS
+    :param dataset:
+    :return: The in-process directory if there is one, installed once the app is
+             imported and read for its stats
+    """
+    if backend == "ldap":
+        return LDAPDirectory(dataset)
+    if backend == "aad":
+        # msal only skips its online instance discovery for hosts it knows
+        import msal.authority
+
+        host = os.environ["AZURE_AUTHORITY_HOST"].split(":")[0]
+        msal.authority.WELL_KNOWN_AUTHORITY_HOSTS.add(host)
+    return None
+
+
+BACKENDS = {
+    "ldap": LDAPDirectory,
+    "aad": MockGraph,
+    "okta": MockOkta,
+    "google": MockGoogle,
+}
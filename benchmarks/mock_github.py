@@ -0,0 +1,347 @@
+"""
+Stand-in for the parts of the GitHub REST and GraphQL APIs used by the sync
+"""
+
+import collections
+import datetime
+import hashlib
+import json
+import time
+
+from .servers import MockAPI, Response, paginate
+
+RATE_LIMIT = 15000
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class MockGitHub(MockAPI):
+    """
+    Serves the dataset's organizations and teams as GitHub Enterprise would,
+    under ``/api/v3`` and ``/api/graphql``. Team membership changes made by the
+    sync are applied, so consecutive runs converge like they would in production.
+    """
+
+    name = "github"
+
+    def __init__(self, dataset, latency=0.0):
+        super().__init__(latency)
+        self.dataset = dataset
+        self.orgs = {login: n + 1 for n, login in enumerate(dataset.orgs)}
+        self.teams = {team_id: (org, slug) for org, team_id, slug in dataset.teams}
+        self.slugs = {(org, slug): team_id for org, team_id, slug in dataset.teams}
+        self.org_teams = collections.defaultdict(list)
+        for org, team_id, slug in dataset.teams:
+            self.org_teams[org].append(team_id)
+        self.members = {team_id: set(m) for team_id, m in dataset.github.items()}
+        self.logins = set(dataset.users)
+        self.user_ids = {login: n + 1 for n, login in enumerate(dataset.users)}
+        self.remaining = collections.Counter()
+        # The rate-limit window outlasts any benchmark run
+        self.reset = int(time.time()) + 3600
+        api = r"/api/v3"
+        self.route("GET", api + r"/app/installations", self.installations)
+        self.route(
+            "POST",
+            api + r"/app/installations/(?P<id>\d+)/access_tokens",
+            self.access_token,
+        )
+        self.route("GET", api + r"/orgs/(?P<org>[^/]+)", self.organization)
+        self.route("GET", api + r"/orgs/(?P<org>[^/]+)/teams", self.org_team_list)
+        self.route(
+            "GET",
+            api + r"/orgs/(?P<org>[^/]+)/teams/(?P<slug>[^/]+)",
+            self.team_by_slug,
+        )
+        self.route("GET", api + r"/orgs/(?P<org>[^/]+)/members", self.org_members)
+        self.route(
+            "GET", api + r"/orgs/(?P<org>[^/]+)/members/(?P<user>[^/]+)", self.is_member
+        )
+        self.route(
+            "PUT",
+            api + r"/orgs/(?P<org>[^/]+)/memberships/(?P<user>[^/]+)",
+            self.add_org_member,
+        )
+        self.route("GET", api + r"/teams/(?P<id>\d+)", self.team)
+        self.route(
+            "GET", api + r"/organizations/\d+/team/(?P<id>\d+)", self.team, "org_team"
+        )
+        self.route("GET", api + r"/teams/(?P<id>\d+)/members", self.team_members)
+        self.route(
+            "PUT",
+            api + r"/teams/(?P<id>\d+)/memberships/(?P<user>[^/]+)",
+            self.add_team_member,
+        )
+        self.route(
+            "DELETE",
+            api + r"/teams/(?P<id>\d+)/memberships/(?P<user>[^/]+)",
+            self.remove_team_member,
+        )
+        self.route("GET", api + r"/users/(?P<user>[^/]+)", self.user)
+        self.route("POST", r"/api/graphql", self.graphql)
+
+    @property
+    def api_url(self):
+        return f"{self.base_url}/api/v3"
+
+    def dispatch(self, method, path, query, body, headers, batched=False):
+        response = super().dispatch(method, path, query, body, headers, batched)
+        token = headers.get("Authorization", "")
+        with self.lock:
+            self.remaining[token] += 1
+            used = self.remaining[token]
+        response.headers["X-RateLimit-Limit"] = str(RATE_LIMIT)
+        response.headers["X-RateLimit-Remaining"] = str(max(RATE_LIMIT - used, 0))
+        response.headers["X-RateLimit-Reset"] = str(self.reset)
+        return response
+
+    def short_user(self, login):
+        url = f"{self.api_url}/users/{login}"
+        return {
+            "login": login,
+            "id": self.user_ids.get(login, 0),
+            "node_id": f"U_{login}",
+            "avatar_url": "",
+            "gravatar_id": "",
+            "url": url,
+            "html_url": f"{self.base_url}/{login}",
+            "followers_url": f"{url}/followers",
+            "following_url": f"{url}/following{{/other_user}}",
+            "gists_url": f"{url}/gists{{/gist_id}}",
+            "starred_url": f"{url}/starred{{/owner}}{{/repo}}",
+            "subscriptions_url": f"{url}/subscriptions",
+            "organizations_url": f"{url}/orgs",
+            "repos_url": f"{url}/repos",
+            "events_url": f"{url}/events{{/privacy}}",
+            "received_events_url": f"{url}/received_events",
+            "type": "User",
+            "site_admin": False,
+        }
+
+    def short_org(self, org):
+        url = f"{self.api_url}/orgs/{org}"
+        return {
+            "login": org,
+            "id": self.orgs[org],
+            "node_id": f"O_{org}",
+            "url": url,
+            "repos_url": f"{url}/repos",
+            "events_url": f"{url}/events",
+            "hooks_url": f"{url}/hooks",
+            "issues_url": f"{url}/issues",
+            "members_url": f"{url}/members{{/member}}",
+            "public_members_url": f"{url}/public_members{{/member}}",
+            "avatar_url": "",
+            "description": None,
+        }
+
+    def short_team(self, team_id):
+        org, slug = self.teams[team_id]
+        url = f"{self.api_url}/teams/{team_id}"
+        return {
+            "id": team_id,
+            "node_id": f"T_{team_id}",
+            "url": url,
+            "html_url": f"{self.base_url}/orgs/{org}/teams/{slug}",
+            "name": slug,
+            "slug": slug,
+            "description": None,
+            "privacy": "closed",
+            "permission": "pull",
+            "members_url": f"{url}/members{{/member}}",
+            "repositories_url": f"{url}/repos",
+            "parent": None,
+        }
+
+    def installations(self, query, **kwargs):
+        items = [
+            {
+                "id": installation_id,
+                "account": self.short_user(org) | {"type": "Organization"},
+                "access_tokens_url": f"{self.api_url}/app/installations/{installation_id}/access_tokens",
+                "repositories_url": f"{self.api_url}/installation/repositories",
+                "html_url": f"{self.base_url}/organizations/{org}/settings/installations/{installation_id}",
+                "app_id": 1,
+                "target_id": installation_id,
+                "target_type": "Organization",
+                "permissions": {"members": "write"},
+                "events": ["team"],
+                "created_at": _now(),
+                "updated_at": _now(),
+                "single_file_name": None,
+                "repository_selection": "all",
+            }
+            for org, installation_id in self.orgs.items()
+        ]
+        return paginate(items, query, f"{self.api_url}/app/installations")
+
+    def access_token(self, id, **kwargs):
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            hours=1
+        )
+        return Response(
+            201,
+            {
+                "token": f"ghs_bench{id}",
+                "expires_at": expires.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "permissions": {"members": "write"},
+            },
+        )
+
+    def organization(self, org, **kwargs):
+        if org not in self.orgs:
+            return Response(404, {"message": "Not Found"})
+        return self.short_org(org) | {
+            "name": org,
+            "company": None,
+            "blog": None,
+            "location": None,
+            "email": None,
+            "public_repos": 0,
+            "followers": 0,
+            "following": 0,
+            "html_url": f"{self.base_url}/{org}",
+            "created_at": _now(),
+            "type": "Organization",
+        }
+
+    def org_team_list(self, org, query, **kwargs):
+        items = [self.short_team(team_id) for team_id in self.org_teams[org]]
+        return paginate(items, query, f"{self.api_url}/orgs/{org}/teams")
+
+    def org_members(self, org, query, **kwargs):
+        with self.lock:
+            logins = sorted(
+                set().union(*(self.members[t] for t in self.org_teams[org]))
+            )
+        items = [self.short_user(login) for login in logins]
+        return paginate(items, query, f"{self.api_url}/orgs/{org}/members")
+
+    def is_member(self, org, user, **kwargs):
+        return Response(204 if user in self.logins else 404)
+
+    def add_org_member(self, org, user, **kwargs):
+        return {
+            "url": f"{self.api_url}/orgs/{org}/memberships/{user}",
+            "state": "active",
+            "role": "member",
+            "organization_url": f"{self.api_url}/orgs/{org}",
+            "organization": self.short_org(org),
+            "user": self.short_user(user),
+        }
+
+    def team(self, id, **kwargs):
+        team_id = int(id)
+        if team_id not in self.teams:
+            return Response(404, {"message": "Not Found"})
+        org, _ = self.teams[team_id]
+        with self.lock:
+            members_count = len(self.members[team_id])
+        return self.short_team(team_id) | {
+            "members_count": members_count,
+            "repos_count": 0,
+            "created_at": _now(),
+            "updated_at": _now(),
+            "organization": self.short_org(org),
+        }
+
+    def team_by_slug(self, org, slug, **kwargs):
+        team_id = self.slugs.get((org, slug))
+        if team_id is None:
+            return Response(404, {"message": "Not Found"})
+        return self.team(team_id)
+
+    def team_members(self, id, query, headers, **kwargs):
+        team_id = int(id)
+        with self.lock:
+            logins = sorted(self.members.get(team_id, ()))
+        items = [self.short_user(login) for login in logins]
+        response = paginate(items, query, f"{self.api_url}/teams/{team_id}/members")
+        # Conditional listings, like GitHub's: the ETag covers the page returned
+        etag = '"%s"' % hashlib.sha1(json.dumps(response.body).encode()).hexdigest()
+        if headers.get("If-None-Match") == etag:
+            return Response(304, None, {"ETag": etag})
+        response.headers["ETag"] = etag
+        return response
+
+    def add_team_member(self, id, user, **kwargs):
+        if user not in self.logins:
+            return Response(404, {"message": "Not Found"})
+        with self.lock:
+            self.members[int(id)].add(user)
+        return {
+            "url": f"{self.api_url}/teams/{id}/memberships/{user}",
+            "role": "member",
+            "state": "active",
+        }
+
+    def remove_team_member(self, id, user, **kwargs):
+        with self.lock:
+            self.members[int(id)].discard(user)
+        return Response(204)
+
+    def user(self, user, **kwargs):
+        if user not in self.logins:
+            return Response(404, {"message": "Not Found"})
+        return self.short_user(user) | {
+            "name": user,
+            "company": None,
+            "blog": "",
+            "location": None,
+            "email": self.dataset.email(user),
+            "hireable": None,
+            "bio": None,
+            "public_repos": 0,
+            "public_gists": 0,
+            "followers": 0,
+            "following": 0,
+            "created_at": _now(),
+            "updated_at": _now(),
+        }
+
+    def graphql(self, body, **kwargs):
+        """
+        Answers the SAML/SCIM external identities query of an organization; any
+        other query gets an empty result
+        """
+        query = (body or {}).get("query", "")
+        variables = (body or {}).get("variables") or {}
+        if "externalIdentities" not in query:
+            return {"data": {}}
+        org = variables.get("org") or variables.get("login")
+        size = int(variables.get("first") or 100)
+        start = int(variables.get("after") or 0)
+        # Every user is an organization member, as in is_member
+        logins = sorted(self.logins)
+        page = logins[start : start + size]
+        edges = []
+        for login in page:
+            email = self.dataset.email(login)
+            identity = {"username": login, "emails": [{"value": email}]}
+            edges.append(
+                {
+                    "node": {
+                        "guid": f"guid-{login}",
+                        "samlIdentity": identity | {"nameId": email},
+                        "scimIdentity": identity,
+                        "user": {"login": login},
+                    }
+                }
+            )
+        return {
+            "data": {
+                "organization": {
+                    "samlIdentityProvider": {
+                        "externalIdentities": {
+                            "pageInfo": {
+                                "hasNextPage": start + size < len(logins),
+                                "endCursor": str(start + size),
+                            },
+                            "edges": edges,
+                        }
+                    }
+                }
+            }
+        }
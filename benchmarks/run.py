@@ -0,0 +1,349 @@
+"""
+Run a full sync end to end against the stand-in servers and report its cost.
+
+    python -m benchmarks.run --backend aad --teams 10000 --users 100000
+    python -m benchmarks.run --backend ldap --output before.json
+    python -m benchmarks.run --backend ldap --baseline before.json
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from .dataset import Dataset
+from .directories import BACKENDS, prepare
+from .mock_github import MockGitHub
+from .servers import serve, write_certificate, write_private_key
+
+# Metrics compared against a baseline, and whether lower is better
+COMPARED = [
+    ("teams_per_second", False),
+    ("p50_seconds", True),
+    ("p99_seconds", True),
+    ("github_calls", True),
+    ("directory_calls", True),
+    ("peak_rss_mb", True),
+]
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _prepare_directory(backend, params):
+    dataset = Dataset(**params) if backend == "ldap" else None
+    return prepare(backend, dataset)
+
+
+def _sync(setup, setup_args, log_file, results):
+    """
+    Import the app and run one full sync. Runs in a freshly spawned process so
+    that its peak RSS only covers the sync.
+    :param setup: Called with ``setup_args`` before the app is imported. May return
+                  an object with an ``install(app)`` method, called once the app is
+                  imported, and a ``stats()`` method added to the results
+    """
+    prepared = setup(*setup_args)
+    rss_before = _rss_mb()
+
+    with open(log_file, "a") as log, contextlib.redirect_stdout(log):
+        import app
+        from githubapp import logs, tracing, transport
+
+        if hasattr(prepared, "install"):
+            prepared.install(app)
+
+        runs = []
+
+        class CapturedRun(tracing.TraceRun):
+            def __init__(self):
+                super().__init__()
+                runs.append(self)
+
+        tracing.TraceRun = CapturedRun
+        start = time.perf_counter()
+        app.sync_all_teams()
+        wall = time.perf_counter() - start
+        # Write out the queued log records while stdout still goes to the log
+        logs.flush()
+
+    traces = [t for run in runs for t in run.traces]
+    durations = [t.duration for t in traces]
+    results.put(
+        {
+            "wall_seconds": wall,
+            "teams": len(traces),
+            "failed": sum(1 for t in traces if t.error is not None),
+            "teams_per_second": len(traces) / wall if wall else None,
+            "p50_seconds": _percentile(durations, 0.50),
+            "p99_seconds": _percentile(durations, 0.99),
+            "max_seconds": max(durations, default=None),
+            "rss_before_sync_mb": rss_before,
+            "peak_rss_mb": _rss_mb(),
+            "stats": prepared.stats() if prepared else None,
+            "http_pools": transport.pool_stats(),
+        }
+    )
+
+
+def spawn_sync(setup, setup_args, log_file):
+    """
+    Run one full sync in a new process, see ``_sync``
+    :return: The measurements of the run
+    :rtype: dict
+    """
+    spawn = multiprocessing.get_context("spawn")
+    results = spawn.Queue()
+    sync = spawn.Process(target=_sync, args=(setup, setup_args, log_file, results))
+    sync.start()
+    while True:
+        try:
+            run = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not sync.is_alive():
+                raise RuntimeError(f"The sync process exited with code {sync.exitcode}")
+    sync.join()
+    return run
+
+
+def start_server(api, cert_file, key_file):
+    """
+    Serve a stand-in from its own process
+    :return: The process and the server's base URL
+    """
+    context = multiprocessing.get_context("fork")
+    ready = context.Queue()
+    process = context.Process(
+        target=serve, args=(api, cert_file, key_file, ready), daemon=True
+    )
+    process.start()
+    base_url = ready.get(timeout=60)
+    api.base_url = base_url
+    return process, base_url
+
+
+def server_stats(base_url):
+    return requests.get(f"{base_url}/_stats", timeout=30).json()
+
+
+def _delta(after, before):
+    calls = {
+        route: count - before["calls"].get(route, 0)
+        for route, count in after["calls"].items()
+        if count - before["calls"].get(route, 0)
+    }
+    return {"calls": calls, "total": after["total"] - before["total"]}
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_run(number, run):
+    print(
+        f"Run {number}: {run['teams']} teams ({run['failed']} failed) in "
+        f"{run['wall_seconds']:.1f}s = {run['teams_per_second']:.1f} teams/s"
+    )
+    if run["teams"]:
+        print(
+            f"  per-team latency p50 {run['p50_seconds'] * 1000:.0f}ms, "
+            f"p99 {run['p99_seconds'] * 1000:.0f}ms, max {run['max_seconds'] * 1000:.0f}ms"
+        )
+    print(
+        f"  API calls: {run['github_calls']} GitHub, {run['directory_calls']} directory"
+    )
+    for route, count in sorted(run["github_calls_by_route"].items()):
+        print(f"    github {route}: {count}")
+    for route, count in sorted(run["directory_calls_by_route"].items()):
+        print(f"    directory {route}: {count}")
+    for host, pool in sorted(run["http_pools"].items()):
+        print(
+            f"  {host}: {pool['requests']} requests over "
+            f"{pool['connections']} connections, "
+            f"{pool['received_bytes'] / 1024:.0f} kB received"
+        )
+    print(
+        f"  peak RSS {run['peak_rss_mb']:.0f} MB "
+        f"({run['rss_before_sync_mb']:.0f} MB before the sync started)"
+    )
+
+
+def compare(result, baseline):
+    """
+    Print the change of each compared metric against a previous result
+    """
+    print(f"Compared with {baseline.get('commit') or 'baseline'}:")
+    for number, (run, base) in enumerate(zip(result["runs"], baseline["runs"]), 1):
+        for metric, lower_is_better in COMPARED:
+            new, old = run.get(metric), base.get(metric)
+            if new is None or not old:
+                continue
+            change = (new - old) / old * 100
+            better = (change < 0) == lower_is_better
+            verdict = "" if abs(change) < 1 else (" better" if better else " worse")
+            print(
+                f"  run {number} {metric}: {old:.3g} -> {new:.3g} ({change:+.1f}%{verdict})"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="ldap")
+    parser.add_argument("--orgs", type=int, default=2)
+    parser.add_argument("--teams", type=int, default=500)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument(
+        "--skew", type=float, default=1.2, help="Pareto shape of the group sizes"
+    )
+    parser.add_argument("--max-group", type=int, default=2000)
+    parser.add_argument(
+        "--drift",
+        type=float,
+        default=0.05,
+        help="Share of each team that differs from its directory group",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds added to every stand-in response",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=2,
+        help="Consecutive full syncs; the first applies the drift, later ones are no-ops",
+    )
+    parser.add_argument("--workers", type=int, help="SYNC_WORKERS for the sync")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with results from --output")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    args = parser.parse_args(argv)
+
+    params = dict(
+        orgs=args.orgs,
+        teams=args.teams,
+        users=args.users,
+        skew=args.skew,
+        max_group=args.max_group,
+        drift=args.drift,
+        seed=args.seed,
+    )
+    dataset = Dataset(**params)
+    print(f"Dataset: {dataset.describe()}")
+
+    workdir = tempfile.mkdtemp(prefix="team-sync-bench-")
+    processes = []
+    try:
+        cert_file, key_file = write_certificate(workdir)
+        app_key = os.path.join(workdir, "app.pem")
+        write_private_key(app_key)
+
+        github = MockGitHub(dataset, latency=args.latency)
+        process, github_url = start_server(github, cert_file, key_file)
+        processes.append(process)
+
+        directory_url = None
+        if args.backend == "ldap":
+            env = BACKENDS["ldap"](dataset).env(workdir)
+        else:
+            directory = BACKENDS[args.backend](dataset, latency=args.latency)
+            process, directory_url = start_server(directory, cert_file, key_file)
+            processes.append(process)
+            env = directory.env(workdir)
+        del dataset
+
+        env.update(
+            APP_ID="1",
+            WEBHOOK_SECRET="bench",
+            PRIVATE_KEY_PATH=app_key,
+            GHE_HOST=github_url.split("://", 1)[1],
+            VERIFY_SSL="true",
+            REQUESTS_CA_BUNDLE=cert_file,
+            SSL_CERT_FILE=cert_file,
+            HTTPLIB2_CA_CERTS=cert_file,
+            USER_SYNC_ATTRIBUTE="username",
+            CHANGE_THRESHOLD=str(10**9),
+            OPEN_ISSUE_ON_FAILURE="false",
+            TRACE_TOP_N="0",
+        )
+        if args.workers:
+            env["SYNC_WORKERS"] = str(args.workers)
+        os.environ.pop("FLASK_APP", None)
+        os.environ.update(env)
+
+        log_file = os.path.join(workdir, "sync.log")
+        result = {
+            "commit": _commit(),
+            "backend": args.backend,
+            "dataset": params,
+            "latency": args.latency,
+            "workers": args.workers,
+            "runs": [],
+        }
+        for number in range(1, args.runs + 1):
+            github_before = server_stats(github_url)
+            directory_before = server_stats(directory_url) if directory_url else None
+            run = spawn_sync(_prepare_directory, (args.backend, params), log_file)
+            github_calls = _delta(server_stats(github_url), github_before)
+            if directory_url:
+                directory_calls = _delta(server_stats(directory_url), directory_before)
+            else:
+                directory_calls = run["stats"]
+            del run["stats"]
+            run.update(
+                github_calls=github_calls["total"],
+                github_calls_by_route=github_calls["calls"],
+                directory_calls=directory_calls["total"],
+                directory_calls_by_route=directory_calls["calls"],
+            )
+            result["runs"].append(run)
+            print_run(number, run)
+        if args.keep:
+            print(f"Sync output: {log_file}")
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                compare(result, json.load(f))
+    finally:
+        for process in processes:
+            process.terminate()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
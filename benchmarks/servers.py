@@ -0,0 +1,223 @@
+"""
+Threaded HTTPS stand-ins for the APIs the sync talks to
+"""
+
+import collections
+import datetime
+import ipaddress
+import json
+import os
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+
+def write_private_key(path):
+    """
+    Write a new RSA private key in PEM format
+    :param path:
+    :return: The key
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.TraditionalOpenSSL,
+                serialization.NoEncryption(),
+            )
+        )
+    return key
+
+
+def write_certificate(directory):
+    """
+    Create a self-signed certificate for localhost, so the real HTTP clients
+    (requests, httplib2, aiohttp) can be pointed at the stand-ins with full
+    certificate verification
+    :param directory:
+    :return: Paths of the certificate and its key
+    :rtype: tuple
+    """
+    key_file = os.path.join(directory, "localhost.key")
+    cert_file = os.path.join(directory, "localhost.pem")
+    key = write_private_key(key_file)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=7))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [
+                    x509.DNSName("localhost"),
+                    x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+                ]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    with open(cert_file, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    return cert_file, key_file
+
+
+class Response:
+    """
+    A stand-in's response. ``body`` is sent as JSON, unless it is bytes.
+    """
+
+    def __init__(self, status=200, body=None, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+class MockAPI:
+    """
+    Base class for an API stand-in. Subclasses register routes with ``route`` and
+    return a ``Response`` (or a JSON-serializable body) from each handler.
+    Every request is counted per route, and ``latency`` seconds are added to each
+    response to simulate the network round trip.
+    """
+
+    name = "api"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.routes = []
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.base_url = None
+
+    def route(self, method, pattern, handler, name=None):
+        self.routes.append(
+            (method, re.compile(pattern + "$"), handler, name or handler.__name__)
+        )
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "total": sum(self.calls.values())}
+
+    def dispatch(self, method, path, query, body, headers, batched=False):
+        """
+        Route a request to its handler
+        :param batched: Whether the request is part of a batch request, which
+                        already paid the latency. It is counted as "batched <route>".
+        :return: Response
+        """
+        if path == "/_stats":
+            return Response(body=self.stats())
+        for route_method, pattern, handler, name in self.routes:
+            if route_method != method:
+                continue
+            match = pattern.match(path)
+            if match:
+                with self.lock:
+                    self.calls[f"batched {name}" if batched else name] += 1
+                if self.latency and not batched:
+                    time.sleep(self.latency)
+                result = handler(
+                    query=query, body=body, headers=headers, **match.groupdict()
+                )
+                return result if isinstance(result, Response) else Response(body=result)
+        return Response(404, {"message": "Not Found", "path": path})
+
+
+def paginate(items, query, url, default_size=30, max_size=100):
+    """
+    Slice ``items`` like the GitHub REST API, with a Link header to the next page
+    :return: Response
+    """
+    size = min(int(query.get("per_page", [default_size])[0]), max_size)
+    page = int(query.get("page", ["1"])[0])
+    start = (page - 1) * size
+    links = []
+    if start + size < len(items):
+        links.append(f'<{url}?per_page={size}&page={page + 1}>; rel="next"')
+    if page > 1:
+        links.append(f'<{url}?per_page={size}&page={page - 1}>; rel="prev"')
+    headers = {"Link": ", ".join(links)} if links else {}
+    return Response(body=items[start : start + size], headers=headers)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        if raw and "json" in content_type:
+            body = json.loads(raw)
+        elif raw and content_type.startswith("multipart/"):
+            body = raw
+        elif raw:
+            body = parse_qs(raw.decode())
+        else:
+            body = None
+        try:
+            response = self.api.dispatch(
+                self.command, url.path, parse_qs(url.query), body, self.headers
+            )
+        except Exception as e:
+            response = Response(500, {"message": repr(e)})
+        if isinstance(response.body, bytes):
+            payload = response.body
+        else:
+            payload = (
+                b"" if response.body is None else json.dumps(response.body).encode()
+            )
+        self.send_response(response.status)
+        if payload and "Content-Type" not in response.headers:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for header, value in response.headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+
+def serve(api, cert_file, key_file, ready, port=0):
+    """
+    Serve ``api`` over HTTPS on localhost until the process is terminated.
+    Meant to run in a child process so the stand-in does not compete with the
+    sync for the GIL, or count towards its memory.
+    :param api: The MockAPI to serve
+    :param ready: Queue receiving the base URL once the server listens
+    :return:
+    """
+    handler = type("Handler", (_Handler,), {"api": api})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    api.base_url = f"https://localhost:{server.server_address[1]}"
+    if hasattr(api, "started"):
+        api.started()
+    ready.put(api.base_url)
+    server.serve_forever()
@@ -0,0 +1,329 @@
+"""
+Drive the webhook endpoint with a realistic mix of signed GitHub events and
+report its throughput and latency.
+
+    python -m benchmarks.webhooks --requests 20000
+    python -m benchmarks.webhooks --url http://localhost:5000/ --secret "$WEBHOOK_SECRET"
+
+Without ``--url`` the requests are sent in process, through Flask's test client,
+to a ``GitHubApp`` with the same hooks as the app, so only the cost of routing
+and verifying the deliveries is measured.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import requests
+
+from .run import _commit, _percentile
+from .servers import write_private_key
+
+# Share of the deliveries, action and approximate payload size in bytes of each
+# event, modelled on the deliveries of an organization-wide app. Only the team
+# events are routed by the app, and only team.created calls a hook.
+EVENT_MIX = [
+    ("push", None, 0.34, 9000),
+    ("pull_request", "synchronize", 0.12, 24000),
+    ("pull_request", "opened", 0.04, 24000),
+    ("check_run", "completed", 0.12, 11000),
+    ("check_suite", "completed", 0.06, 9000),
+    ("status", None, 0.10, 7000),
+    ("issue_comment", "created", 0.08, 12000),
+    ("workflow_run", "completed", 0.08, 14000),
+    ("membership", "added", 0.02, 4000),
+    ("team", "edited", 0.02, 4000),
+    ("team", "created", 0.02, 4000),
+]
+# Distinct payloads generated per event, so the server can't benefit from
+# receiving the same bytes over and over
+VARIANTS = 20
+HANDLED = {"team"}
+
+
+def _payload(event, action, size, rng):
+    """
+    Build a delivery of roughly ``size`` bytes with the fields the app reads
+    """
+    org = "bench-org-%d" % rng.randint(1, 5)
+    payload = {
+        "installation": {
+            "id": 1,
+            "node_id": "MDIzOkludGVncmF0aW9uSW5zdGFsbGF0aW9uMQ==",
+        },
+        "organization": {"login": org, "id": rng.randint(1, 10**6)},
+        "sender": {"login": "user%06d" % rng.randint(0, 99999), "type": "User"},
+    }
+    if action:
+        payload["action"] = action
+    if event == "team":
+        name = "team-%05d" % rng.randint(0, 99999)
+        payload["team"] = {
+            "id": rng.randint(1000, 10**6),
+            "name": name,
+            "slug": name,
+            "privacy": "closed",
+        }
+    else:
+        payload["repository"] = {
+            "id": rng.randint(1, 10**7),
+            "full_name": "%s/repo-%d" % (org, rng.randint(1, 5000)),
+            "private": True,
+        }
+    # Pad with commit-like entries, the bulk of most real deliveries
+    filler = []
+    while len(json.dumps(payload)) + 260 * len(filler) < size:
+        filler.append(
+            {
+                "id": "%040x" % rng.getrandbits(160),
+                "message": "Update %d files" % rng.randint(1, 40),
+                "timestamp": "2024-01-01T00:00:00Z",
+                "added": [],
+                "removed": [],
+                "modified": ["src/module_%d.py" % rng.randint(1, 500)],
+            }
+        )
+    payload["commits"] = filler
+    return json.dumps(payload).encode("utf-8")
+
+
+def _sign(secret, body, legacy):
+    if legacy:
+        return {
+            "X-Hub-Signature": "sha1="
+            + hmac.new(secret, body, hashlib.sha1).hexdigest()
+        }
+    return {
+        "X-Hub-Signature": "sha1=" + hmac.new(secret, body, hashlib.sha1).hexdigest(),
+        "X-Hub-Signature-256": "sha256="
+        + hmac.new(secret, body, hashlib.sha256).hexdigest(),
+    }
+
+
+def build_deliveries(secret, count, seed=1, legacy=False):
+    """
+    Sample ``count`` signed deliveries from EVENT_MIX
+    :return: List of (kind, headers, body)
+    """
+    rng = random.Random(seed)
+    variants = {}
+    for event, action, _, size in EVENT_MIX:
+        kind = "%s.%s" % (event, action) if action else event
+        bodies = [_payload(event, action, size, rng) for _ in range(VARIANTS)]
+        variants[kind] = [
+            (
+                dict(
+                    _sign(secret, body, legacy),
+                    **{
+                        "X-GitHub-Event": event,
+                        "X-GitHub-Delivery": "%032x" % rng.getrandbits(128),
+                        "Content-Type": "application/json",
+                    },
+                ),
+                body,
+            )
+            for body in bodies
+        ]
+    kinds = list(variants)
+    weights = [weight for _, _, weight, _ in EVENT_MIX]
+    return [
+        (kind,) + rng.choice(variants[kind])
+        for kind in rng.choices(kinds, weights=weights, k=count)
+    ]
+
+
+def local_client(secret):
+    """
+    A Flask test client for a GitHubApp with the app's hooks
+    :return: A function posting one delivery and returning the status code
+    """
+    from flask import Flask
+
+    from githubapp import GitHubApp
+
+    workdir = tempfile.mkdtemp(prefix="team-sync-webhooks-")
+    try:
+        key_file = os.path.join(workdir, "app.pem")
+        write_private_key(key_file)
+        os.environ.update(
+            APP_ID="1", WEBHOOK_SECRET=secret.decode(), PRIVATE_KEY_PATH=key_file
+        )
+        os.environ.pop("GHE_HOST", None)
+        app = Flask(__name__)
+        github_app = GitHubApp(app)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    @github_app.on("team.created")
+    def sync_new_team():
+        return github_app.payload["team"]["slug"]
+
+    client = app.test_client()
+
+    def post(headers, body):
+        return client.post("/", data=body, headers=headers).status_code
+
+    return post
+
+
+def remote_client(url, verify=True):
+    """
+    :return: A function posting one delivery to ``url`` and returning the status code
+    """
+    local = threading.local()
+
+    def post(headers, body):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.verify = verify
+        return local.session.post(
+            url, data=body, headers=headers, timeout=30
+        ).status_code
+
+    return post
+
+
+def drive(post, deliveries, concurrency=1):
+    """
+    Send every delivery and time each one
+    :return: Wall time, and latencies and status codes by kind of delivery
+    """
+    latencies = collections.defaultdict(list)
+    statuses = collections.Counter()
+
+    def send(delivery):
+        kind, headers, body = delivery
+        start = time.perf_counter()
+        status = post(headers, body)
+        return kind, status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(send, deliveries))
+    else:
+        results = [send(delivery) for delivery in deliveries]
+    wall = time.perf_counter() - start
+    for kind, status, latency in results:
+        latencies[kind].append(latency)
+        statuses[status] += 1
+    return wall, latencies, statuses
+
+
+def summarize(wall, latencies, statuses):
+    everything = [l for values in latencies.values() for l in values]
+
+    def stats(values):
+        return {
+            "requests": len(values),
+            "p50_ms": _percentile(values, 0.50) * 1000,
+            "p99_ms": _percentile(values, 0.99) * 1000,
+            "max_ms": max(values) * 1000,
+        }
+
+    handled = [
+        l
+        for kind, values in latencies.items()
+        for l in values
+        if kind.split(".")[0] in HANDLED
+    ]
+    ignored = [
+        l
+        for kind, values in latencies.items()
+        for l in values
+        if kind.split(".")[0] not in HANDLED
+    ]
+    return {
+        "wall_seconds": wall,
+        "requests_per_second": len(everything) / wall if wall else None,
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "all": stats(everything),
+        "handled": stats(handled) if handled else None,
+        "ignored": stats(ignored) if ignored else None,
+        "events": {kind: stats(values) for kind, values in sorted(latencies.items())},
+    }
+
+
+def print_summary(summary):
+    print(
+        f"{summary['all']['requests']} deliveries in {summary['wall_seconds']:.2f}s "
+        f"= {summary['requests_per_second']:.0f} requests/s"
+    )
+    print(
+        "  status codes: "
+        + ", ".join(f"{s}: {c}" for s, c in sorted(summary["statuses"].items()))
+    )
+    print(f"  {'event':<28}{'requests':>9}{'p50':>10}{'p99':>10}{'max':>10}")
+    rows = [("all", summary["all"]), ("handled", summary["handled"])]
+    rows += [("unsubscribed", summary["ignored"])]
+    rows += sorted(summary["events"].items())
+    for name, stats in rows:
+        if stats:
+            print(
+                f"  {name:<28}{stats['requests']:>9}{stats['p50_ms']:>8.2f}ms"
+                f"{stats['p99_ms']:>8.2f}ms{stats['max_ms']:>8.2f}ms"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--url", help="Webhook URL of a running app; in process if unset"
+    )
+    parser.add_argument(
+        "--secret",
+        default=os.environ.get("WEBHOOK_SECRET", "bench"),
+        help="Webhook secret the deliveries are signed with. Default: $WEBHOOK_SECRET",
+    )
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Parallel senders with --url"
+    )
+    parser.add_argument(
+        "--legacy-signature",
+        action="store_true",
+        help="Only send the SHA-1 X-Hub-Signature header",
+    )
+    parser.add_argument(
+        "--no-verify", action="store_true", help="Skip TLS verification"
+    )
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    secret = args.secret.encode("utf-8")
+    deliveries = build_deliveries(
+        secret, args.requests + args.warmup, args.seed, args.legacy_signature
+    )
+    if args.url:
+        post = remote_client(args.url, verify=not args.no_verify)
+        concurrency = args.concurrency
+    else:
+        post = local_client(secret)
+        concurrency = 1
+    drive(post, deliveries[: args.warmup], concurrency)
+    summary = summarize(*drive(post, deliveries[args.warmup :], concurrency))
+    print_summary(summary)
+    if args.output:
+        summary.update(
+            commit=_commit(),
+            url=args.url,
+            concurrency=concurrency,
+            legacy_signature=args.legacy_signature,
+        )
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
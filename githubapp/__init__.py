@@ -1,22 +1,53 @@
+import importlib
 import os
-from distutils.util import strtobool
 
+from .config import parse_mapping, strtobool
 from .core import GitHubApp
-
-if os.environ.get("USER_DIRECTORY", "LDAP").upper() == "LDAP":
-    from .ldap import LDAPClient as DirectoryClient
-elif os.environ.get("USER_DIRECTORY", "LDAP").upper() == "AAD":
-    from .azuread import AzureAD as DirectoryClient
-elif os.environ.get("USER_DIRECTORY", "LDAP").upper() == "OKTA":
-    from .okta import Okta as DirectoryClient
-elif os.environ.get("USER_DIRECTORY", "LDAP").upper() == "ONELOGIN":
-    from .onelogin import OneLogin as DirectoryClient
-elif os.environ.get("USER_DIRECTORY", "LDAP").upper() == "GOOGLE_WORKSPACE":
-    from .googleworkspace import GoogleWorkspaceClient as DirectoryClient
-elif os.environ.get("USER_DIRECTORY", "LDAP").upper() == "KEYCLOAK":
-    from .keycloak import Keycloak as DirectoryClient
 from .version import __version__
 
+# Module and class of each USER_DIRECTORY backend. Only the chosen backend, and so
+# only its SDK, is imported, when the first client is created.
+DIRECTORY_BACKENDS = {
+    "LDAP": ("ldap", "LDAPClient"),
+    "AAD": ("azuread", "AzureAD"),
+    "OKTA": ("okta", "Okta"),
+    "ONELOGIN": ("onelogin", "OneLogin"),
+    "GOOGLE_WORKSPACE": ("googleworkspace", "GoogleWorkspaceClient"),
+    "KEYCLOAK": ("keycloak", "Keycloak"),
+}
+if os.environ.get("USER_DIRECTORY", "LDAP").upper() not in DIRECTORY_BACKENDS:
+    raise ImportError(
+        f"Unknown USER_DIRECTORY {os.environ['USER_DIRECTORY']}, expected one of "
+        + ", ".join(DIRECTORY_BACKENDS)
+    )
+
+
+def directory_backend(backend=None):
+    """
+    The class of a directory backend, imported on first use
+    :param backend: Name of the backend, such as "AAD". Default: USER_DIRECTORY
+    :return:
+    """
+    backend = (backend or os.environ.get("USER_DIRECTORY", "LDAP")).upper()
+    if backend not in DIRECTORY_BACKENDS:
+        raise ValueError(
+            f"Unknown directory backend {backend}, expected one of "
+            + ", ".join(DIRECTORY_BACKENDS)
+        )
+    module, name = DIRECTORY_BACKENDS[backend]
+    return getattr(importlib.import_module(f".{module}", __name__), name)
+
+
+class DirectoryClient:
+    """
+    Client of the user directory chosen with USER_DIRECTORY, or of another backend
+    given as ``backend``. Creating one returns an instance of the backend's class.
+    """
+
+    def __new__(cls, *args, backend=None, **kwargs):
+        return directory_backend(backend)(*args, **kwargs)
+
+
 __all__ = ["GitHubApp", "DirectoryClient"]
 
 # Set default logging handler to avoid "No handler found" warnings.
@@ -47,5 +78,59 @@ ADD_MEMBER = strtobool(os.environ.get("ADD_MEMBER", "False"))
 REMOVE_ORG_MEMBERS_WITHOUT_TEAM = strtobool(
     os.environ.get("REMOVE_ORG_MEMBERS_WITHOUT_TEAM", "False")
 )
+DIRECTORY_BACKEND = os.environ.get("USER_DIRECTORY", "LDAP").upper()
 USER_SYNC_ATTRIBUTE = os.environ.get("USER_SYNC_ATTRIBUTE", "username").lower()
 SYNCMAP_ONLY = strtobool(os.environ.get("SYNCMAP_ONLY", "False"))
+# Number of teams processed concurrently in each stage of a full sync
+SYNC_WORKERS = int(os.environ.get("SYNC_WORKERS", 10))
+# Maximum number of teams waiting between two stages of a full sync
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 100))
+# Most directory groups fetched with one bulk lookup during a full sync
+DIRECTORY_BATCH_SIZE = int(os.environ.get("DIRECTORY_BATCH_SIZE", 50))
+# Seconds a team's directory and GitHub lookups may each take; 0 for no limit
+DIRECTORY_TIMEOUT = float(os.environ.get("DIRECTORY_TIMEOUT", 300))
+GITHUB_TIMEOUT = float(os.environ.get("GITHUB_TIMEOUT", 600))
+# "sync" applies changes as teams are compared, "plan" writes them to SYNC_PLAN
+# and "apply" makes the changes listed in SYNC_PLAN
+SYNC_MODE = os.environ.get("SYNC_MODE", "sync").lower()
+SYNC_PLAN = os.environ.get("SYNC_PLAN", "sync-plan.jsonl")
+# Teams changed concurrently when applying a plan
+APPLY_WORKERS = int(os.environ.get("APPLY_WORKERS", 4))
+# Most changes a plan may contain in total for it to be applied; unset for no limit
+PLAN_MAX_CHANGES = (
+    int(os.environ["PLAN_MAX_CHANGES"]) if os.environ.get("PLAN_MAX_CHANGES") else None
+)
+# "fifo" syncs teams as they are listed. "priority" lists every team first, then
+# syncs failed, recently changed and least recently synced teams first, starting
+# none after SYNC_TIME_BUDGET
+SYNC_SCHEDULER = os.environ.get("SYNC_SCHEDULER", "fifo").lower()
+# "auto" ends SYNC_BUDGET_MARGIN seconds before the next scheduled run, a number
+# is a duration in seconds, and empty or 0 means no limit
+SYNC_TIME_BUDGET = os.environ.get("SYNC_TIME_BUDGET", "auto").lower()
+SYNC_BUDGET_MARGIN = float(os.environ.get("SYNC_BUDGET_MARGIN", 60))
+# Directory backend of the organizations not using USER_DIRECTORY, such as
+# "acme=AAD,acme-labs=OKTA"
+ORG_DIRECTORIES = {
+    org: backend.upper()
+    for org, backend in parse_mapping(os.environ.get("ORG_DIRECTORIES")).items()
+}
+# Teams looked up concurrently in each directory backend during a full sync, such
+# as "AAD=20,OKTA=4". Backends not listed get SYNC_WORKERS.
+DIRECTORY_WORKERS = {
+    backend.upper(): int(workers)
+    for backend, workers in parse_mapping(os.environ.get("DIRECTORY_WORKERS")).items()
+}
+for _backend in [*ORG_DIRECTORIES.values(), *DIRECTORY_WORKERS]:
+    if _backend not in DIRECTORY_BACKENDS:
+        raise ImportError(
+            f"Unknown directory backend {_backend}, expected one of "
+            + ", ".join(DIRECTORY_BACKENDS)
+        )
+# "saml" or "scim" to join directory users to GitHub logins through the external
+# identities of each organization; unset to compare USER_SYNC_ATTRIBUTE directly
+IDENTITY_INDEX = os.environ.get("IDENTITY_INDEX", "").lower()
+if IDENTITY_INDEX not in ("", "saml", "scim"):
+    raise ImportError(f"IDENTITY_INDEX must be saml or scim, not {IDENTITY_INDEX}")
+# Seconds between starting the web server and the first full sync; negative to
+# wait for the schedule
+INITIAL_SYNC_DELAY = float(os.environ.get("INITIAL_SYNC_DELAY", 10))
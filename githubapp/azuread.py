@@ -1,16 +1,32 @@
 import os
-import json
 import logging
-from distutils.util import strtobool
+import threading
+import time
 import requests
 import msal
 
+from .config import strtobool
+from .directory import chunked, rewrite_usernames
+from .syncmap import load_syncmap
+from .transport import get_session
+
 # Optional logging
 # logging.basicConfig(level=logging.DEBUG)  # Enable DEBUG log for entire script
 # logging.getLogger("msal").setLevel(logging.INFO)  # Optionally disable MSAL DEBUG logs
 
 LOG = logging.getLogger(__name__)
 
+# Most requests Microsoft Graph accepts in one JSON batch
+GRAPH_BATCH_SIZE = 20
+# Most groups Microsoft Graph returns in one page
+GRAPH_PAGE_SIZE = 999
+# Properties of group members the sync reads
+MEMBER_FIELDS = "id,displayName"
+
+# IDs of the groups by casefolded display name, shared by all clients for a run
+_group_index = None
+_group_index_lock = threading.Lock()
+
 
 class AzureAD:
     def __init__(self):
@@ -21,6 +37,9 @@ class AzureAD:
             f"https://graph.microsoft.com/{x}"
             for x in os.environ["AZURE_APP_SCOPE"].split(" ")
         ]
+        self.AZURE_AUTHORITY_HOST = os.environ.get(
+            "AZURE_AUTHORITY_HOST", "login.microsoftonline.com"
+        )
         self.AZURE_API_ENDPOINT = os.environ.get(
             "AZURE_API_ENDPOINT", "https://graph.microsoft.com/v1.0"
         )
@@ -31,6 +50,9 @@ class AzureAD:
         self.AZURE_USE_TRANSITIVE_GROUP_MEMBERS = strtobool(
             os.environ.get("AZURE_USE_TRANSITIVE_GROUP_MEMBERS", "False")
         )
+        self.AZURE_GROUP_INDEX = strtobool(os.environ.get("AZURE_GROUP_INDEX", "True"))
+        # Pooled keep-alive connections with default timeouts, shared by all clients
+        self.session = get_session("AAD")
 
     def get_access_token(self):
         """
@@ -39,17 +61,16 @@ class AzureAD:
         """
         app = msal.ConfidentialClientApplication(
             self.AZURE_CLIENT_ID,
-            authority=f"https://login.microsoftonline.com/{self.AZURE_TENANT_ID}",
+            authority=f"https://{self.AZURE_AUTHORITY_HOST}/{self.AZURE_TENANT_ID}",
             client_credential=self.AZURE_CLIENT_SECRET,
+            http_client=self.session,
         )
 
         # Lookup the token in cache
         result = app.acquire_token_silent(self.AZURE_APP_SCOPE, account=None)
 
         if not result:
-            logging.info(
-                "No suitable token exists in cache. Let's get a new one from AAD."
-            )
+            LOG.info("No suitable token exists in cache. Let's get a new one from AAD.")
             result = app.acquire_token_for_client(scopes=self.AZURE_APP_SCOPE)
 
         if "access_token" in result:
@@ -57,11 +78,13 @@ class AzureAD:
             return result["access_token"]
 
         else:
-            print(result.get("error"))
-            print(result.get("error_description"))
-            print(
-                result.get("correlation_id")
-            )  # You may need this when reporting a bug
+            # The correlation ID may be needed when reporting a bug
+            LOG.error(
+                "Unable to get an Azure AD token: %s: %s (correlation ID %s)",
+                result.get("error"),
+                result.get("error_description"),
+                result.get("correlation_id"),
+            )
 
     def get_group_members(self, token=None, group_name=None):
         """
@@ -70,56 +93,273 @@ class AzureAD:
         :param group_name:
         :return:
         """
+        return list(self.iter_group_members(token=token, group_name=group_name))
+
+    def iter_group_members(self, token=None, group_name=None):
+        """
+        Yield the members of a given group, one page of members at a time
+        :param token:
+        :param group_name:
+        :return: Dicts of username and email
+        :rtype: generator
+        """
         token = self.get_access_token() if not token else token
-        member_list = []
-        # Calling graph using the access token
-        # url encode the group name
-        group_name = requests.utils.quote(group_name)
-        graph_data = requests.get(  # Use token to call downstream service
-            f"{self.AZURE_API_ENDPOINT}/groups?$filter=displayName eq '{group_name}'",
+        group_id = self.get_group_id(token, group_name)
+        if group_id is None:
+            return
+        members_endpoint = (
+            "transitiveMembers"
+            if self.AZURE_USE_TRANSITIVE_GROUP_MEMBERS
+            else "members"
+        )
+        members = self.iter_group_members_pages(
+            token,
+            f"{self.AZURE_API_ENDPOINT}/groups/{group_id}/{members_endpoint}"
+            f"?$select={MEMBER_FIELDS}",
+        )
+        for member in members:
+            if member["@odata.type"] == "#microsoft.graph.group":
+                LOG.debug("Nested group: %s", member["displayName"])
+            else:
+                user = self.member_info(
+                    self.get_user_info(token=token, user=member["id"])
+                )
+                if user is not None:
+                    yield user
+
+    def get_group_id(self, token, group_name):
+        """
+        Find the ID of a group in the group index, or look it up by name if the
+        group isn't indexed
+        :param token:
+        :param group_name:
+        :return: The group ID, or None if there is no such group
+        """
+        if self.AZURE_GROUP_INDEX:
+            group_id = self.get_group_index(token).get(group_name.casefold())
+            if group_id is not None:
+                return group_id
+        # Not indexed, or created since the index was built
+        graph_data = self.session.get(  # Use token to call downstream service
+            f"{self.AZURE_API_ENDPOINT}{self.group_lookup_path(group_name)}",
             headers={"Authorization": f"Bearer {token}"},
         ).json()
-        # print("Graph API call result: %s" % json.dumps(graph_data, indent=2))
         try:
-            group_info = json.loads(json.dumps(graph_data, indent=2))["value"][0]
-            members_endpoint = (
-                "transitiveMembers"
-                if self.AZURE_USE_TRANSITIVE_GROUP_MEMBERS
-                else "members"
+            return graph_data["value"][0]["id"]
+        except IndexError:
+            return None
+
+    def group_lookup_path(self, group_name):
+        """
+        Path of the request looking up a group by name, relative to AZURE_API_ENDPOINT
+        :param group_name:
+        :return:
+        """
+        # url encode the group name
+        group_name = requests.utils.quote(group_name.replace("'", "''"))
+        return f"/groups?$filter=displayName eq '{group_name}'&$select=id,displayName"
+
+    def get_group_index(self, token):
+        """
+        Return the IDs of the groups by casefolded display name, listed once per run
+        and re-used by every client. When syncmap.yml has a group_prefix, only the
+        groups whose name starts with one of the prefixes are listed.
+        :param token:
+        :return:
+        :rtype: dict
+        """
+        global _group_index
+        with _group_index_lock:
+            if _group_index is not None:
+                return _group_index
+            start = time.monotonic()
+            prefixes = list(load_syncmap()[1]) or [None]
+            index = {}
+            for prefix in prefixes:
+                for group in self.iter_groups(token, prefix):
+                    index.setdefault(group["displayName"].casefold(), group["id"])
+            LOG.info(
+                "Indexed %d Azure AD groups in %.1fs",
+                len(index),
+                time.monotonic() - start,
             )
-            members = self.get_group_members_pages(
-                token,
-                f'{self.AZURE_API_ENDPOINT}/groups/{group_info["id"]}/{members_endpoint}',
+            _group_index = index
+            return index
+
+    @staticmethod
+    def reset_group_index():
+        """
+        Forget the group index at the start of a run, so groups renamed or recreated
+        since the previous run are not looked up by a stale ID
+        :return:
+        """
+        global _group_index
+        with _group_index_lock:
+            _group_index = None
+
+    def iter_groups(self, token, prefix=None):
+        """
+        Yield the ID and display name of every group, or of the groups whose name
+        starts with ``prefix``
+        :param token:
+        :param prefix:
+        :return:
+        :rtype: generator
+        """
+        url = (
+            f"{self.AZURE_API_ENDPOINT}/groups"
+            f"?$select=id,displayName&$top={GRAPH_PAGE_SIZE}"
+        )
+        if prefix:
+            prefix = requests.utils.quote(prefix.replace("'", "''"))
+            url += f"&$filter=startswith(displayName,'{prefix}')"
+        while url:
+            response = self.session.get(
+                url, headers={"Authorization": f"Bearer {token}"}
             )
-        except IndexError as e:
-            members = []
-        for member in members:
-            if member["@odata.type"] == "#microsoft.graph.group":
-                print("Nested group: ", member["displayName"])
+            response.raise_for_status()
+            body = response.json()
+            yield from body["value"]
+            url = body.get("@odata.nextLink")
+
+    def get_groups_members(self, names):
+        """
+        Get the members of several groups through Microsoft Graph JSON batching.
+        The groups, their pages of members and their members' user info are each
+        requested GRAPH_BATCH_SIZE at a time, and every user is looked up once.
+        :param names: Names of the groups
+        :type names: list
+        :return: Members of each group by name. Groups whose requests failed or were
+                 throttled are left out.
+        :rtype: dict
+        """
+        token = self.get_access_token()
+        groups = {}
+        index = self.get_group_index(token) if self.AZURE_GROUP_INDEX else {}
+        members_endpoint = (
+            "transitiveMembers"
+            if self.AZURE_USE_TRANSITIVE_GROUP_MEMBERS
+            else "members"
+        )
+        pages = {}
+        lookups = {}
+        for name in names:
+            group_id = index.get(name.casefold())
+            if group_id is None:
+                lookups[name] = self.group_lookup_path(name)
             else:
-                user_info = self.get_user_info(token=token, user=member["id"])
-                if self.USERNAME_ATTRIBUTE.startswith("extensionAttribute"):
-                    username = user_info["onPremisesExtensionAttributes"][
-                        self.USERNAME_ATTRIBUTE
+                pages[name] = (
+                    f"/groups/{group_id}/{members_endpoint}?$select={MEMBER_FIELDS}"
+                )
+        # Groups missing from the index are looked up by name
+        responses = self.graph_batch(token, lookups.values())
+        for name, url in lookups.items():
+            response = responses.get(url)
+            if response is None or response["status"] != 200:
+                continue
+            if not response["body"]["value"]:
+                groups[name] = []
+                continue
+            group_id = response["body"]["value"][0]["id"]
+            pages[name] = (
+                f"/groups/{group_id}/{members_endpoint}?$select={MEMBER_FIELDS}"
+            )
+
+        # Follow every group's next links, one batch per page depth
+        members = {name: [] for name in pages}
+        while pages:
+            responses = self.graph_batch(token, pages.values())
+            next_pages = {}
+            for name, url in pages.items():
+                response = responses.get(url)
+                if response is None or response["status"] != 200:
+                    del members[name]
+                    continue
+                for member in response["body"]["value"]:
+                    if member["@odata.type"] == "#microsoft.graph.group":
+                        LOG.debug("Nested group: %s", member["displayName"])
+                    else:
+                        members[name].append(member["id"])
+                next_link = response["body"].get("@odata.nextLink", "")
+                if next_link.startswith(self.AZURE_API_ENDPOINT):
+                    next_pages[name] = next_link[len(self.AZURE_API_ENDPOINT) :]
+                elif next_link:
+                    del members[name]
+            pages = next_pages
+
+        user_ids = {user for ids in members.values() for user in ids}
+        paths = {user: self.user_info_path(user) for user in user_ids}
+        responses = self.graph_batch(token, paths.values())
+        users = {}
+        for user, path in paths.items():
+            response = responses.get(path)
+            if response is not None and response["status"] == 200:
+                users[user] = self.member_info(response["body"])
+            else:
+                users[user] = self.member_info(self.get_user_info(token, user))
+        for name, ids in members.items():
+            groups[name] = [users[user] for user in ids if users[user] is not None]
+        return groups
+
+    def graph_batch(self, token, urls):
+        """
+        Send GET requests through the JSON batching endpoint of Microsoft Graph
+        :param token:
+        :param urls: Request URLs relative to AZURE_API_ENDPOINT
+        :return: The response (status, headers and body) to each URL. URLs whose
+                 batch failed are missing.
+        :rtype: dict
+        """
+        responses = {}
+        for chunk in chunked(set(urls), GRAPH_BATCH_SIZE):
+            batch = self.session.post(
+                f"{self.AZURE_API_ENDPOINT}/$batch",
+                json={
+                    "requests": [
+                        {"id": str(n), "method": "GET", "url": url}
+                        for n, url in enumerate(chunk)
                     ]
-                    if username is None:
-                        continue
-                else:
-                    username = user_info[self.USERNAME_ATTRIBUTE]
-                if self.AZURE_USER_IS_UPN:
-                    if r"\\" in username:
-                        username = username.split(r"\\")[1]
-                    username = username.split("@")[0].split("#")[0].split("_")[0]
-                    username = username.translate(str.maketrans("._!#^~", "------"))
-                    username = username.lower()
-                if "EMU_SHORTCODE" in os.environ:
-                    username = username + "_" + os.environ["EMU_SHORTCODE"]
-                user = {
-                    "username": username,
-                    "email": user_info["mail"],
-                }
-                member_list.append(user)
-        return member_list
+                },
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            if not batch.ok:
+                LOG.error(
+                    "[GraphBatch]: Error sending batch error code %s", batch.status_code
+                )
+                continue
+            for response in batch.json()["responses"]:
+                responses[chunk[int(response["id"])]] = response
+        return responses
+
+    def member_info(self, user_info):
+        """
+        Turn a Graph user into a member
+        :param user_info: The user, as returned by get_user_info
+        :type user_info: dict
+        :return: Dict of username and email, or None if the user has no username
+        :rtype: dict
+        """
+        if self.USERNAME_ATTRIBUTE.startswith("extensionAttribute"):
+            username = user_info["onPremisesExtensionAttributes"][
+                self.USERNAME_ATTRIBUTE
+            ]
+            if username is None:
+                return None
+        else:
+            username = user_info[self.USERNAME_ATTRIBUTE]
+        if rewrite_usernames():
+            if self.AZURE_USER_IS_UPN:
+                if r"\\" in username:
+                    username = username.split(r"\\")[1]
+                username = username.split("@")[0].split("#")[0].split("_")[0]
+                username = username.translate(str.maketrans("._!#^~", "------"))
+                username = username.lower()
+            if "EMU_SHORTCODE" in os.environ:
+                username = username + "_" + os.environ["EMU_SHORTCODE"]
+        return {
+            "username": username,
+            "email": user_info["mail"],
+        }
 
     def get_group_members_pages(self, token=None, url=None):
         """
@@ -129,22 +369,30 @@ class AzureAD:
         :return members:
         :rtype members: dict
         """
-        members_data = requests.get(url, headers={"Authorization": f"Bearer {token}"})
-        if members_data.ok != True:
-            print(
-                f"[GetMembers]: Error getting members data error code {members_data.status_code}"
+        return list(self.iter_group_members_pages(token, url))
+
+    def iter_group_members_pages(self, token=None, url=None):
+        """
+        Yield group members, following the next links one page at a time
+        :param token:
+        :param url:
+        :return members:
+        :rtype members: generator
+        """
+        while url:
+            members_data = self.session.get(
+                url, headers={"Authorization": f"Bearer {token}"}
             )
-            return []
-
-        members_data_content = members_data.json()
-        members = members_data_content["value"]
-        if "@odata.nextLink" in members_data_content:
-            members.extend(
-                self.get_group_members_pages(
-                    token, members_data_content["@odata.nextLink"]
+            if members_data.ok != True:
+                LOG.error(
+                    "[GetMembers]: Error getting members data error code %s",
+                    members_data.status_code,
                 )
-            )
-        return members
+                return
+
+            members_data_content = members_data.json()
+            yield from members_data_content["value"]
+            url = members_data_content.get("@odata.nextLink")
 
     def get_user_info(self, token=None, user=None):
         """
@@ -155,12 +403,18 @@ class AzureAD:
         :rtype user_info: dict
         """
         token = self.get_access_token() if not token else token
+        return self.session.get(  # Use token to call downstream service
+            f"{self.AZURE_API_ENDPOINT}{self.user_info_path(user)}",
+            headers={"Authorization": f"Bearer {token}"},
+        ).json()
+
+    def user_info_path(self, user):
+        """
+        Path of the user info request of a user, relative to AZURE_API_ENDPOINT
+        :param user:
+        :return:
+        """
         attribute = self.USERNAME_ATTRIBUTE
         if self.USERNAME_ATTRIBUTE.startswith("extensionAttribute"):
             attribute = "onPremisesExtensionAttributes"
-        graph_data = requests.get(  # Use token to call downstream service
-            f"{self.AZURE_API_ENDPOINT}/users/{user}?$select=id,mail,{attribute}",
-            headers={"Authorization": f"Bearer {token}"},
-        ).json()
-        user_info = json.loads(json.dumps(graph_data, indent=2))
-        return user_info
+        return f"/users/{user}?$select=id,mail,{attribute}"
@@ -0,0 +1,37 @@
+"""
+Helpers for reading settings from the environment
+"""
+
+
+def strtobool(value):
+    """
+    Convert a string representation of truth to 1 or 0, like the distutils function
+    of the same name, without importing distutils
+    :param value: y, yes, t, true, on and 1 are true, n, no, f, false, off and 0 false
+    :return:
+    :rtype: int
+    """
+    value = value.lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return 1
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return 0
+    raise ValueError(f"invalid truth value {value!r}")
+
+
+def parse_mapping(value):
+    """
+    Parse a setting listing ``key=value`` pairs separated by commas
+    :param value: For instance "acme=AAD,acme-labs=OKTA"
+    :return:
+    :rtype: dict
+    """
+    mapping = {}
+    for pair in (value or "").split(","):
+        if not pair.strip():
+            continue
+        key, sep, item = pair.partition("=")
+        if not sep or not key.strip():
+            raise ValueError(f"invalid key=value pair {pair!r}")
+        mapping[key.strip()] = item.strip()
+    return mapping
@@ -4,15 +4,19 @@ Flask extension for rapid GitHub app development
 import os.path
 import hmac
 import logging
-import distutils
 
 from flask import abort, current_app, jsonify, request, _app_ctx_stack
-from github3 import GitHub, GitHubEnterprise
+
+from .config import strtobool
+from .metrics import metrics_view
+from .status import status_view
 
 LOG = logging.getLogger(__name__)
 
 STATUS_FUNC_CALLED = "HIT"
 STATUS_NO_FUNC_CALLED = "MISS"
+# Response body for events without a registered hook, served without parsing the payload
+MISS_RESPONSE = '{"calls":{},"status":"%s"}\n' % STATUS_NO_FUNC_CALLED
 
 
 class GitHubApp(object):
@@ -29,6 +33,9 @@ class GitHubApp(object):
 
     def __init__(self, app=None):
         self._hook_mappings = {}
+        # Routing table of event -> action -> hooks, where the action None holds the
+        # hooks registered for every action of the event
+        self._routes = {}
         if app is not None:
             self.init_app(app)
 
@@ -39,7 +46,7 @@ class GitHubApp(object):
         if "GHE_HOST" in os.environ:
             app.config["GITHUBAPP_URL"] = "https://{}".format(os.environ["GHE_HOST"])
             app.config["VERIFY_SSL"] = bool(
-                distutils.util.strtobool(os.environ.get("VERIFY_SSL", "false"))
+                strtobool(os.environ.get("VERIFY_SSL", "false"))
             )
         with open(os.environ["PRIVATE_KEY_PATH"], "rb") as key_file:
             app.config["GITHUBAPP_KEY"] = key_file.read()
@@ -94,6 +101,9 @@ class GitHubApp(object):
         def health_check():
             return "Web server is running.", 200
 
+        app.add_url_rule("/metrics", endpoint="metrics", view_func=metrics_view)
+        app.add_url_rule("/status", endpoint="status", view_func=status_view)
+
     @property
     def id(self):
         return current_app.config["GITHUBAPP_ID"]
@@ -119,12 +129,20 @@ class GitHubApp(object):
     @property
     def client(self):
         """Unauthenticated GitHub client"""
+        # Imported on first use, so the web server can start without them
+        from github3 import GitHub, GitHubEnterprise
+
+        from .transport import mount
+
         if current_app.config.get("GITHUBAPP_URL"):
-            return GitHubEnterprise(
+            client = GitHubEnterprise(
                 current_app.config["GITHUBAPP_URL"],
                 verify=current_app.config["VERIFY_SSL"],
             )
-        return GitHub()
+        else:
+            client = GitHub()
+        mount(client.session)
+        return client
 
     @property
     def payload(self):
@@ -211,6 +229,8 @@ class GitHubApp(object):
                 self._hook_mappings[event_action] = [f]
             else:
                 self._hook_mappings[event_action].append(f)
+            event, _, action = event_action.partition(".")
+            self._routes.setdefault(event, {}).setdefault(action or None, []).append(f)
 
             # make sure the function can still be called normally (e.g. if a user wants to pass in their
             # own Context for whatever reason).
@@ -219,21 +239,26 @@ class GitHubApp(object):
         return decorator
 
     def _flask_view_func(self):
-        functions_to_call = []
         calls = {}
 
-        event = request.headers["X-GitHub-Event"]
-        action = request.json.get("action")
+        event = request.headers.get("X-GitHub-Event")
+        if not event:
+            LOG.warning("GitHub event header not found.")
+            abort(400)
 
         self._verify_webhook()
 
-        if event in self._hook_mappings:
-            functions_to_call += self._hook_mappings[event]
+        # Events without a registered hook are answered before the payload is parsed
+        routes = self._routes.get(event)
+        if routes is None:
+            return current_app.response_class(
+                MISS_RESPONSE, mimetype="application/json"
+            )
 
-        if action:
-            event_action = ".".join([event, action])
-            if event_action in self._hook_mappings:
-                functions_to_call += self._hook_mappings[event_action]
+        action = request.json.get("action")
+        functions_to_call = routes.get(None, [])
+        if action and action in routes:
+            functions_to_call = functions_to_call + routes[action]
 
         if functions_to_call:
             for function in functions_to_call:
@@ -244,14 +269,23 @@ class GitHubApp(object):
         return jsonify({"status": status, "calls": calls})
 
     def _verify_webhook(self):
-        hub_signature = "X-HUB-SIGNATURE"
-        if hub_signature not in request.headers:
+        """
+        Check the signature of the hook over the raw request body, preferring the
+        SHA-256 signature over the legacy SHA-1 one
+        """
+        for hub_signature, digestmod in (
+            ("X-Hub-Signature-256", "sha256"),
+            ("X-Hub-Signature", "sha1"),
+        ):
+            if hub_signature in request.headers:
+                break
+        else:
             LOG.warning("Github Hook Signature not found.")
             abort(400)
 
-        signature = request.headers[hub_signature].split("=")[1]
+        signature = request.headers[hub_signature].partition("=")[2]
 
-        mac = hmac.new(self.secret, msg=request.data, digestmod="sha1")
+        mac = hmac.new(self.secret, msg=request.get_data(), digestmod=digestmod)
 
         if not hmac.compare_digest(mac.hexdigest(), signature):
             LOG.warning("GitHub hook signature verification failed.")
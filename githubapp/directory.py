@@ -0,0 +1,56 @@
+"""
+Behaviour shared by the user directory backends
+"""
+
+import logging
+import os
+
+LOG = logging.getLogger(__name__)
+
+
+def rewrite_usernames():
+    """
+    Whether backends rewrite directory usernames into GitHub logins, by cutting
+    them at "@", replacing unsupported characters or appending EMU_SHORTCODE. With
+    IDENTITY_INDEX, usernames are passed through as they are, to be matched against
+    the SAML NameIDs and SCIM usernames of the organization.
+    :return:
+    :rtype: bool
+    """
+    return not os.environ.get("IDENTITY_INDEX")
+
+
+def chunked(items, size):
+    """
+    Split a list into lists of at most ``size`` items
+    :param items:
+    :param size:
+    :return:
+    """
+    items = list(items)
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+class BulkGroupsMixin:
+    """
+    Generic ``get_groups_members`` for backends without a bulk lookup: the groups
+    are looked up one after the other with ``iter_group_members``. Backends with a
+    native bulk mechanism override it.
+    """
+
+    def get_groups_members(self, names):
+        """
+        Get the members of several groups
+        :param names: Names of the groups
+        :type names: list
+        :return: Members of each group by name. Groups that could not be looked up
+                 are left out, so the caller can retry them on their own.
+        :rtype: dict
+        """
+        groups = {}
+        for name in names:
+            try:
+                groups[name] = list(self.iter_group_members(group_name=name))
+            except Exception:
+                LOG.exception("Unable to look up group %s", name)
+        return groups
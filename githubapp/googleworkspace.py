@@ -5,8 +5,12 @@ import json
 import logging
 from google.oauth2 import service_account
 import googleapiclient.discovery
+import googleapiclient.errors
+import googleapiclient.http
 from pprint import pprint
 
+from .directory import chunked
+
 LOG = logging.getLogger(__name__)
 
 SCOPES = [
@@ -14,6 +18,10 @@ SCOPES = [
     "https://www.googleapis.com/auth/admin.directory.group.member.readonly",
     "https://www.googleapis.com/auth/admin.directory.user.readonly",
 ]
+# Requests sent in one batch request
+BATCH_SIZE = 100
+# Parts of the member listings the sync reads
+MEMBER_FIELDS = "nextPageToken,members(id)"
 
 
 class GoogleWorkspaceClient:
@@ -32,6 +40,9 @@ class GoogleWorkspaceClient:
         self.GOOGLE_WORKSPACE_USERNAME_FIELD = os.environ.get(
             "GOOGLE_WORKSPACE_USERNAME_FIELD"
         )
+        self.GOOGLE_WORKSPACE_API_ENDPOINT = os.environ.get(
+            "GOOGLE_WORKSPACE_API_ENDPOINT"
+        )
         self.USER_SYNC_ATTRIBUTE = os.environ["USER_SYNC_ATTRIBUTE"]
 
         credentials = service_account.Credentials.from_service_account_file(
@@ -40,8 +51,14 @@ class GoogleWorkspaceClient:
         delegated_credentials = credentials.with_subject(
             self.GOOGLE_WORKSPACE_ADMIN_EMAIL
         )
+        client_options = None
+        if self.GOOGLE_WORKSPACE_API_ENDPOINT:
+            client_options = {"api_endpoint": self.GOOGLE_WORKSPACE_API_ENDPOINT}
         self.service = googleapiclient.discovery.build(
-            "admin", "directory_v1", credentials=delegated_credentials
+            "admin",
+            "directory_v1",
+            credentials=delegated_credentials,
+            client_options=client_options,
         )
 
     def get_group_members(self, group_name):
@@ -52,24 +69,128 @@ class GoogleWorkspaceClient:
         :return member_list: List of members found in this GOOGLE_WORKSPACE group
         :rtype member_list: list
         """
+        return list(self.iter_group_members(group_name))
 
-        member_list = []
+    def iter_group_members(self, group_name):
+        """
+        Yield the members of the requested group, one page of members at a time
+        :param group_name: The name of the group
+        :type group_name: str
+        :return: Dicts of username and email
+        :rtype: generator
+        """
         # Retrive dict of groups ids, to be able to match group names
         groups = self.get_groups_info()
         group_id = groups.get(group_name)
         if not group_id:
-            return []
+            return
 
         service = self.service.members()
-        request = service.list(groupKey=group_id)
+        request = service.list(groupKey=group_id, fields=MEMBER_FIELDS)
         while request is not None:
             members = request.execute()
             for m in members.get("members", []):
                 user_info = self.get_user_info(m["id"])
                 if user_info.get("email") or user_info.get("username"):
-                    member_list.append(user_info)
+                    yield user_info
             request = service.list_next(request, members)
-        return member_list
+
+    def get_groups_members(self, names):
+        """
+        Get the members of several groups with batch requests: a page of members
+        of every group per batch, then the user info of every member once,
+        BATCH_SIZE requests at a time
+        :param names: Names of the groups
+        :type names: list
+        :return: Members of each group by name. Groups whose member pages failed
+                 are left out.
+        :rtype: dict
+        """
+        groups_info = self.get_groups_info()
+        groups = {}
+        service = self.service.members()
+        pending = {}
+        for name in names:
+            group_id = groups_info.get(name)
+            if group_id:
+                pending[name] = service.list(groupKey=group_id, fields=MEMBER_FIELDS)
+            else:
+                groups[name] = []
+
+        member_ids = {name: [] for name in pending}
+        while pending:
+            responses = self.execute_batch(pending)
+            next_requests = {}
+            for name, request in pending.items():
+                members, error = responses[name]
+                if error is not None:
+                    LOG.warning("Unable to list the members of %s: %s", name, error)
+                    del member_ids[name]
+                    continue
+                member_ids[name].extend(m["id"] for m in members.get("members", []))
+                next_request = service.list_next(request, members)
+                if next_request is not None:
+                    next_requests[name] = next_request
+            pending = next_requests
+
+        user_ids = {user for ids in member_ids.values() for user in ids}
+        requests = {user: self.user_request(user) for user in user_ids}
+        responses = self.execute_batch(
+            {user: request for user, request in requests.items() if request}
+        )
+        users = {}
+        for user in user_ids:
+            response, error = responses.get(user, (None, None))
+            if response is None or error is not None:
+                users[user] = self.get_user_info(user)
+            else:
+                users[user] = self.user_info(response)
+        for name, ids in member_ids.items():
+            groups[name] = [
+                users[user]
+                for user in ids
+                if users[user].get("email") or users[user].get("username")
+            ]
+        return groups
+
+    def execute_batch(self, requests):
+        """
+        Execute requests in batch requests of at most BATCH_SIZE
+        :param requests: Requests by key
+        :type requests: dict
+        :return: The response and exception of each request by key
+        :rtype: dict
+        """
+        results = {}
+        for chunk in chunked(requests, BATCH_SIZE):
+
+            def callback(request_id, response, exception, chunk=chunk):
+                results[chunk[int(request_id)]] = (response, exception)
+
+            batch = self.new_batch_http_request(callback)
+            for n, key in enumerate(chunk):
+                batch.add(requests[key], request_id=str(n))
+            try:
+                batch.execute()
+            except googleapiclient.errors.Error as e:
+                for key in chunk:
+                    results.setdefault(key, (None, e))
+        return results
+
+    def new_batch_http_request(self, callback):
+        """
+        A batch request for the Admin SDK, sent to GOOGLE_WORKSPACE_API_ENDPOINT
+        when it is set
+        :param callback:
+        :return:
+        """
+        if self.GOOGLE_WORKSPACE_API_ENDPOINT:
+            return googleapiclient.http.BatchHttpRequest(
+                callback=callback,
+                batch_uri=self.GOOGLE_WORKSPACE_API_ENDPOINT.rstrip("/")
+                + "/batch/admin/directory_v1",
+            )
+        return self.service.new_batch_http_request(callback=callback)
 
     def get_user_info(self, id):
         """
@@ -79,27 +200,47 @@ class GoogleWorkspaceClient:
         :return:
         :rtype:
         """
+        request = self.user_request(id)
+        if request is None:
+            return {"username": None, "email": None}
+        return self.user_info(request.execute())
 
+    def user_request(self, id):
+        """
+        The request for the user info USER_SYNC_ATTRIBUTE needs
+        :param id:
+        :return: The request, or None if USER_SYNC_ATTRIBUTE is not supported
+        """
         if self.USER_SYNC_ATTRIBUTE == "username":
-            user = (
-                self.service.users()
-                .get(
-                    userKey=id,
-                    projection="custom",
-                    customFieldMask=self.GOOGLE_WORKSPACE_USERNAME_CUSTOM_SCHEMA_NAME,
-                )
-                .execute()
+            return self.service.users().get(
+                userKey=id,
+                projection="custom",
+                customFieldMask=self.GOOGLE_WORKSPACE_USERNAME_CUSTOM_SCHEMA_NAME,
+                fields="suspended,archived,customSchemas",
             )
-            if not user["suspended"] and not user["archived"]:
+        elif self.USER_SYNC_ATTRIBUTE == "email":
+            return self.service.users().get(
+                userKey=id,
+                fields=f"suspended,archived,{self.GOOGLE_WORKSPACE_USER_MAIL_ATTRIBUTE}",
+            )
+        return None
+
+    def user_info(self, user):
+        """
+        Turn a user returned by user_request into a member
+        :param user:
+        :return: Dict of username and email, both None for suspended and archived users
+        :rtype: dict
+        """
+        if not user["suspended"] and not user["archived"]:
+            if self.USER_SYNC_ATTRIBUTE == "username":
                 return {
                     "username": user.get("customSchemas", {})
                     .get(self.GOOGLE_WORKSPACE_USERNAME_CUSTOM_SCHEMA_NAME, {})
                     .get(self.GOOGLE_WORKSPACE_USERNAME_FIELD),
                     "email": None,
                 }
-        elif self.USER_SYNC_ATTRIBUTE == "email":
-            user = self.service.users().get(userKey=id).execute()
-            if not user["suspended"] and not user["archived"]:
+            elif self.USER_SYNC_ATTRIBUTE == "email":
                 return {
                     "username": None,
                     "email": user[self.GOOGLE_WORKSPACE_USER_MAIL_ATTRIBUTE],
@@ -113,7 +254,9 @@ class GoogleWorkspaceClient:
 
         groups_dict = dict()
         service = self.service.groups()
-        request = service.list(customer="my_customer")
+        request = service.list(
+            customer="my_customer", fields="nextPageToken,groups(id,name)"
+        )
         while request is not None:
             groups = request.execute()
             for g in groups.get("groups", []):
@@ -0,0 +1,198 @@
+"""
+Index of the SAML or SCIM external identities of an organization, joining directory
+users to GitHub logins by NameID, username or email instead of rebuilding logins
+from directory attributes
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+QUERY = """
+query($org: String!, $first: Int!, $after: String) {
+  organization(login: $org) {
+    samlIdentityProvider {
+      externalIdentities(first: $first, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        edges {
+          node {
+            samlIdentity { nameId username emails { value } }
+            scimIdentity { username emails { value } }
+            user { login }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+class IdentityIndex:
+    """
+    GitHub logins of an organization's members, by the casefolded NameID, username
+    and emails of their external identity
+    """
+
+    def __init__(self, logins, built_at=None):
+        self.by_key = logins
+        self.built_at = built_at or time.time()
+
+    @classmethod
+    def fetch(cls, client, org, source="saml", page_size=100):
+        """
+        Read the external identities of an organization, ``page_size`` at a time
+        :param client: github3 client authenticated as the organization's installation
+        :param org: Organization login
+        :param source: "saml" to index SAML identities, "scim" for SCIM identities
+        :param page_size: At most 100
+        :return:
+        :rtype: IdentityIndex
+        """
+        url = graphql_url(client)
+        logins = {}
+        after = None
+        while True:
+            response = client.session.post(
+                url,
+                json={
+                    "query": QUERY,
+                    "variables": {"org": org, "first": page_size, "after": after},
+                },
+            )
+            response.raise_for_status()
+            body = response.json()
+            if body.get("errors"):
+                raise ValueError(
+                    f"Unable to read the external identities of {org}: "
+                    + "; ".join(e.get("message", "") for e in body["errors"])
+                )
+            provider = body["data"]["organization"]["samlIdentityProvider"]
+            if provider is None:
+                raise ValueError(f"{org} has no SAML identity provider")
+            identities = provider["externalIdentities"]
+            for edge in identities["edges"]:
+                node = edge["node"]
+                if not node.get("user"):
+                    # Identity not linked to a GitHub account yet
+                    continue
+                for key in identity_keys(node.get(f"{source}Identity")):
+                    logins.setdefault(key, node["user"]["login"].casefold())
+            if not identities["pageInfo"]["hasNextPage"]:
+                return cls(logins)
+            after = identities["pageInfo"]["endCursor"]
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["logins"], data["built_at"])
+
+    def save(self, path):
+        """
+        Write the index to ``path``, replacing it in one step
+        :param path:
+        :return:
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "w") as f:
+            json.dump({"built_at": self.built_at, "logins": self.by_key}, f)
+        os.replace(temp, path)
+
+    def logins(self, keys):
+        """
+        Join directory users to GitHub logins
+        :param keys: Casefolded directory attributes, as returned by member_keys
+        :return: The logins found, and the keys without an identity
+        :rtype: tuple
+        """
+        found = set()
+        missing = []
+        for key in keys:
+            login = self.by_key.get(key)
+            if login is None:
+                missing.append(key)
+            else:
+                found.add(login)
+        return frozenset(found), sorted(missing)
+
+    def __len__(self):
+        return len(set(self.by_key.values()))
+
+
+def identity_keys(identity):
+    """
+    The casefolded NameID, username and emails of a SAML or SCIM identity
+    :param identity:
+    :return:
+    :rtype: set
+    """
+    if not identity:
+        return set()
+    keys = {identity.get("nameId"), identity.get("username")}
+    keys.update(email.get("value") for email in identity.get("emails") or ())
+    return {key.casefold() for key in keys if key}
+
+
+def graphql_url(client):
+    """
+    The GraphQL endpoint of the GitHub instance a github3 client talks to
+    :param client:
+    :return:
+    """
+    base = client.session.base_url.rstrip("/")
+    if base.endswith("/api/v3"):
+        # GitHub Enterprise Server
+        return base[: -len("/v3")] + "/graphql"
+    return base + "/graphql"
+
+
+_indexes = {}
+_locks = {}
+_lock = threading.Lock()
+
+
+def get_identity_index(client, org):
+    """
+    Return the identity index of an organization, built once and re-used for
+    IDENTITY_CACHE_TTL seconds. With IDENTITY_CACHE_DIR, the index is kept on disk
+    so a restart doesn't have to read it again.
+    :param client: github3 client authenticated as the organization's installation
+    :param org: Organization login
+    :return: The index, or None if IDENTITY_INDEX is not set
+    :rtype: IdentityIndex
+    """
+    source = os.environ.get("IDENTITY_INDEX", "").lower()
+    if not source:
+        return None
+    ttl = float(os.environ.get("IDENTITY_CACHE_TTL", 3600))
+    cache_dir = os.environ.get("IDENTITY_CACHE_DIR")
+    with _lock:
+        lock = _locks.setdefault(org, threading.Lock())
+    # Teams of the same organization wait for the one building the index
+    with lock:
+        index = _indexes.get(org)
+        if index is not None and time.time() - index.built_at < ttl:
+            return index
+        path = os.path.join(cache_dir, f"{source}-{org}.json") if cache_dir else None
+        if path and os.path.exists(path):
+            index = IdentityIndex.load(path)
+        if index is None or time.time() - index.built_at >= ttl:
+            start = time.monotonic()
+            index = IdentityIndex.fetch(client, org, source)
+            LOG.info(
+                "Indexed %d %s identities of %s in %.1fs",
+                len(index),
+                source.upper(),
+                org,
+                time.monotonic() - start,
+            )
+            if path:
+                index.save(path)
+        _indexes[org] = index
+        return index
@@ -5,11 +5,12 @@ import logging
 import re
 from keycloak import KeycloakAdmin
 
+from .directory import BulkGroupsMixin, rewrite_usernames
 
 LOG = logging.getLogger(__name__)
 
 
-class Keycloak:
+class Keycloak(BulkGroupsMixin):
     def __init__(self):
         if not os.environ.get("KEYCLOAK_SERVER_URL", None):
             raise Exception("KEYCLOAK_SERVER_URL not defined")
@@ -46,7 +47,18 @@ class Keycloak:
         :return member_list: A list of dictionaries containing usernames and emails
         :rtype member_list: list
         """
-        member_list = []
+        return list(self.iter_group_members(group_name=group_name))
+
+    def iter_group_members(self, group_name: str = None):
+        """
+        Yield the users that are in a group in Keycloak, one page at a time
+
+        :param group_name: Group name to look up
+        :type group_name: str
+
+        :return: Dictionaries containing usernames and emails
+        :rtype: generator
+        """
 
         def get_group_id(client: KeycloakAdmin = None):
             """
@@ -70,7 +82,7 @@ class Keycloak:
             :param client: A KeycloakAdmin client
             :param group_id: The group's UUID in Keycloak
 
-            :return: A list containing all users in the group
+            :return: The users in the group
             """
             # Keycloak paginates the response when grabbing the list of members
             # The response doesn't contain any info on the next page either
@@ -78,20 +90,18 @@ class Keycloak:
             # list is smaller than the provided page size
             page_start = 0
             page_size = 100
-            members = []
             group_members = client.get_group_members(
                 group_id=group_id,
                 query={"first": page_start, "max": page_size}
             )
-            members += group_members
+            yield from group_members
             while len(group_members) == page_size:
                 page_start += page_size
                 group_members = client.get_group_members(
                     group_id=group_id,
                     query={"first": page_start, "max": page_size}
                 )
-                members += group_members
-            return members
+                yield from group_members
 
         def get_github_username(client: KeycloakAdmin = None, user_id: str = None):
             """
@@ -123,15 +133,13 @@ class Keycloak:
                     username = user["username"]
                     if not username:
                         raise Exception("Unable to find username in profile")
-                    if "EMU_SHORTCODE" in os.environ:
+                    if "EMU_SHORTCODE" in os.environ and rewrite_usernames():
                         username = username + "_" + os.environ["EMU_SHORTCODE"]
-                member_list.append(
-                    {
-                        "username": username,
-                        "email": user["email"]
-                    }
-                )
+                email = user["email"]
             except Exception as e:
-                user_info = f'{user["username"]} ({user["email"]})'
-                print(f"User {user_info}: {e}")
-        return member_list
+                LOG.warning("User %s (%s): %s", user["username"], user["email"], e)
+                continue
+            yield {
+                "username": username,
+                "email": email
+            }
@@ -1,17 +1,142 @@
+import atexit
 import os
-import traceback
-import sys
+import threading
+import time
 import json
 import logging
 import ssl
-from ldap3 import Server, Connection, Tls, ALL
+from ldap3 import Server, Connection, Tls, ALL, BASE
 from ldap3.utils.conv import escape_filter_chars
+from ldap3.utils.dn import parse_dn
+
+from .config import strtobool
+from .directory import BulkGroupsMixin, rewrite_usernames
 from pprint import pprint
 
 LOG = logging.getLogger(__name__)
 
+# Attributes that can be used to track changes in the directory
+CHANGE_ATTRIBUTES = ["uSNChanged", "modifyTimestamp", "entryCSN"]
+
+
+class MembershipCache:
+    """
+    Local, on-disk cache of resolved group memberships for the incremental mode.
+
+    Groups are stored with their DN and their raw member values so that a change
+    to either the group entry or one of its member entries invalidates it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.attribute = None
+        self.highwater = None
+        self.last_poll = 0
+        self.last_save = 0
+        self.groups = {}
+        self.load()
+
+    def load(self):
+        """
+        Load the cache from disk, starting empty if it is missing or unreadable
+        :return:
+        """
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.attribute = data.get("attribute")
+            self.highwater = data.get("highwater")
+            self.groups = data.get("groups", {})
+        except (OSError, ValueError):
+            LOG.exception("Unable to read the membership cache %s", self.path)
+            self.groups = {}
+
+    def save(self):
+        """
+        Atomically write the cache to disk
+        :return:
+        """
+        with self.lock:
+            data = {
+                "attribute": self.attribute,
+                "highwater": self.highwater,
+                "groups": self.groups,
+            }
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+            self.last_save = time.time()
+
+    def get(self, group_name):
+        with self.lock:
+            group = self.groups.get(group_name)
+            return None if group is None else group["members"]
+
+    def put(self, group_name, dn, raw_members, members):
+        with self.lock:
+            self.groups[group_name] = {
+                "dn": dn.casefold(),
+                "raw": [m.casefold() for m in raw_members],
+                "members": members,
+            }
+            # Throttle writes; the final state is flushed at exit
+            if time.time() - self.last_save > 30:
+                self.save()
+
+    def invalidate(self, group_dns, member_keys):
+        """
+        Drop every cached group whose entry or whose members have changed
+        :param group_dns: DNs of group entries that changed
+        :param member_keys: DNs and user attribute values of user entries that changed
+        :return: Number of groups dropped
+        :rtype: int
+        """
+        with self.lock:
+            stale = [
+                name
+                for name, group in self.groups.items()
+                if group["dn"] in group_dns or not member_keys.isdisjoint(group["raw"])
+            ]
+            for name in stale:
+                del self.groups[name]
+            return len(stale)
+
+    def reset(self, attribute):
+        with self.lock:
+            self.attribute = attribute
+            self.highwater = None
+            self.groups = {}
 
-class LDAPClient:
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_membership_cache(path):
+    """
+    Return the process-wide membership cache stored at ``path``
+    :param path:
+    :return:
+    """
+    with _caches_lock:
+        if path not in _caches:
+            cache = MembershipCache(path)
+            atexit.register(cache.save)
+            _caches[path] = cache
+        return _caches[path]
+
+
+def _first(value):
+    if isinstance(value, (list, tuple)):
+        return value[0] if value else None
+    return value
+
+
+class LDAPClient(BulkGroupsMixin):
     def __init__(self):
         # Read settings from the config file and store them as constants
         self.LDAP_SERVER_HOST = os.environ["LDAP_SERVER_HOST"]
@@ -43,7 +168,21 @@ class LDAPClient:
 
         self.USER_SYNC_ATTRIBUTE = os.environ["USER_SYNC_ATTRIBUTE"]
 
-        self.LDAP_USE_SSL = bool(os.environ("LDAP_USE_SSL", False))
+        self.LDAP_INCREMENTAL = strtobool(os.environ.get("LDAP_INCREMENTAL", "False"))
+        self.LDAP_CHANGE_ATTRIBUTE = os.environ.get(
+            "LDAP_CHANGE_ATTRIBUTE", "uSNChanged"
+        )
+        if self.LDAP_CHANGE_ATTRIBUTE not in CHANGE_ATTRIBUTES:
+            raise Exception(
+                f"LDAP_CHANGE_ATTRIBUTE valid options are {CHANGE_ATTRIBUTES}"
+            )
+        self.LDAP_CACHE_FILE = os.environ.get("LDAP_CACHE_FILE", ".ldap_cache.json")
+        self.LDAP_CHANGE_POLL_INTERVAL = int(
+            os.environ.get("LDAP_CHANGE_POLL_INTERVAL", 300)
+        )
+        self.LDAP_CHANGE_CLOCK_SKEW = int(os.environ.get("LDAP_CHANGE_CLOCK_SKEW", 300))
+
+        self.LDAP_USE_SSL = strtobool(os.environ.get("LDAP_USE_SSL", "False"))
         if self.LDAP_USE_SSL:
             self.LDAP_SSL_PRIVATE_KEY = os.environ.get("LDAP_SSL_PRIVATE_KEY")
             self.LDAP_SSL_CERTIFICATE = os.environ.get("LDAP_SSL_CERTIFICATE")
@@ -76,8 +215,8 @@ class LDAPClient:
 
         self.srv = Server(
             host=self.LDAP_SERVER_HOST,
-            port=self.LDAP_SERVER_HOST,
-            use_ssl=self.USE_SSL,
+            port=int(self.LDAP_SERVER_PORT),
+            use_ssl=self.LDAP_USE_SSL,
             tls=self.tls,
         )
         self.conn = Connection(
@@ -96,67 +235,281 @@ class LDAPClient:
         :return member_list: List of members found in this LDAP group
         :rtype member_list: list
         """
+        return list(self.iter_group_members(group_name))
+
+    def iter_group_members(self, group_name):
+        """
+        Yield the members of the requested group in LDAP/Active Directory as
+        they are resolved
+        :param group_name: The name of the group
+        :type group_name: str
+        :return: Dicts of username and email
+        :rtype: generator
+        """
+        if not self.LDAP_INCREMENTAL:
+            for _, raw_members in self.search_groups(self.group_filter(group_name)):
+                yield from self.resolve_members(raw_members)
+            return
+
+        cache = get_membership_cache(self.LDAP_CACHE_FILE)
+        self.refresh_changes(cache)
+        member_list = cache.get(group_name)
+        if member_list is None:
+            member_list, group_dn, raw_members = self.fetch_group_members(group_name)
+            if group_dn is not None:
+                cache.put(group_name, group_dn, raw_members, member_list)
+        yield from member_list
+
+    def fetch_group_members(self, group_name):
+        """
+        Query the directory for the members of a group
+        :param group_name: The name of the group
+        :type group_name: str
+        :return: The resolved members, the group DN and the raw member values
+        :rtype: tuple
+        """
         member_list = []
+        group_dn = None
+        raw_members = []
+        for group_dn, members in self.search_groups(self.group_filter(group_name)):
+            raw_members.extend(members)
+            member_list.extend(self.resolve_members(members))
+        return member_list, group_dn, raw_members
+
+    def get_groups_members(self, names):
+        """
+        Get the members of several groups, finding all the group entries with a
+        single search for any of the names
+        :param names: Names of the groups
+        :type names: list
+        :return: Members of each group by name. Groups that were not found, or whose
+                 entry can't be matched to a name by its RDN, are left out.
+        :rtype: dict
+        """
+        groups = {}
+        missing = list(names)
+        if self.LDAP_INCREMENTAL:
+            cache = get_membership_cache(self.LDAP_CACHE_FILE)
+            self.refresh_changes(cache)
+            missing = []
+            for name in names:
+                member_list = cache.get(name)
+                if member_list is None:
+                    missing.append(name)
+                else:
+                    groups[name] = member_list
+        if not missing:
+            return groups
+
+        by_rdn = {name.casefold(): name for name in missing}
+        search_filter = "(|{})".format("".join(map(self.group_filter, missing)))
+        found = {}
+        for group_dn, raw_members in self.search_groups(search_filter):
+            name = by_rdn.get(str(parse_dn(group_dn)[0][1]).casefold())
+            if name is None:
+                continue
+            # Like fetch_group_members, keep the last DN if several entries match
+            entry = found.setdefault(name, {"raw": []})
+            entry["dn"] = group_dn
+            entry["raw"].extend(raw_members)
+            groups.setdefault(name, []).extend(self.resolve_members(raw_members))
+        if self.LDAP_INCREMENTAL:
+            for name, entry in found.items():
+                cache.put(name, entry["dn"], entry["raw"], groups[name])
+        return groups
+
+    def group_filter(self, group_name):
+        """
+        The search filter matching a group by name
+        :param group_name:
+        :return:
+        """
+        return self.LDAP_GROUP_FILTER.replace("{group_name}", group_name)
+
+    def search_groups(self, search_filter):
+        """
+        Search the directory for groups
+        :param search_filter: Filter matching the group entries
+        :type search_filter: str
+        :return: The DN and raw member values of each matching group entry
+        :rtype: generator
+        """
         entries = self.conn.extend.standard.paged_search(
             search_base=self.LDAP_BASE_DN,
-            search_filter=self.LDAP_GROUP_FILTER.replace("{group_name}", group_name),
+            search_filter=search_filter,
             attributes=[self.LDAP_GROUP_MEMBER_ATTRIBUTE],
             paged_size=self.LDAP_PAGE_SIZE,
+            generator=True,
         )
         for entry in entries:
             if entry["type"] == "searchResEntry":
-                for member in entry["attributes"][self.LDAP_GROUP_MEMBER_ATTRIBUTE]:
-                    if self.LDAP_GROUP_BASE_DN in member:
-                        pass
-                    # print("Nested groups are not yet supported.")
-                    # print("This feature is currently under development.")
-                    # print("{} was not processed.".format(member))
-                    # print("Unable to look up '{}'".format(member))
-                    # print(e)
-                    else:
-                        try:
-                            member_dn = self.get_user_info(user=member)
-                            # pprint(member_dn)
-                            if (
-                                member_dn
-                                and member_dn["attributes"]
-                                and member_dn["attributes"][self.LDAP_USER_ATTRIBUTE]
-                            ):
-                                username = str(
-                                    member_dn["attributes"][self.LDAP_USER_ATTRIBUTE][0]
-                                ).casefold()
-                                if (
-                                    self.USER_SYNC_ATTRIBUTE == "mail"
-                                    and self.LDAP_USER_MAIL_ATTRIBUTE
-                                    not in member_dn["attributes"]
-                                ):
-                                    raise Exception(
-                                        f"{self.USER_SYNC_ATTRIBUTE} not found"
-                                    )
-                                elif (
-                                    self.LDAP_USER_MAIL_ATTRIBUTE
-                                    in member_dn["attributes"]
-                                ):
-                                    email = str(
-                                        member_dn["attributes"][
-                                            self.LDAP_USER_MAIL_ATTRIBUTE
-                                        ][0]
-                                    ).casefold()
-                                else:
-                                    email = None
-                                if "EMU_SHORTCODE" in os.environ:
-                                    username = (
-                                        username + "_" + os.environ["EMU_SHORTCODE"]
-                                    )
-                                user_info = {"username": username, "email": email}
-                                member_list.append(user_info)
-                        except Exception as e:
-                            traceback.print_exc(file=sys.stderr)
-        return member_list
+                yield entry["dn"], entry["attributes"][self.LDAP_GROUP_MEMBER_ATTRIBUTE]
+
+    def resolve_members(self, raw_members):
+        """
+        Look up the users referenced by the member values of a group
+        :param raw_members: DNs or usernames from the group's member attribute
+        :type raw_members: list
+        :return: Dicts of username and email
+        :rtype: generator
+        """
+        for member in raw_members:
+            if self.LDAP_GROUP_BASE_DN in member:
+                pass
+            # print("Nested groups are not yet supported.")
+            # print("This feature is currently under development.")
+            # print("{} was not processed.".format(member))
+            # print("Unable to look up '{}'".format(member))
+            # print(e)
+            else:
+                try:
+                    member_dn = self.get_user_info(user=member)
+                    # pprint(member_dn)
+                    if (
+                        member_dn
+                        and member_dn["attributes"]
+                        and member_dn["attributes"][self.LDAP_USER_ATTRIBUTE]
+                    ):
+                        username = str(
+                            member_dn["attributes"][self.LDAP_USER_ATTRIBUTE][0]
+                        ).casefold()
+                        # Requested attributes the entry lacks come back empty
+                        if self.USER_SYNC_ATTRIBUTE == "mail" and not member_dn[
+                            "attributes"
+                        ].get(self.LDAP_USER_MAIL_ATTRIBUTE):
+                            raise Exception(f"{self.USER_SYNC_ATTRIBUTE} not found")
+                        elif member_dn["attributes"].get(self.LDAP_USER_MAIL_ATTRIBUTE):
+                            email = str(
+                                member_dn["attributes"][self.LDAP_USER_MAIL_ATTRIBUTE][
+                                    0
+                                ]
+                            ).casefold()
+                        else:
+                            email = None
+                        if "EMU_SHORTCODE" in os.environ and rewrite_usernames():
+                            username = username + "_" + os.environ["EMU_SHORTCODE"]
+                        yield {"username": username, "email": email}
+                except Exception as e:
+                    LOG.exception("Unable to look up member %s", member)
+
+    def refresh_changes(self, cache):
+        """
+        Poll the directory for group and user entries that changed since the last
+        high-water mark and drop the affected groups from the membership cache.
+        Polls at most once every LDAP_CHANGE_POLL_INTERVAL seconds per process.
+        :param cache: The membership cache to update
+        :type cache: MembershipCache
+        :return:
+        """
+        with cache.lock:
+            if time.time() - cache.last_poll < self.LDAP_CHANGE_POLL_INTERVAL:
+                return
+            # Read the new mark before looking for changes, so anything that
+            # changes while we run is picked up by the next poll
+            highwater = self.get_highwater()
+            if cache.attribute != self.LDAP_CHANGE_ATTRIBUTE or not cache.highwater:
+                cache.reset(self.LDAP_CHANGE_ATTRIBUTE)
+                LOG.info("LDAP incremental: no usable high-water mark, full refresh")
+            else:
+                group_dns, user_dns, member_keys = self.get_changed_entries(
+                    cache.highwater
+                )
+                dropped = cache.invalidate(group_dns, member_keys)
+                LOG.info(
+                    "LDAP incremental: %d groups and %d users changed since %s, "
+                    "%d cached groups invalidated",
+                    len(group_dns),
+                    len(user_dns),
+                    cache.highwater,
+                    dropped,
+                )
+            cache.highwater = highwater
+            cache.last_poll = time.time()
+            cache.save()
+
+    def get_highwater(self):
+        """
+        Read the server's current position for LDAP_CHANGE_ATTRIBUTE
+        :return: The high-water mark as a string
+        :rtype: str
+        """
+        if self.LDAP_CHANGE_ATTRIBUTE == "uSNChanged":
+            # Active Directory: USNs are local to each domain controller, so
+            # LDAP_SERVER_HOST must always resolve to the same DC
+            self.conn.search(
+                search_base="",
+                search_filter="(objectClass=*)",
+                search_scope=BASE,
+                attributes=["highestCommittedUSN"],
+            )
+            return str(
+                _first(self.conn.response[0]["attributes"]["highestCommittedUSN"])
+            )
+        elif self.LDAP_CHANGE_ATTRIBUTE == "entryCSN":
+            # OpenLDAP: the suffix entry carries the latest CSN per server ID
+            self.conn.search(
+                search_base=self.LDAP_BASE_DN,
+                search_filter="(objectClass=*)",
+                search_scope=BASE,
+                attributes=["contextCSN"],
+            )
+            csns = self.conn.response[0]["attributes"]["contextCSN"]
+            if not isinstance(csns, (list, tuple)):
+                csns = [csns]
+            return max(str(csn) for csn in csns)
+        else:
+            # modifyTimestamp has no server-side counter, so fall back on our
+            # clock minus an allowance for skew between us and the server
+            return time.strftime(
+                "%Y%m%d%H%M%SZ",
+                time.gmtime(time.time() - self.LDAP_CHANGE_CLOCK_SKEW),
+            )
+
+    def get_changed_entries(self, highwater):
+        """
+        Find group and user entries changed at or after the high-water mark
+        :param highwater:
+        :type highwater: str
+        :return: Changed group DNs, changed user DNs, and the keys groups may use
+                 to reference those users (DNs and user attribute values)
+        :rtype: tuple
+        """
+        change_filter = (
+            f"({self.LDAP_CHANGE_ATTRIBUTE}>={escape_filter_chars(highwater)})"
+        )
+        group_filter = self.LDAP_GROUP_FILTER.replace("{group_name}", "*")
+        group_dns = set()
+        for entry in self.conn.extend.standard.paged_search(
+            search_base=self.LDAP_BASE_DN,
+            search_filter=f"(&{group_filter}{change_filter})",
+            attributes=[self.LDAP_CHANGE_ATTRIBUTE],
+            paged_size=self.LDAP_PAGE_SIZE,
+        ):
+            if entry["type"] == "searchResEntry":
+                group_dns.add(entry["dn"].casefold())
+
+        user_filter = self.LDAP_USER_FILTER.replace("{username}", "*")
+        user_dns = set()
+        member_keys = set()
+        for entry in self.conn.extend.standard.paged_search(
+            search_base=self.LDAP_USER_BASE_DN,
+            search_filter=f"(&{user_filter}{change_filter})",
+            attributes=[self.LDAP_USER_ATTRIBUTE],
+            paged_size=self.LDAP_PAGE_SIZE,
+        ):
+            if entry["type"] == "searchResEntry":
+                # Groups reference members either by DN (member) or by
+                # username (memberUid), so track both
+                user_dns.add(entry["dn"].casefold())
+                member_keys.add(entry["dn"].casefold())
+                username = _first(entry["attributes"].get(self.LDAP_USER_ATTRIBUTE))
+                if username:
+                    member_keys.add(str(username).casefold())
+        return group_dns, user_dns, member_keys
 
     def get_user_info(self, user=None):
         """
-        Look up user info from LDAP
+        Look up the username and mail attributes of a user in LDAP
         :param user:
         :type user:
         :return:
@@ -173,12 +526,18 @@ class LDAPClient:
                     search_filter=self.LDAP_USER_FILTER.replace(
                         "{username}", escape_filter_chars(user)
                     ),
-                    attributes=["*"],
+                    attributes=[
+                        self.LDAP_USER_ATTRIBUTE,
+                        self.LDAP_USER_MAIL_ATTRIBUTE,
+                    ],
                 )
                 if len(self.conn.entries) > 0:
-                    data = json.loads(self.conn.entries[0].entry_to_json())
-                    return data
+                    entry = self.conn.entries[0]
+                    return {
+                        "dn": entry.entry_dn,
+                        "attributes": entry.entry_attributes_as_dict,
+                    }
             except Exception as e:
-                traceback.print_exc(file=sys.stderr)
+                LOG.exception("Unable to look up user %s", user)
         except Exception as e:
-            traceback.print_exc(file=sys.stderr)
+            LOG.exception("Unable to look up user %s", user)
@@ -0,0 +1,161 @@
+"""
+Logging of the sync. Records are handed to a queue and written by a background
+thread, so a slow log consumer doesn't stall the sync workers. Each record carries
+the organization, team and phase being synced on the thread that logged it.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+from . import tracing
+
+# Attributes every LogRecord has; any other attribute was passed with ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+_CONTEXT = ("org", "team", "phase")
+
+_lock = threading.Lock()
+_queue = None
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    """
+    Add the org, team and phase of the team synced on the current thread to records
+    that don't already have them
+    """
+
+    def filter(self, record):
+        trace = tracing.current()
+        if not hasattr(record, "org"):
+            record.org = trace.org if trace else None
+        if not hasattr(record, "team"):
+            record.team = trace.team if trace else None
+        if not hasattr(record, "phase"):
+            record.phase = tracing.current_phase()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Format records as text, prefixed with the team they are about
+    """
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(context)s%(message)s")
+
+    def format(self, record):
+        team = getattr(record, "team", None)
+        org = getattr(record, "org", None)
+        context = f"{org}/{team}" if team and org else team or org or ""
+        if getattr(record, "phase", None):
+            context += f" ({record.phase})"
+        record.context = f"[{context}] " if context else ""
+        return super().format(record)
+
+
+class SyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler leaving the formatting of records to the listener's thread. Only
+    the message is resolved on the logging thread, since its arguments may change
+    once the call returns.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(*names, level=None, fmt=None, stream=None):
+    """
+    Send the records of the root logger through a queue to ``stream``. Only the
+    first call has an effect.
+    :param names: Loggers logging at ``level`` besides "githubapp"; other loggers
+                  keep their level, or the root logger's WARNING
+    :param level: Default: LOG_LEVEL or INFO
+    :param fmt: "json" or "text". Default: LOG_FORMAT or json
+    :param stream: Default: the current sys.stdout, at the time of each record
+    :return:
+    """
+    global _queue, _listener
+    with _lock:
+        if _listener is not None:
+            return
+        level = (level or os.environ.get("LOG_LEVEL", "INFO")).upper()
+        fmt = (fmt or os.environ.get("LOG_FORMAT", "json")).lower()
+        if fmt not in ("json", "text"):
+            raise ValueError(f"LOG_FORMAT must be json or text, not {fmt}")
+
+        output = _StdoutHandler() if stream is None else logging.StreamHandler(stream)
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+        _queue = queue.Queue()
+        handler = SyncQueueHandler(_queue)
+        handler.addFilter(ContextFilter())
+        root = logging.getLogger()
+        root.addHandler(handler)
+        if root.level == logging.NOTSET or root.level > logging.WARNING:
+            root.setLevel(logging.WARNING)
+        for name in ("githubapp", *names):
+            logging.getLogger(name).setLevel(level)
+        _listener = logging.handlers.QueueListener(_queue, output)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def flush():
+    """
+    Wait until every record logged so far has been written
+    :return:
+    """
+    if _queue is not None:
+        _queue.join()
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """
+    StreamHandler writing to whatever sys.stdout is when a record is written
+    """
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
@@ -0,0 +1,236 @@
+"""
+Prometheus metrics for the sync, served on /metrics
+"""
+
+import contextlib
+import functools
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from . import tracing
+from .ratelimit import get_budget
+
+PHASE_SECONDS = Histogram(
+    "team_sync_phase_seconds",
+    "Time spent in each phase of a team sync",
+    ["phase"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+DIRECTORY_CALLS = Counter(
+    "team_sync_directory_api_calls_total",
+    "Group lookups made against the user directory",
+    ["backend", "installation"],
+)
+GITHUB_CALLS = Counter(
+    "team_sync_github_api_calls_total",
+    "Requests made to the GitHub API",
+    ["installation"],
+)
+GITHUB_RATE_LIMIT_REMAINING = Gauge(
+    "team_sync_github_rate_limit_remaining",
+    "GitHub API requests left in the current rate-limit window",
+    ["installation"],
+)
+TEAMS = Counter(
+    "team_sync_teams_total",
+    "Teams processed, by outcome (synced, skipped, failed, carried_over or deferred)",
+    ["outcome"],
+)
+RUNS = Counter(
+    "team_sync_runs_total",
+    "Full syncs, by outcome",
+    ["outcome"],
+)
+RUN_DURATION = Gauge(
+    "team_sync_last_run_duration_seconds",
+    "Duration of the last full sync",
+)
+RUN_RECEIVED_BYTES = Gauge(
+    "team_sync_last_run_received_bytes",
+    "Response bytes received through the shared HTTP transport during the last "
+    "full sync",
+)
+RUN_IN_PROGRESS = Gauge(
+    "team_sync_run_in_progress",
+    "Whether a full sync is running",
+)
+
+# Pipeline of the full sync in progress, if any, for the queue depth gauge
+_pipeline = None
+
+
+class QueueDepthCollector:
+    """
+    Reports the number of teams waiting in front of each pipeline stage at scrape time
+    """
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            "team_sync_queue_depth",
+            "Teams waiting in front of each stage of the running full sync",
+            labels=["stage"],
+        )
+        pipeline = _pipeline
+        if pipeline is not None:
+            for stage, depth in pipeline.depths().items():
+                family.add_metric([stage], depth)
+        yield family
+
+
+REGISTRY.register(QueueDepthCollector())
+
+
+class ConnectionPoolCollector:
+    """
+    Reports the requests sent, connections opened and bytes received through the
+    shared HTTP transport at scrape time
+    """
+
+    def collect(self):
+        # Imported here so requests isn't imported before the first scrape
+        from .transport import pool_stats
+
+        requests = CounterMetricFamily(
+            "team_sync_http_requests",
+            "Requests sent through the shared HTTP connection pools",
+            labels=["host"],
+        )
+        connections = CounterMetricFamily(
+            "team_sync_http_connections",
+            "Connections opened by the shared HTTP connection pools",
+            labels=["host"],
+        )
+        received = CounterMetricFamily(
+            "team_sync_http_received_bytes",
+            "Response bytes received through the shared HTTP transport, before "
+            "decompression",
+            labels=["host"],
+        )
+        for host, stats in pool_stats().items():
+            requests.add_metric([host], stats["requests"])
+            connections.add_metric([host], stats["connections"])
+            received.add_metric([host], stats["received_bytes"])
+        yield requests
+        yield connections
+        yield received
+
+
+REGISTRY.register(ConnectionPoolCollector())
+
+
+def track_pipeline(pipeline):
+    """
+    Report the queue depths of ``pipeline`` until the next call
+    :param pipeline: The running pipeline, or None once it is done
+    :return:
+    """
+    global _pipeline
+    _pipeline = pipeline
+
+
+def timed_phase(phase):
+    """
+    Decorator recording how long a sync phase takes
+    :param phase: Name of the phase
+    :return:
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with PHASE_SECONDS.labels(phase).time():
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_phase(phase, seconds):
+    """
+    Record the duration of a sync phase timed by the caller
+    :param phase: Name of the phase
+    :param seconds:
+    :return:
+    """
+    PHASE_SECONDS.labels(phase).observe(seconds)
+
+
+def instrument_github(client, installation):
+    """
+    Count the requests made by a github3 client and track its rate limit, also
+    reported on /status
+    :param client: github3 client authenticated as an installation
+    :param installation: Installation (organization) label
+    :return: client
+    """
+    session = client.session
+    if getattr(session, "_team_sync_instrumented", False):
+        return client
+    calls = GITHUB_CALLS.labels(installation)
+    remaining = GITHUB_RATE_LIMIT_REMAINING.labels(installation)
+    budget = get_budget("github")
+
+    def on_response(response, *args, **kwargs):
+        calls.inc()
+        tracing.count_api_call()
+        if "X-RateLimit-Remaining" in response.headers:
+            remaining.set(int(response.headers["X-RateLimit-Remaining"]))
+            if "X-RateLimit-Reset" in response.headers:
+                budget.update(
+                    installation,
+                    response.headers["X-RateLimit-Remaining"],
+                    response.headers["X-RateLimit-Reset"],
+                    response.headers.get("Date"),
+                )
+
+    session.hooks["response"].append(on_response)
+    session._team_sync_instrumented = True
+    return client
+
+
+def count_directory_call(backend, installation):
+    DIRECTORY_CALLS.labels(backend, installation or "").inc()
+    tracing.count_api_call()
+
+
+def count_team(outcome):
+    TEAMS.labels(outcome).inc()
+
+
+@contextlib.contextmanager
+def track_run():
+    """
+    Record the duration, outcome and bytes received of a full sync
+    """
+    from .transport import received_bytes
+
+    start = time.monotonic()
+    received = received_bytes()
+    RUN_IN_PROGRESS.set(1)
+    outcome = "failed"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        RUN_DURATION.set(time.monotonic() - start)
+        RUN_RECEIVED_BYTES.set(received_bytes() - received)
+        RUN_IN_PROGRESS.set(0)
+        RUNS.labels(outcome).inc()
+        track_pipeline(None)
+
+
+def metrics_view():
+    """
+    Flask view rendering every metric in the Prometheus text format
+    """
+    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
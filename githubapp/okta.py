@@ -2,11 +2,30 @@ import asyncio
 import os
 import logging
 import re
+import threading
+import time
+from urllib.parse import urlsplit
 from okta.client import Client as OktaClient
 
+from .config import strtobool
+from .directory import rewrite_usernames
+from .ratelimit import get_budget
+from .syncmap import load_syncmap
 
 LOG = logging.getLogger(__name__)
 
+# Most groups looked up at the same time by get_groups_members
+CONCURRENT_REQUESTS = 10
+# Most groups Okta returns in one page
+GROUP_PAGE_SIZE = 10000
+
+# Requests left in the rate-limit window of each Okta endpoint, shared by all clients
+RATE_LIMITS = get_budget("okta", int(os.environ.get("OKTA_RATE_LIMIT_RESERVE", 0)))
+
+# IDs of the groups by name, shared by all clients for a run
+_group_index = None
+_group_index_lock = threading.Lock()
+
 
 class Okta:
     def __init__(self):
@@ -20,7 +39,9 @@ class Okta:
             config["privateKey"] = os.environ["OKTA_PRIVATE_KEY"]
         else:
             config["token"] = os.environ["OKTA_ACCESS_TOKEN"]
+        self.OKTA_GROUP_INDEX = strtobool(os.environ.get("OKTA_GROUP_INDEX", "True"))
         self.client = OktaClient(config)
+        pace(self.client.get_request_executor())
 
     def get_group_members(self, group_name=None):
         """
@@ -30,58 +51,241 @@ class Okta:
         :return member_list: A list of dictionaries containing usernames and emails
         :rtype member_list: list
         """
-        member_list = []
-
-        async def get_group_id(client=None):
-            """
-            Get the group ID
-            :return:
-            """
-            group = await client.list_groups(query_params={"q": group_name})
-            return group[0][0].id
-
-        async def get_members(client=None, groupId=None):
-            """
-            Get the users that belong to this group
-            :param groupId:
-            :return:
-            """
-            members = await client.list_group_users(groupId=groupId)
-            return members[0]
-
-        def get_or_create_eventloop():
-            """
-            Create an async loop if we're in a child thread
-            :return:
-            """
-            try:
-                return asyncio.get_event_loop()
-            except RuntimeError as ex:
-                if "There is no current event loop in thread" in str(ex):
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    return asyncio.get_event_loop()
+        return list(self.iter_group_members(group_name=group_name))
 
+    def iter_group_members(self, group_name=None):
+        """
+        Yield the users that are part of a given group in Okta
+        :param group_name: Group name to look up
+        :type group_name: str
+        :return: Dictionaries containing usernames and emails
+        :rtype: generator
+        """
+        index = self.get_group_index()
         loop = get_or_create_eventloop()
-        gid = loop.run_until_complete(get_group_id(client=self.client))
-        users = loop.run_until_complete(get_members(client=self.client, groupId=gid))
+        gid = loop.run_until_complete(self.get_group_id(group_name, index))
+        if gid is None:
+            return
+        users = loop.run_until_complete(self.get_members(groupId=gid))
         for user in users:
-            try:
-                username = getattr(user.profile, self.USERNAME_ATTRIBUTE)
+            member = self.member_info(user)
+            if member is not None:
+                yield member
+
+    def get_groups_members(self, names):
+        """
+        Get the members of several groups, looking them up concurrently with at
+        most CONCURRENT_REQUESTS groups in flight
+        :param names: Names of the groups
+        :type names: list
+        :return: Members of each group by name. Groups that could not be looked up
+                 are left out.
+        :rtype: dict
+        """
+
+        async def get_group(name, semaphore):
+            async with semaphore:
+                gid = await self.get_group_id(name, index)
+                if gid is None:
+                    return []
+                return await self.get_members(groupId=gid)
+
+        async def get_groups():
+            semaphore = asyncio.Semaphore(CONCURRENT_REQUESTS)
+            return await asyncio.gather(
+                *(get_group(name, semaphore) for name in names),
+                return_exceptions=True,
+            )
+
+        index = self.get_group_index()
+        loop = get_or_create_eventloop()
+        groups = {}
+        for name, users in zip(names, loop.run_until_complete(get_groups())):
+            if isinstance(users, Exception):
+                LOG.warning("Unable to look up group %s: %r", name, users)
+                continue
+            groups[name] = [
+                member for member in map(self.member_info, users) if member is not None
+            ]
+        return groups
+
+    async def get_group_id(self, group_name, index=None):
+        """
+        Get the group ID from the group index, or look the group up by its exact
+        name if it isn't indexed
+        :param group_name:
+        :param index: As returned by get_group_index
+        :return: The group ID, or None if there is no such group
+        """
+        if index and group_name in index:
+            return index[group_name]
+        # Not indexed, or created since the index was built
+        groups = await self.list_groups(f'profile.name eq "{search_value(group_name)}"')
+        return groups[0].id if groups else None
+
+    def get_group_index(self):
+        """
+        Return the IDs of the groups by name, listed once per run and re-used by
+        every client. When syncmap.yml has a group_prefix, only the groups whose
+        name starts with one of the prefixes are listed.
+        :return: An empty dict if OKTA_GROUP_INDEX is false
+        :rtype: dict
+        """
+        global _group_index
+        if not self.OKTA_GROUP_INDEX:
+            return {}
+        with _group_index_lock:
+            if _group_index is not None:
+                return _group_index
+            start = time.monotonic()
+            loop = get_or_create_eventloop()
+            index = {}
+            for prefix in list(load_syncmap()[1]) or [None]:
+                search = f'profile.name sw "{search_value(prefix)}"' if prefix else None
+                for group in loop.run_until_complete(self.list_groups(search)):
+                    index.setdefault(group.profile.name, group.id)
+            LOG.info(
+                "Indexed %d Okta groups in %.1fs", len(index), time.monotonic() - start
+            )
+            _group_index = index
+            return index
+
+    @staticmethod
+    def reset_group_index():
+        """
+        Forget the group index at the start of a run, so groups renamed or recreated
+        since the previous run are not looked up by a stale ID
+        :return:
+        """
+        global _group_index
+        with _group_index_lock:
+            _group_index = None
+
+    async def list_groups(self, search=None):
+        """
+        List every group, or the groups matching a search expression
+        :param search: Okta search expression, such as 'profile.name eq "name"'
+        :return:
+        :rtype: list
+        """
+        query_params = {"limit": GROUP_PAGE_SIZE}
+        if search:
+            query_params["search"] = search
+        return await all_pages(
+            *await self.client.list_groups(query_params=query_params)
+        )
+
+    async def get_members(self, groupId=None):
+        """
+        Get the users that belong to this group, following every page
+        :param groupId:
+        :return:
+        """
+        return await all_pages(*await self.client.list_group_users(groupId=groupId))
+
+    def member_info(self, user):
+        """
+        Turn an Okta user into a member
+        :param user:
+        :return: Dict of username and email, or None if the profile lacks them
+        :rtype: dict
+        """
+        try:
+            username = getattr(user.profile, self.USERNAME_ATTRIBUTE)
+            if rewrite_usernames():
                 username = username.split("@")[0]
                 username = re.sub("[^0-9a-zA-Z-]+", "-", username)
                 if "EMU_SHORTCODE" in os.environ:
                     username = username + "_" + os.environ["EMU_SHORTCODE"]
-                member_list.append(
-                    {
-                        "username": username,
-                        "email": user.profile.email,
-                    }
-                )
-            except AttributeError as e:
-                if user.links:
-                    user_info = user.links["self"]["href"]
-                else:
-                    user_info = user
-                print(f"User {user_info}: {e}")
-        return member_list
+            email = user.profile.email
+        except AttributeError as e:
+            if user.links:
+                user_info = user.links["self"]["href"]
+            else:
+                user_info = user
+            LOG.warning("User %s: %s", user_info, e)
+            return None
+        return {
+            "username": username,
+            "email": email,
+        }
+
+
+async def all_pages(items, response, error):
+    """
+    Read the remaining pages of an Okta list response
+    :param items: The first page, as returned by the client
+    :param response:
+    :param error:
+    :return: The items of every page
+    :rtype: list
+    """
+    items = list(items or [])
+    while error is None and response.has_next():
+        page, error = await response.next()
+        items.extend(page or [])
+    if error is not None:
+        if isinstance(error, Exception):
+            raise error
+        raise Exception(f"Okta request failed: {error.message}")
+    return items
+
+
+def search_value(value):
+    """
+    Quote a string for use in an Okta search expression
+    :param value:
+    :return:
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def rate_limit_key(url):
+    """
+    The rate-limit bucket of a request: its path, without the IDs in it
+    :param url:
+    :return:
+    """
+    return re.sub(r"/(groups|users|apps)/[^/]+", r"/\1/{id}", urlsplit(url).path)
+
+
+def pace(executor):
+    """
+    Make the requests of an Okta client wait for the rate-limit budget of their
+    endpoint in RATE_LIMITS, and record the budget their responses report. Workers
+    then queue for the budget instead of getting 429 responses.
+    :param executor: The client's request executor
+    :return:
+    """
+    if getattr(executor, "_team_sync_paced", False):
+        return
+    send = executor.fire_request_helper
+
+    async def fire_request_helper(request, attempts, request_start_time):
+        key = rate_limit_key(request["url"])
+        wait = RATE_LIMITS.reserve_request(key)
+        while wait:
+            LOG.debug("Waiting %.1fs for the rate limit of %s", wait, key)
+            await asyncio.sleep(wait)
+            wait = RATE_LIMITS.reserve_request(key)
+        result = await send(request, attempts, request_start_time)
+        if result[1] is not None:
+            RATE_LIMITS.update_from_headers(key, result[1].headers)
+        return result
+
+    executor.fire_request_helper = fire_request_helper
+    executor._team_sync_paced = True
+
+
+def get_or_create_eventloop():
+    """
+    Create an async loop if we're in a child thread
+    :return:
+    """
+    try:
+        return asyncio.get_event_loop()
+    except RuntimeError as ex:
+        if "There is no current event loop in thread" in str(ex):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            return asyncio.get_event_loop()
@@ -1,8 +1,10 @@
 from onelogin.api.client import OneLoginClient
 import os
 
+from .directory import BulkGroupsMixin, rewrite_usernames
 
-class OneLogin:
+
+class OneLogin(BulkGroupsMixin):
     def __init__(self):
         CLIENT_ID = os.environ["ONELOGIN_CLIENT_ID"]
         CLIENT_SECRET = os.environ["ONELOGIN_CLIENT_SECRET"]
@@ -16,14 +18,19 @@ class OneLogin:
         :param group_name:
         :return:
         """
-        member_list = []
+        return list(self.iter_group_members(group_name=group_name))
+
+    def iter_group_members(self, group_name=None):
+        """
+        Yield the users assigned to a role, see get_group_members
+        :param group_name:
+        :return:
+        """
         role = self.client.get_roles(query_parameters={"name": group_name})
         users = self.client.get_users(query_parameters={"role_id": role[0].id})
         for user in users:
-            if "EMU_SHORTCODE" in os.environ:
+            if "EMU_SHORTCODE" in os.environ and rewrite_usernames():
                 username = user.username + "_" + os.environ["EMU_SHORTCODE"]
             else:
                 username = user.username
-            member_list.append({"username": username, "email": user.email})
-
-        return member_list
+            yield {"username": username, "email": user.email}
@@ -0,0 +1,313 @@
+"""
+Staged worker pipeline connected by bounded queues
+"""
+
+import logging
+import queue
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    ``func`` takes an item and returns the item to pass to the next stage, or None
+    to drop it. With ``fanout`` it returns an iterable of items instead.
+
+    With ``batch``, ``func`` takes a list of up to ``batch`` items and returns an
+    iterable of items. A worker takes whatever is queued, waiting at most ``linger``
+    seconds for a batch to fill up.
+
+    With ``partition``, items are sorted by ``partition(item)`` into separate queues,
+    each with its own ``pools[key]`` workers, so a slow partition doesn't hold up the
+    others until its queue is full. Batches then only hold items of the same partition.
+    """
+
+    def __init__(
+        self,
+        name,
+        func,
+        workers=1,
+        fanout=False,
+        batch=None,
+        linger=0.05,
+        partition=None,
+        pools=None,
+    ):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.fanout = fanout or bool(batch)
+        self.batch = batch
+        self.linger = linger
+        self.partition = partition
+        self.pools = pools or {}
+
+    @property
+    def readers(self):
+        """
+        Threads taking items from the stage's queue: a partitioned stage has one
+        thread sorting them into the queues of its partitions
+        """
+        return 1 if self.partition else self.workers
+
+    @property
+    def threads(self):
+        """
+        Worker threads of the stage
+        """
+        return sum(self.pools.values()) if self.partition else self.workers
+
+
+class Pipeline:
+    """
+    Runs every stage concurrently on its own worker threads. Stages are connected by
+    queues holding at most ``maxsize`` items, so a slow stage makes the stages before
+    it wait instead of buffering the whole run in memory.
+    """
+
+    def __init__(self, stages, maxsize=100, on_error=None):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.queues = [queue.Queue(maxsize) for _ in stages]
+        self.on_error = on_error or self._print_error
+        self.lock = threading.Lock()
+        self.finished = [0] * len(stages)
+        # Queues of the partitions of partitioned stages, by stage index and key
+        self.partitions = {
+            index: {key: queue.Queue(maxsize) for key in stage.pools}
+            for index, stage in enumerate(stages)
+            if stage.partition
+        }
+
+    @staticmethod
+    def _print_error(stage, item, error):
+        LOG.error("Pipeline stage %s failed: %s", stage, error, exc_info=error)
+
+    def depths(self):
+        """
+        Number of items waiting in front of each stage
+        :return:
+        :rtype: dict
+        """
+        depths = {stage.name: q.qsize() for stage, q in zip(self.stages, self.queues)}
+        for index, partitions in self.partitions.items():
+            for key, inbox in partitions.items():
+                depths[f"{self.stages[index].name}[{key}]"] = inbox.qsize()
+        return depths
+
+    def run(self, source):
+        """
+        Feed every item of ``source`` to the first stage and wait for all stages to drain
+        :param source: Iterable of items for the first stage
+        :return:
+        """
+        workers = []
+        for index, stage in enumerate(self.stages):
+            if not stage.partition:
+                workers += [
+                    (f"{stage.name}-{n}", self._work, (index, self.queues[index]))
+                    for n in range(stage.workers)
+                ]
+                continue
+            workers.append((f"{stage.name}-sort", self._sort, (index,)))
+            for key, inbox in self.partitions[index].items():
+                workers += [
+                    (f"{stage.name}-{key}-{n}", self._work, (index, inbox))
+                    for n in range(stage.pools[key])
+                ]
+        threads = []
+        for name, target, args in workers:
+            thread = threading.Thread(target=target, args=args, name=name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for item in source:
+                self.queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].readers):
+                self.queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+    @staticmethod
+    def _take_batch(stage, inbox, first):
+        """
+        Collect up to ``stage.batch`` items, starting with ``first``
+        :return: The items, and whether the end of the input was reached
+        """
+        items = [first]
+        deadline = time.monotonic() + stage.linger
+        while len(items) < stage.batch:
+            try:
+                item = inbox.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _sort(self, index):
+        """
+        Move the items queued for a partitioned stage to the queues of their partitions
+        """
+        stage = self.stages[index]
+        partitions = self.partitions[index]
+        while True:
+            item = self.queues[index].get()
+            if item is _DONE:
+                break
+            try:
+                key = stage.partition(item)
+                if key not in partitions:
+                    raise ValueError(f"Stage {stage.name} has no partition {key}")
+                partitions[key].put(item)
+            except Exception as e:
+                try:
+                    self.on_error(stage.name, item, e)
+                except Exception:
+                    LOG.exception("Error handler of stage %s failed", stage.name)
+        for key, inbox in partitions.items():
+            for _ in range(stage.pools[key]):
+                inbox.put(_DONE)
+
+    def _work(self, index, inbox):
+        stage = self.stages[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.stages) else None
+        done = False
+        while not done:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            if stage.batch:
+                item, done = self._take_batch(stage, inbox, item)
+            try:
+                result = stage.func(item)
+                if stage.fanout:
+                    results = result or ()
+                else:
+                    results = () if result is None else (result,)
+                for result in results:
+                    if outbox is not None:
+                        outbox.put(result)
+            except Exception as e:
+                for failed in item if stage.batch else (item,):
+                    try:
+                        self.on_error(stage.name, failed, e)
+                    except Exception:
+                        LOG.exception("Error handler of stage %s failed", stage.name)
+        with self.lock:
+            self.finished[index] += 1
+            last = self.finished[index] == stage.threads
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1].readers):
+                outbox.put(_DONE)
+
+
+class Cancelled(Exception):
+    """
+    Raised at a checkpoint of a call that ``gather`` gave up on
+    """
+
+
+class CallTimeout(TimeoutError):
+    """
+    A call run by ``gather`` did not finish within its timeout
+    """
+
+
+_local = threading.local()
+
+
+class _Scope:
+    def __init__(self, name):
+        self.name = name
+        self.cancelled = threading.Event()
+
+
+def checkpoint():
+    """
+    Raise Cancelled if the ``gather`` call running on this thread was cancelled.
+    Long-running calls should reach a checkpoint regularly, e.g. once per page or
+    item, so they stop soon after their result is no longer wanted.
+    """
+    scope = getattr(_local, "scope", None)
+    if scope is not None and scope.cancelled.is_set():
+        raise Cancelled(f"{scope.name} was cancelled")
+
+
+def cancellable(iterable):
+    """
+    Iterate over ``iterable``, reaching a checkpoint before each item
+    :param iterable:
+    :return:
+    """
+    for item in iterable:
+        checkpoint()
+        yield item
+    checkpoint()
+
+
+def gather(calls, timeouts=None):
+    """
+    Run calls concurrently, each on its own thread, and wait for all of them.
+
+    As soon as one call raises or runs past its timeout, the others are cancelled
+    and that error is raised: a cancelled call stops at its next ``checkpoint`` and
+    whatever it raises or returns afterwards is ignored.
+    :param calls: Functions without arguments, by name
+    :type calls: dict
+    :param timeouts: Seconds each call may take, by name. None or 0 for no limit
+    :type timeouts: dict
+    :return: The result of each call, by name
+    :rtype: dict
+    """
+    timeouts = timeouts or {}
+    outcomes = queue.Queue()
+    scopes = {name: _Scope(name) for name in calls}
+
+    def run(name, func):
+        _local.scope = scopes[name]
+        try:
+            outcomes.put((name, func(), None))
+        except BaseException as e:
+            outcomes.put((name, None, e))
+
+    start = time.monotonic()
+    deadlines = {name: start + timeouts[name] for name in calls if timeouts.get(name)}
+    for name, func in calls.items():
+        thread = threading.Thread(target=run, args=(name, func), name=name)
+        thread.daemon = True
+        thread.start()
+
+    results = {}
+    pending = set(calls)
+    try:
+        while pending:
+            waits = [deadlines[name] for name in pending if name in deadlines]
+            wait = max(min(waits) - time.monotonic(), 0) if waits else None
+            try:
+                name, result, error = outcomes.get(timeout=wait)
+            except queue.Empty:
+                now = time.monotonic()
+                name = min((n for n in pending if n in deadlines), key=deadlines.get)
+                if deadlines[name] > now:
+                    continue
+                raise CallTimeout(
+                    f"{name} did not finish within {timeouts[name]:g}s"
+                ) from None
+            pending.discard(name)
+            if error is not None:
+                raise error
+            results[name] = result
+    finally:
+        for name in pending:
+            scopes[name].cancelled.set()
+    return results
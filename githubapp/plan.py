@@ -0,0 +1,158 @@
+"""
+Sync plans: the changes a full sync would make, written as JSON Lines so they can
+be reviewed before being applied
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+
+class PlanWriter:
+    """
+    Writes a plan file: a header line, then one line per team with changes or a
+    failed lookup. Safe to use from several threads.
+
+    The plan is written to a temporary file next to ``path``, which only replaces
+    ``path`` once the plan is closed complete, so a plan being applied is never
+    partial or truncated.
+    """
+
+    def __init__(self, path, attribute):
+        self.path = path
+        self.lock = threading.Lock()
+        self.teams = 0
+        self.changes = 0
+        self.failed = 0
+        directory, name = os.path.split(os.path.abspath(path))
+        self.temp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+        self.file = open(self.temp_path, "w")
+        self._write(
+            {
+                "version": PLAN_VERSION,
+                "created_at": time.time(),
+                "attribute": attribute,
+            }
+        )
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def add(self, owner, slug, team_id, directory_group, state):
+        """
+        Add the changes computed for a team. Teams without changes are left out.
+        :param owner:
+        :param slug:
+        :param team_id:
+        :param directory_group:
+        :param state: The sync state returned by compare_members
+        :return:
+        """
+        add, remove = state["action"]["add"], state["action"]["remove"]
+        if not add and not remove:
+            return
+        with self.lock:
+            self.teams += 1
+            self.changes += len(add) + len(remove)
+            self._write(
+                {
+                    "owner": owner,
+                    "slug": slug,
+                    "team_id": team_id,
+                    "directory_group": directory_group,
+                    "directory_count": state["directory_count"],
+                    "github_count": state["github_count"],
+                    "add": add,
+                    "remove": remove,
+                }
+            )
+
+    def add_failure(self, owner, slug, error):
+        """
+        Record a team whose changes could not be computed
+        :param owner:
+        :param slug:
+        :param error:
+        :return:
+        """
+        with self.lock:
+            self.failed += 1
+            self._write({"owner": owner, "slug": slug, "error": str(error)})
+
+    def close(self, complete=True):
+        """
+        Finish the plan
+        :param complete: Whether the run finished, so the plan replaces the one at
+                         ``path``. Otherwise the plan is discarded.
+        :return:
+        """
+        with self.lock:
+            self.file.close()
+        if not complete:
+            os.remove(self.temp_path)
+            LOG.warning("Discarded the incomplete plan for %s", self.path)
+            return
+        os.replace(self.temp_path, self.path)
+        LOG.info(
+            "Wrote plan %s: %d changes to %d teams, %d teams failed",
+            self.path,
+            self.changes,
+            self.teams,
+            self.failed,
+        )
+
+
+def read_plan(path):
+    """
+    Read a plan file
+    :param path:
+    :return: The plan's header, and its teams
+    :rtype: tuple
+    """
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if not lines or lines[0].get("version") != PLAN_VERSION:
+        raise ValueError(f"{path} is not a version {PLAN_VERSION} sync plan")
+    return lines[0], lines[1:]
+
+
+def sync_state(team):
+    """
+    Turn a team of a plan back into the sync state execute_sync takes
+    :param team:
+    :return:
+    :rtype: dict
+    """
+    return {
+        "directory_count": team["directory_count"],
+        "github_count": team["github_count"],
+        "action": {"add": team["add"], "remove": team["remove"]},
+    }
+
+
+def check_plan(header, teams, attribute, max_changes=None):
+    """
+    Check a whole plan before any of it is applied
+    :param header:
+    :param teams:
+    :param attribute: The USER_SYNC_ATTRIBUTE the plan must have been made with
+    :param max_changes: Most changes the plan may contain in total, or None
+    :return: The total number of changes
+    :raises ValueError: If the plan must not be applied
+    """
+    if header["attribute"] != attribute:
+        raise ValueError(
+            f"The plan compares {header['attribute']}, not {attribute}; make a new plan"
+        )
+    total = sum(len(t["add"]) + len(t["remove"]) for t in teams if "error" not in t)
+    if max_changes is not None and total > max_changes:
+        raise ValueError(
+            f"The plan has {total} changes, more than PLAN_MAX_CHANGES ({max_changes})"
+        )
+    return total
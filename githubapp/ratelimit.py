@@ -0,0 +1,131 @@
+"""
+Rate-limit budgets shared by every sync worker. Responses report the requests left
+in the current window of an endpoint and when it resets; once the budget of an
+endpoint is spent, its requests wait for the reset instead of being rejected.
+"""
+
+import email.utils
+import threading
+import time
+
+
+class RateLimitBudget:
+    """
+    Requests left in the rate-limit window of each endpoint, as last reported by
+    the API, less the requests sent since
+    """
+
+    def __init__(self, reserve=0):
+        """
+        :param reserve: Requests of each window left to other clients of the same
+                        limit, such as other apps of the organization
+        """
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        # [remaining, reset as a time.time() value], by endpoint
+        self.windows = {}
+
+    def reserve_request(self, key):
+        """
+        Take a request from the budget of an endpoint
+        :param key: The endpoint, as used with ``update``
+        :return: Seconds to wait before trying again, or 0 if the request can be
+                 sent now
+        :rtype: float
+        """
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None:
+                return 0
+            now = time.time()
+            if window[1] <= now:
+                # The window reset; the next response tells the new budget
+                del self.windows[key]
+                return 0
+            if window[0] > self.reserve:
+                window[0] -= 1
+                return 0
+            return window[1] - now
+
+    def update(self, key, remaining, reset, date=None):
+        """
+        Record the budget a response reported
+        :param key: The endpoint the request was sent to
+        :param remaining: Requests left in the window
+        :param reset: When the window resets, in seconds since the epoch
+        :param date: Date header of the response, to correct ``reset`` for the
+                     difference between the API's clock and ours
+        :return:
+        """
+        reset = float(reset)
+        if date:
+            try:
+                reset += (
+                    time.time() - email.utils.parsedate_to_datetime(date).timestamp()
+                )
+            except (TypeError, ValueError):
+                pass
+        remaining = int(remaining)
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or reset > window[1] + 1:
+                self.windows[key] = [remaining, reset]
+            else:
+                # Responses to requests sent before others may arrive after them
+                window[0] = min(window[0], remaining)
+
+    def update_from_headers(self, key, headers):
+        """
+        Record the budget reported by the X-Rate-Limit-Remaining and
+        X-Rate-Limit-Reset headers of a response, if it has them
+        :param key:
+        :param headers: Case-insensitive headers of the response
+        :return:
+        """
+        remaining = headers.get("X-Rate-Limit-Remaining")
+        reset = headers.get("X-Rate-Limit-Reset")
+        if remaining is not None and reset is not None:
+            self.update(key, remaining, reset, headers.get("Date"))
+
+    def snapshot(self):
+        """
+        The budget of each endpoint whose window hasn't reset yet
+        :return: Dicts of remaining and reset_in seconds, by endpoint
+        :rtype: dict
+        """
+        now = time.time()
+        with self.lock:
+            return {
+                key: {"remaining": remaining, "reset_in": round(reset - now, 1)}
+                for key, (remaining, reset) in self.windows.items()
+                if reset > now
+            }
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def get_budget(name, reserve=0):
+    """
+    Return the process-wide budget of an API, created on first use
+    :param name: Name of the API, such as "github" or "okta"
+    :param reserve: Reserve of the budget, if it is created
+    :return:
+    :rtype: RateLimitBudget
+    """
+    with _budgets_lock:
+        if name not in _budgets:
+            _budgets[name] = RateLimitBudget(reserve)
+        return _budgets[name]
+
+
+def budgets():
+    """
+    The budget of each endpoint of every API, see RateLimitBudget.snapshot
+    :return: Snapshots by API name
+    :rtype: dict
+    """
+    with _budgets_lock:
+        apis = dict(_budgets)
+    return {name: budget.snapshot() for name, budget in apis.items()}
@@ -0,0 +1,79 @@
+"""
+Scheduling of full syncs: one run at a time, most urgent teams first, and no
+team started after the run's time budget is spent
+"""
+
+import datetime
+import functools
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Reentrant, so a run can call another single_run function, as planning does
+_run_lock = threading.RLock()
+
+
+def single_run(f):
+    """
+    Decorator letting only one run of the decorated functions happen at a time. A
+    call made while another run is in progress returns None straight away.
+    :param f:
+    :return:
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not _run_lock.acquire(blocking=False):
+            LOG.warning(
+                "Skipping %s: the previous run is still in progress", f.__name__
+            )
+            return None
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _run_lock.release()
+
+    return wrapper
+
+
+def priority(state):
+    """
+    Sort key putting the teams most in need of a sync first: teams whose last sync
+    failed, then teams the last sync changed, most recently changed first, then
+    the others, longest since their last sync first. Teams never synced count as
+    the longest since their last sync.
+    :param state: The team's snapshot row, or None if there is none
+    :return:
+    """
+    if state is None:
+        return (2, 0)
+    synced_at = state["synced_at"] or 0
+    if state["status"] == "failed":
+        return (0, synced_at)
+    if state["changed_at"] and state["changed_at"] >= synced_at:
+        return (1, -state["changed_at"])
+    return (2, synced_at)
+
+
+def run_deadline(trigger, budget, margin=60):
+    """
+    Work out when a run should stop starting teams
+    :param trigger: The APScheduler trigger of the runs
+    :param budget: "auto" to stop ``margin`` seconds before the trigger next fires,
+                   a number of seconds, or an empty value for no limit
+    :param margin:
+    :return: The deadline as a time.monotonic() value, or None for no limit
+    """
+    if not budget or budget == "0":
+        return None
+    if budget == "auto":
+        now = datetime.datetime.now(datetime.timezone.utc)
+        next_run = trigger.get_next_fire_time(None, now)
+        if next_run is None:
+            return None
+        seconds = (next_run - now).total_seconds() - margin
+    else:
+        seconds = float(budget)
+    return time.monotonic() + max(seconds, 0)
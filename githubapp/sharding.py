@@ -0,0 +1,302 @@
+"""
+Split teams across several sync workers sharing a coordinator database
+"""
+
+import atexit
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL,
+    assigned INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS leases (
+    shard TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hash ring, so adding or losing a worker only moves the keys
+    that worker owned
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self.ring = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self.hashes = [h for h, _ in self.ring]
+
+    def get(self, key):
+        """
+        Get the node owning a key
+        :param key:
+        :return: The node, or None if the ring is empty
+        """
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class ShardCoordinator:
+    """
+    Coordinates sync workers through a shared SQLite database.
+
+    Live workers heartbeat into the database; a team belongs to the worker the hash
+    ring of live workers maps it to. Before syncing, the owner takes a lease on the
+    team so that two workers never sync it at the same time while the ring is
+    changing. Workers heartbeat for as long as their process runs, so each run sees
+    every worker, and leave the ring when their process exits. A worker that stops
+    heartbeating without leaving drops out of the ring once its lease period
+    passes, and its teams are picked up by the others.
+    """
+
+    def __init__(self, path, worker_id=None, lease_seconds=300):
+        self.path = path
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.conn.executescript(SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(leases)")]
+        if "completed" not in columns:
+            # Databases created before leases recorded completion
+            self.conn.execute(
+                "ALTER TABLE leases ADD COLUMN completed INTEGER NOT NULL DEFAULT 0"
+            )
+        self.live_workers = [self.worker_id]
+        self.ring = HashRing(self.live_workers)
+        self.assigned = 0
+        self.done = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def join(self):
+        """
+        Register this worker and keep its heartbeat alive in the background until
+        shutdown. Calling it again has no effect.
+        :return:
+        """
+        if self._thread is not None:
+            return
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self._thread.start()
+
+    def start(self):
+        """
+        Start the progress of a new run
+        :return:
+        """
+        with self.lock:
+            self.assigned = self.done = self.failed = 0
+        self.join()
+        self.heartbeat()
+
+    def stop(self):
+        """
+        Publish the progress of the run that ended. The heartbeat goes on, so the
+        other workers keep this one in their ring between runs.
+        :return:
+        """
+        self.heartbeat()
+
+    def shutdown(self):
+        """
+        Stop heartbeating and leave the ring now rather than once the lease period
+        passes. This worker's leases are left for the others to take over.
+        :return:
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM workers WHERE worker_id = ?", (self.worker_id,)
+            )
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                LOG.warning("Shard heartbeat failed: %s", e)
+
+    def heartbeat(self):
+        """
+        Publish this worker's heartbeat and progress, and rebuild the ring from the
+        workers that are still alive
+        :return:
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?)",
+                (self.worker_id, now, self.assigned, self.done, self.failed),
+            )
+            rows = self.conn.execute(
+                "SELECT worker_id FROM workers WHERE heartbeat > ?",
+                (now - self.lease_seconds,),
+            ).fetchall()
+            self.live_workers = [r[0] for r in rows]
+            self.ring = HashRing(self.live_workers)
+
+    def owns(self, key):
+        return self.ring.get(key) == self.worker_id
+
+    def claim(self, key):
+        """
+        Take the lease on a key if this worker owns it and no other worker is
+        syncing it. Leases this worker holds, completed leases and expired leases
+        can be taken.
+        :param key: Shard key, e.g. "org/team-slug"
+        :return: Whether this worker should sync the key
+        :rtype: bool
+        """
+        if not self.owns(key):
+            return False
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT owner, expires, completed FROM leases WHERE shard = ?",
+                    (key,),
+                ).fetchone()
+                if row and row[1] > now and row[0] != self.worker_id and not row[2]:
+                    # Another worker is syncing it
+                    self.conn.execute("COMMIT")
+                    return False
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, 0)",
+                    (key, self.worker_id, now + self.lease_seconds),
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.assigned += 1
+            return True
+
+    def complete(self, key, success=True):
+        """
+        Record the outcome of a claimed key. Successful keys keep their lease,
+        marked completed so the next run's owner can take it straight away; failed
+        keys are released for another worker to retry.
+        :param key:
+        :param success:
+        :return:
+        """
+        with self.lock:
+            if success:
+                self.done += 1
+                self.conn.execute(
+                    "UPDATE leases SET expires = ?, completed = 1 "
+                    "WHERE shard = ? AND owner = ?",
+                    (time.time() + self.lease_seconds, key, self.worker_id),
+                )
+            else:
+                self.failed += 1
+                self.conn.execute(
+                    "DELETE FROM leases WHERE shard = ? AND owner = ?",
+                    (key, self.worker_id),
+                )
+            finished = self.done + self.failed
+        if finished % 50 == 0:
+            self.report()
+
+    def release(self, key):
+        """
+        Give up a claimed key without syncing it, e.g. when the run is out of time
+        :param key:
+        :return:
+        """
+        with self.lock:
+            self.assigned -= 1
+            self.conn.execute(
+                "DELETE FROM leases WHERE shard = ? AND owner = ?",
+                (key, self.worker_id),
+            )
+
+    def report(self):
+        LOG.info(
+            "Shard progress for %s: %d/%d teams (%d failed, %d live workers)",
+            self.worker_id,
+            self.done + self.failed,
+            self.assigned,
+            self.failed,
+            len(self.live_workers),
+        )
+
+    def progress(self):
+        """
+        Get the progress of every registered worker
+        :return: Tuples of worker ID, seconds since last heartbeat, assigned, done and failed
+        :rtype: list
+        """
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT worker_id, heartbeat, assigned, done, failed FROM workers "
+                "ORDER BY worker_id"
+            ).fetchall()
+        return [(w, now - hb, a, d, f) for w, hb, a, d, f in rows]
+
+
+_coordinator = None
+
+
+def get_shard_coordinator():
+    """
+    Return this process's shard coordinator, or None if SHARD_COORDINATOR is not set
+    :return:
+    """
+    global _coordinator
+    path = os.environ.get("SHARD_COORDINATOR")
+    if not path:
+        return None
+    if _coordinator is None:
+        _coordinator = ShardCoordinator(
+            path,
+            worker_id=os.environ.get("SHARD_WORKER_ID"),
+            lease_seconds=int(os.environ.get("SHARD_LEASE_SECONDS", 300)),
+        )
+        atexit.register(_coordinator.shutdown)
+    return _coordinator
+
+
+if __name__ == "__main__":
+    if not os.environ.get("SHARD_COORDINATOR"):
+        sys.exit("SHARD_COORDINATOR is not set")
+    coordinator = ShardCoordinator(os.environ["SHARD_COORDINATOR"], worker_id="-")
+    for worker_id, age, assigned, done, failed in coordinator.progress():
+        print(
+            f"{worker_id}: {done + failed}/{assigned} teams, {failed} failed, "
+            f"last heartbeat {int(age)}s ago"
+        )
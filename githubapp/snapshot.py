@@ -0,0 +1,280 @@
+"""
+Persistent snapshots of team membership on both sides of the sync
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS teams (
+    org TEXT NOT NULL,
+    team TEXT NOT NULL,
+    team_id INTEGER,
+    directory_group TEXT,
+    attribute TEXT,
+    github_count INTEGER,
+    synced_at REAL,
+    changed_at REAL,
+    status TEXT,
+    error TEXT,
+    github_etag TEXT,
+    PRIMARY KEY (org, team)
+);
+CREATE INDEX IF NOT EXISTS teams_team ON teams (team);
+CREATE TABLE IF NOT EXISTS members (
+    org TEXT NOT NULL,
+    team TEXT NOT NULL,
+    side TEXT NOT NULL,
+    login TEXT,
+    email TEXT
+);
+CREATE INDEX IF NOT EXISTS members_org_team ON members (org, team, side);
+CREATE INDEX IF NOT EXISTS members_team ON members (team);
+CREATE INDEX IF NOT EXISTS members_login ON members (login);
+CREATE INDEX IF NOT EXISTS members_email ON members (email);
+"""
+
+GITHUB = "github"
+DIRECTORY = "directory"
+
+
+class SnapshotStore:
+    """
+    SQLite store holding the last-known GitHub and directory membership of every team.
+
+    GitHub membership is only trusted while GitHub answers a conditional listing of
+    the team's members with the ETag it was stored with as unchanged, the member count
+    is unchanged and the snapshot is younger than ``max_age`` seconds; otherwise it is
+    read again.
+    """
+
+    def __init__(self, path, max_age=86400):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+            columns = [r["name"] for r in self.conn.execute("PRAGMA table_info(teams)")]
+            if "github_etag" not in columns:
+                # Snapshots taken before listings were conditional
+                self.conn.execute("ALTER TABLE teams ADD COLUMN github_etag TEXT")
+
+    def get_team(self, org, team):
+        """
+        Get the stored sync state of a team
+        :param org:
+        :param team:
+        :return: The team row, or None if the team was never synced
+        :rtype: dict
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM teams WHERE org = ? AND team = ?", (org, team)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def get_teams(self):
+        """
+        Get the stored sync state of every team
+        :return: Team rows by org and team
+        :rtype: dict
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM teams").fetchall()
+        return {(r["org"], r["team"]): dict(r) for r in rows}
+
+    def get_members(self, org, team, side):
+        """
+        Get the stored members of one side of a team
+        :param org:
+        :param team:
+        :param side: Either "github" or "directory"
+        :return: Members as dicts of username and email
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT login, email FROM members WHERE org = ? AND team = ? AND side = ?",
+                (org, team, side),
+            ).fetchall()
+        return [{"username": r["login"], "email": r["email"]} for r in rows]
+
+    def github_members(self, org, team, members_count, attribute):
+        """
+        Get the GitHub members of a team from the snapshot, to be used only if the
+        listing of the team's members is unchanged since its ETag
+        :param org:
+        :param team:
+        :param members_count: The member count GitHub currently reports for the team
+        :param attribute: The USER_SYNC_ATTRIBUTE the snapshot must have been taken with
+        :return: Members as dicts of username and email and the ETag of the listing they
+                 were read from, or None if a fresh read is needed
+        :rtype: tuple
+        """
+        state = self.get_team(org, team)
+        if (
+            not state
+            or state["attribute"] != attribute
+            or not state["github_etag"]
+            or state["github_count"] is None
+            or state["github_count"] != members_count
+            or time.time() - (state["synced_at"] or 0) > self.max_age
+        ):
+            return None
+        return self.get_members(org, team, GITHUB), state["github_etag"]
+
+    def save_team(
+        self,
+        org,
+        team,
+        team_id=None,
+        directory_group=None,
+        attribute=None,
+        github=None,
+        directory=None,
+        github_count=None,
+        github_etag=None,
+        changed=False,
+        status="synced",
+    ):
+        """
+        Replace the snapshot of a team
+        :param org:
+        :param team:
+        :param team_id:
+        :param directory_group:
+        :param attribute:
+        :param github: GitHub members as dicts of username and email
+        :param directory: Directory members as dicts of username and email
+        :param github_count: GitHub's member count matching ``github``, or None if it
+                             should not be trusted on the next run
+        :param github_etag: ETag of the member listing ``github`` was read from
+        :param changed: Whether this run changed the team
+        :param status:
+        :return:
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            previous = self.conn.execute(
+                "SELECT changed_at FROM teams WHERE org = ? AND team = ?", (org, team)
+            ).fetchone()
+            changed_at = now if changed or not previous else previous["changed_at"]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO teams VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, ?)",
+                (
+                    org,
+                    team,
+                    team_id,
+                    directory_group,
+                    attribute,
+                    github_count,
+                    now,
+                    changed_at,
+                    status,
+                    github_etag if github_count is not None else None,
+                ),
+            )
+            for side, members in ((GITHUB, github), (DIRECTORY, directory)):
+                if members is None:
+                    continue
+                self.conn.execute(
+                    "DELETE FROM members WHERE org = ? AND team = ? AND side = ?",
+                    (org, team, side),
+                )
+                self.conn.executemany(
+                    "INSERT INTO members VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (
+                            org,
+                            team,
+                            side,
+                            _fold(m.get("username")),
+                            _fold(m.get("email")),
+                        )
+                        for m in members
+                    ),
+                )
+
+    def record_failure(self, org, team, error):
+        """
+        Record a failed sync without touching the stored membership
+        :param org:
+        :param team:
+        :param error:
+        :return:
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO teams (org, team) VALUES (?, ?)", (org, team)
+            )
+            self.conn.execute(
+                "UPDATE teams SET status = 'failed', error = ? "
+                "WHERE org = ? AND team = ?",
+                (str(error), org, team),
+            )
+
+    def teams_for_user(self, user):
+        """
+        Find every team a user belongs to, on either side
+        :param user: Login or email address
+        :return: Tuples of org, team and side
+        :rtype: list
+        """
+        user = user.casefold()
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT org, team, side FROM members WHERE login = ? "
+                "UNION SELECT DISTINCT org, team, side FROM members WHERE email = ? "
+                "ORDER BY org, team, side",
+                (user, user),
+            ).fetchall()
+        return [tuple(r) for r in rows]
+
+
+def _fold(value):
+    return value.casefold() if value else value
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_snapshot_store():
+    """
+    Return the process-wide snapshot store, or None if SNAPSHOT_DB is not set
+    :return:
+    """
+    global _store
+    path = os.environ.get("SNAPSHOT_DB")
+    if not path:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = SnapshotStore(
+                path, max_age=int(os.environ.get("SNAPSHOT_MAX_AGE", 86400))
+            )
+        return _store
+
+
+if __name__ == "__main__":
+    usage = "usage: python -m githubapp.snapshot (who <user> | team <org> <team>)"
+    store = get_snapshot_store()
+    if store is None:
+        sys.exit("SNAPSHOT_DB is not set")
+    if len(sys.argv) == 3 and sys.argv[1] == "who":
+        for org, team, side in store.teams_for_user(sys.argv[2]):
+            print(f"{org}/{team} ({side})")
+    elif len(sys.argv) == 4 and sys.argv[1] == "team":
+        for side in (GITHUB, DIRECTORY):
+            print(f"{side}:")
+            for m in store.get_members(sys.argv[2], sys.argv[3], side):
+                print(f"  {m['username'] or ''} {m['email'] or ''}".rstrip())
+    else:
+        sys.exit(usage)
@@ -0,0 +1,66 @@
+"""
+Report where the time goes while the app starts
+
+    python -m githubapp.startup
+    python app.py --profile-startup
+"""
+
+import os
+import subprocess
+import sys
+
+# Imports the app in a fresh interpreter and reports how long that took overall
+_PROBE = (
+    "import time; start = time.perf_counter(); import {module}; "
+    "print('ready', time.perf_counter() - start)"
+)
+
+
+def profile_imports(module="app"):
+    """
+    Import ``module`` in a new interpreter with ``-X importtime``
+    :param module:
+    :return: Seconds until the import finished, and the cumulative import time in
+             seconds of each module imported, by name
+    :rtype: tuple
+    """
+    env = dict(os.environ)
+    # Only measure the import, not the initial sync
+    env.pop("FLASK_APP", None)
+    probe = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _PROBE.format(module=module)],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    ready = float(probe.stdout.strip().splitlines()[-1].split()[1])
+    modules = {}
+    for line in probe.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # import time: <self us> | <cumulative us> | <indented module name>
+        _, cumulative_us, name = line.split("|")
+        modules[name.strip()] = int(cumulative_us) / 1e6
+    return ready, modules
+
+
+def report(module="app", top=25, file=None):
+    """
+    Print the slowest imports of ``module``
+    :param module:
+    :param top: Number of modules shown
+    :param file:
+    :return:
+    """
+    file = file or sys.stdout
+    ready, modules = profile_imports(module)
+    print(f"Importing {module} took {ready * 1000:.0f}ms", file=file)
+    print(f"  {'module':<50}{'cumulative':>12}", file=file)
+    slowest = sorted(modules.items(), key=lambda m: m[1], reverse=True)[:top]
+    for name, seconds in slowest:
+        print(f"  {name:<50}{seconds * 1000:>10.1f}ms", file=file)
+
+
+if __name__ == "__main__":
+    report()
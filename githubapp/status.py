@@ -0,0 +1,198 @@
+"""
+Progress of the run in progress and outcome of the last one, served as JSON on
+/status so on-call can tell whether a slow run will finish before the next one
+is due
+"""
+
+import contextlib
+import datetime
+import threading
+import time
+import uuid
+
+from flask import jsonify
+
+from . import ratelimit
+
+_lock = threading.Lock()
+_current = None
+_last = None
+# (scheduler, job id) of the scheduled runs
+_schedule = None
+
+
+class RunProgress:
+    """
+    Teams listed and finished by a run, by installation
+    """
+
+    def __init__(self, mode):
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.phase = "starting"
+        self.started_at = time.time()
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.listed = {}
+        self.done = {}
+        self.failed = {}
+        # Installations whose teams are still being listed
+        self.listing = set()
+
+    def set_phase(self, phase):
+        self.phase = phase
+
+    def listing_started(self, org):
+        with self.lock:
+            self.listing.add(org)
+            self.listed.setdefault(org, set())
+
+    def listing_finished(self, org):
+        with self.lock:
+            self.listing.discard(org)
+
+    def add_team(self, org, slug):
+        with self.lock:
+            self.listed.setdefault(org, set()).add(slug)
+
+    def team_done(self, org, slug, failed=False):
+        """
+        Count a team as finished, whether it was synced, skipped or left for the
+        next run. A team finished twice counts once.
+        :param org:
+        :param slug:
+        :param failed:
+        :return:
+        """
+        with self.lock:
+            self.done.setdefault(org, set()).add(slug)
+            if failed:
+                self.failed.setdefault(org, set()).add(slug)
+
+    def snapshot(self):
+        """
+        :return: The run's progress, throughput and estimated time left
+        :rtype: dict
+        """
+        elapsed = time.monotonic() - self.start
+        with self.lock:
+            installations = {
+                org: {
+                    "done": len(self.done.get(org, ())),
+                    "total": len(slugs),
+                    "failed": len(self.failed.get(org, ())),
+                    "listing": org in self.listing,
+                }
+                for org, slugs in self.listed.items()
+            }
+            listing = bool(self.listing)
+        done = sum(i["done"] for i in installations.values())
+        total = sum(i["total"] for i in installations.values())
+        rate = done / elapsed if elapsed else 0
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "phase": self.phase,
+            "started_at": _isoformat(self.started_at),
+            "elapsed_seconds": round(elapsed, 1),
+            "teams_done": done,
+            "teams_total": total,
+            "teams_failed": sum(i["failed"] for i in installations.values()),
+            "teams_per_second": round(rate, 2),
+            # While teams are still being listed, the total and the ETA only grow
+            "eta_seconds": round((total - done) / rate, 1) if rate else None,
+            "listing": listing,
+            "installations": installations,
+        }
+
+
+@contextlib.contextmanager
+def track_run(mode):
+    """
+    Report the progress of a run on /status while it lasts, then its outcome as
+    the last run
+    :param mode: "sync", "plan" or "apply"
+    :return: The RunProgress to record the run's teams in
+    """
+    global _current, _last
+    progress = RunProgress(mode)
+    with _lock:
+        _current = progress
+    outcome = "failed"
+    try:
+        yield progress
+        outcome = "success"
+    finally:
+        summary = progress.snapshot()
+        with _lock:
+            _current = None
+            _last = {
+                "id": progress.id,
+                "mode": mode,
+                "outcome": outcome,
+                "started_at": summary["started_at"],
+                "finished_at": _isoformat(time.time()),
+                "duration_seconds": summary["elapsed_seconds"],
+                "teams_done": summary["teams_done"],
+                "teams_failed": summary["teams_failed"],
+            }
+
+
+def track_schedule(scheduler, job_id):
+    """
+    Report when the scheduled job ``job_id`` next runs on /status
+    :param scheduler: APScheduler scheduler
+    :param job_id:
+    :return:
+    """
+    global _schedule
+    _schedule = (scheduler, job_id)
+
+
+def next_run_time():
+    """
+    :return: When the scheduled run is next due, or None
+    :rtype: datetime.datetime
+    """
+    if _schedule is None:
+        return None
+    scheduler, job_id = _schedule
+    job = scheduler.get_job(job_id)
+    return job.next_run_time if job else None
+
+
+def status():
+    """
+    :return: The run in progress, the last run, requests in flight, rate-limit
+             budgets and the next scheduled run
+    :rtype: dict
+    """
+    # Imported here so requests isn't imported before the first request
+    from .transport import in_flight
+
+    with _lock:
+        current, last = _current, _last
+    run = current.snapshot() if current else None
+    next_run = next_run_time()
+    if run and next_run and run["eta_seconds"] is not None:
+        finish = time.time() + run["eta_seconds"]
+        run["finishes_before_next_run"] = finish < next_run.timestamp()
+    return {
+        "running": run is not None,
+        "run": run,
+        "last_run": last,
+        "next_run_at": next_run.isoformat() if next_run else None,
+        "in_flight_requests": in_flight(),
+        "rate_limits": ratelimit.budgets(),
+    }
+
+
+def status_view():
+    """
+    Flask view rendering the status as JSON
+    """
+    return jsonify(status())
+
+
+def _isoformat(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
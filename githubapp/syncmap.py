@@ -0,0 +1,201 @@
+"""
+Compiled team to directory group mapping loaded from syncmap.yml
+"""
+
+import os
+import re
+import threading
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+class PrefixTrie:
+    """
+    Character trie answering "does this string start with any of the prefixes"
+    in time proportional to the string, regardless of the number of prefixes.
+    """
+
+    _END = object()
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        self.prefixes = []
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for char in str(prefix):
+            node = node.setdefault(char, {})
+        if self._END not in node:
+            node[self._END] = True
+            self.prefixes.append(str(prefix))
+
+    def matches(self, value):
+        """
+        Check whether a string starts with one of the prefixes
+        :param value:
+        :type value: str
+        :rtype: bool
+        """
+        node = self.root
+        if self._END in node:
+            return True
+        for char in value:
+            node = node.get(char)
+            if node is None:
+                return False
+            if self._END in node:
+                return True
+        return False
+
+    def __iter__(self):
+        return iter(self.prefixes)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+
+def _glob_to_regex(pattern):
+    """
+    Translate a glob into a regex where every wildcard is a capture group, so the
+    matched parts can be used in the directory group name as {1}, {2}, ...
+    """
+    parts = []
+    for char in pattern:
+        if char == "*":
+            parts.append("(.*)")
+        elif char == "?":
+            parts.append("(.)")
+        else:
+            parts.append(re.escape(char))
+    return "".join(parts)
+
+
+class SyncMap:
+    """
+    Indexed form of the ``mapping`` section of syncmap.yml.
+
+    Exact entries are looked up in dictionaries keyed on ``(org, github)`` and
+    ``github``. Entries using ``github_pattern`` (a glob) or ``github_regex`` are
+    compiled into a single combined matcher tried after the exact keys, in file order.
+    Their ``directory`` may reference the team slug as ``{0}`` and captured parts as
+    ``{1}``, ``{2}``, ... or by group name.
+
+    An entry's ``backend`` names the USER_DIRECTORY backend holding its group, for
+    teams whose group isn't in their organization's directory.
+    """
+
+    def __init__(self, mapping=()):
+        self.by_org = {}
+        self.by_slug = {}
+        self.rules = []
+        # Backends named by entries
+        self.backends = set()
+        for entry in mapping:
+            backend = entry.get("backend")
+            if backend:
+                backend = backend.upper()
+                self.backends.add(backend)
+            target = (entry["directory"], backend)
+            if "github_pattern" in entry or "github_regex" in entry:
+                if "github_regex" in entry:
+                    pattern = entry["github_regex"]
+                else:
+                    pattern = _glob_to_regex(entry["github_pattern"])
+                org = re.escape(entry["org"]) if "org" in entry else "[^/]*"
+                regex = f"{org}/(?:{pattern})"
+                self.rules.append((re.compile(regex), target))
+            elif "org" in entry:
+                self.by_org[(entry["org"], entry["github"])] = target
+            else:
+                self.by_slug[entry["github"]] = target
+        self.matcher = None
+        if self.rules:
+            combined = "|".join(
+                f"(?P<_r{i}>{regex.pattern})" for i, (regex, _) in enumerate(self.rules)
+            )
+            try:
+                self.matcher = re.compile(combined)
+            except re.error:
+                # Rules reusing the same group name can't be combined; they are
+                # then tried one by one
+                self.matcher = None
+
+    def lookup(self, org, slug):
+        """
+        Find the directory group mapped to a team
+        :param org: Organization login
+        :param slug: Team slug
+        :return: The directory group, or None if the team is not in the map
+        :rtype: str
+        """
+        return self.resolve(org, slug)[0]
+
+    def resolve(self, org, slug):
+        """
+        Find the directory group mapped to a team, and the backend holding it
+        :param org: Organization login
+        :param slug: Team slug
+        :return: (directory group, backend), either None if the map doesn't say
+        :rtype: tuple
+        """
+        if (org, slug) in self.by_org:
+            return self.by_org[(org, slug)]
+        if slug in self.by_slug:
+            return self.by_slug[slug]
+        if not self.rules:
+            return None, None
+        key = f"{org}/{slug}"
+        first = 0
+        if self.matcher is not None:
+            match = self.matcher.fullmatch(key)
+            if match is None:
+                return None, None
+            # The outer group of the first matching alternative closes last
+            first = int(match.lastgroup[2:])
+        for regex, (directory, backend) in self.rules[first:]:
+            match = regex.fullmatch(key)
+            if match:
+                groups = match.groupdict()
+                return directory.format(slug, *match.groups(), **groups), backend
+        return None, None
+
+    def __len__(self):
+        return len(self.by_org) + len(self.by_slug) + len(self.rules)
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def load_syncmap(file="syncmap.yml"):
+    """
+    Load and compile syncmap.yml, re-using the compiled copy until the file changes
+    :param file:
+    :return: (syncmap, group_prefix, ignore_users)
+    :rtype: tuple
+    """
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return SyncMap(), PrefixTrie(), frozenset()
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        cached = _cache.get(file)
+        if cached and cached[0] == version:
+            return cached[1]
+        with open(file, "r") as f:
+            data = yaml.load(f, Loader=SafeLoader) or {}
+        compiled = (
+            SyncMap(data.get("mapping") or []),
+            PrefixTrie(data.get("group_prefix") or []),
+            frozenset(data.get("ignore_users") or []),
+        )
+        _cache[file] = (version, compiled)
+        return compiled
@@ -0,0 +1,271 @@
+"""
+Lightweight per-team tracing, with optional OpenTelemetry export
+"""
+
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+
+# Phases reported in the end-of-run summary, in pipeline order
+PHASES = ["directory", "github", "compare", "apply"]
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """
+    Return an OpenTelemetry tracer if TRACE_EXPORT is set to "otlp" or "file"
+    :return: The tracer, or None when export is disabled or unavailable
+    """
+    global _tracer
+    exporter_name = os.environ.get("TRACE_EXPORT", "").lower()
+    if not exporter_name:
+        return None
+    with _tracer_lock:
+        if _tracer is not None:
+            return _tracer or None
+        try:
+            from opentelemetry import trace
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import (
+                BatchSpanProcessor,
+                ConsoleSpanExporter,
+            )
+
+            if exporter_name == "otlp":
+                # Endpoint is read from OTEL_EXPORTER_OTLP_ENDPOINT (default localhost:4317)
+                from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+                    OTLPSpanExporter,
+                )
+
+                exporter = OTLPSpanExporter()
+            else:
+                exporter = ConsoleSpanExporter(
+                    out=open(os.environ.get("TRACE_FILE", "traces.jsonl"), "a")
+                )
+            provider = TracerProvider(
+                resource=Resource.create({"service.name": "github-team-sync"})
+            )
+            provider.add_span_processor(BatchSpanProcessor(exporter))
+            _tracer = provider.get_tracer(__name__)
+        except ImportError as e:
+            LOG.warning("TRACE_EXPORT is set but OpenTelemetry is not installed: %s", e)
+            _tracer = False
+        return _tracer or None
+
+
+class TeamTrace:
+    """
+    Timings, API calls and member counts collected while syncing one team
+    """
+
+    def __init__(self, org, team, run=None):
+        self.org = org
+        self.team = team
+        self.run = run
+        self.started = time.monotonic()
+        self.duration = None
+        # Phases of a team can run at the same time, e.g. in gather threads
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.api_calls = 0
+        self.directory_members = None
+        self.github_members = None
+        self.error = None
+        self.otel_span = None
+        tracer = get_tracer()
+        if tracer:
+            self.otel_span = tracer.start_span(
+                "sync_team", attributes={"org": org, "team": team}
+            )
+
+    def otel_child(self, name, nested=False):
+        """
+        Start an OpenTelemetry span under the team's span, or with ``nested`` under
+        the span current on this thread
+        """
+        if self.otel_span is None:
+            return contextlib.nullcontext()
+        from opentelemetry import trace
+
+        context = None if nested else trace.set_span_in_context(self.otel_span)
+        return get_tracer().start_as_current_span(name, context=context)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def finish(self, error=None):
+        if self.duration is not None:
+            return
+        self.duration = time.monotonic() - self.started
+        self.error = error
+        if self.otel_span is not None:
+            self.otel_span.set_attribute("api_calls", self.api_calls)
+            if error is not None:
+                self.otel_span.record_exception(error)
+            self.otel_span.end()
+        if self.run is not None:
+            self.run.add(self)
+
+    def discard(self):
+        """
+        End the trace of a team that was not synced after all, leaving it out of
+        the run's report
+        """
+        self.run = None
+        if self.otel_span is not None:
+            self.otel_span.set_attribute("carried_over", True)
+        self.finish()
+
+
+class TraceRun:
+    """
+    Collects the traces of every team synced during one full sync
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.traces = []
+
+    def start(self, org, team):
+        return TeamTrace(org, team, run=self)
+
+    def add(self, trace):
+        with self.lock:
+            self.traces.append(trace)
+
+    def report(self, top_n=None, file=None):
+        """
+        Log the slowest teams with their per-phase breakdown
+        :param top_n: Number of teams to show. Default: TRACE_TOP_N or 10
+        :param file: Print the table to this file instead
+        :return:
+        """
+        if top_n is None:
+            top_n = int(os.environ.get("TRACE_TOP_N", 10))
+        if not top_n or not self.traces:
+            return
+        slowest = sorted(self.traces, key=lambda t: t.duration, reverse=True)[:top_n]
+        header = ["team", "total"] + PHASES + ["api calls", "dir members", "gh members"]
+        rows = [
+            [
+                f"{t.org}/{t.team}" + (" (failed)" if t.error else ""),
+                f"{t.duration:.2f}s",
+            ]
+            + [f"{t.phases[p]:.2f}s" if p in t.phases else "-" for p in PHASES]
+            + [
+                str(t.api_calls),
+                "-" if t.directory_members is None else str(t.directory_members),
+                "-" if t.github_members is None else str(t.github_members),
+            ]
+            for t in slowest
+        ]
+        widths = [max(len(r[i]) for r in rows + [header]) for i in range(len(header))]
+        lines = [f"Slowest {len(slowest)} of {len(self.traces)} teams:"]
+        for row in [header] + rows:
+            lines.append(
+                "  ".join(
+                    c.ljust(w) if i == 0 else c.rjust(w)
+                    for i, (c, w) in enumerate(zip(row, widths))
+                )
+            )
+        if file is not None:
+            print("\n".join(lines), file=file)
+        else:
+            LOG.info("\n".join(lines))
+
+
+def current():
+    """
+    The trace of the team being processed on this thread, if any
+    """
+    return getattr(_local, "trace", None)
+
+
+def current_phase():
+    """
+    The sync phase running on this thread, if any
+    """
+    return getattr(_local, "phase", None)
+
+
+def phase(name):
+    """
+    Decorator for sync phases taking a job dict. Records the phase duration in the
+    job's trace and makes the trace current on this thread for the phase, so spans
+    and API calls are attributed to the team.
+    :param name: Name of the phase
+    :return:
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(job, *args, **kwargs):
+            trace = job.get("trace")
+            if trace is None:
+                trace = job["trace"] = TeamTrace(job["owner"], job["slug"])
+            previous = current(), current_phase()
+            _local.trace, _local.phase = trace, name
+            start = time.monotonic()
+            try:
+                with trace.otel_child(name):
+                    return f(job, *args, **kwargs)
+            finally:
+                trace.add_phase(name, time.monotonic() - start)
+                _local.trace, _local.phase = previous
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Export a block of work as an OpenTelemetry span within the current team's trace
+    :param name:
+    :return:
+    """
+    trace = current()
+    if trace is None:
+        yield
+        return
+    with trace.otel_child(name, nested=True):
+        yield
+
+
+def traced(name):
+    """
+    Decorator exporting a function as a span of the current team's trace
+    :param name:
+    :return:
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_api_call():
+    """
+    Attribute an API call to the team being processed on this thread
+    """
+    trace = current()
+    if trace is not None:
+        with trace.lock:
+            trace.api_calls += 1
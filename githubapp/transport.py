@@ -0,0 +1,183 @@
+"""
+Shared HTTP transport for the REST clients: one pool of keep-alive connections per
+host, sized for the sync workers, and default connect and read timeouts. Directory
+backends can get pools of their own, so one backend can't use up the connections
+of another. The bytes received from each host are counted.
+"""
+
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_lock = threading.Lock()
+# By name, None being the pools shared by GitHub and the directory backends
+_adapters = {}
+_sessions = {}
+# Response bytes received, as sent over the wire, by host
+_received = {}
+
+
+class CountingAdapter(HTTPAdapter):
+    """
+    HTTPAdapter keeping count of the requests waiting for their response
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self._count_lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        with self._count_lock:
+            self.in_flight += 1
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self._count_lock:
+                self.in_flight -= 1
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests.Session applying a default timeout to requests made without one
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def get_adapter(name=None):
+    """
+    Return the process-wide connection pools. Each host gets a pool keeping up to
+    HTTP_POOL_SIZE idle connections alive, by default three per sync worker since
+    three stages of a full sync make requests at the same time.
+    :param name: Name of a separate set of pools, such as a directory backend's
+    :return:
+    :rtype: HTTPAdapter
+    """
+    with _lock:
+        if name not in _adapters:
+            workers = int(os.environ.get("SYNC_WORKERS", 10))
+            _adapters[name] = CountingAdapter(
+                pool_connections=int(os.environ.get("HTTP_POOL_HOSTS", 20)),
+                pool_maxsize=int(os.environ.get("HTTP_POOL_SIZE", 3 * workers)),
+            )
+        return _adapters[name]
+
+
+def get_session(name=None):
+    """
+    Return the process-wide session of the REST directory backends. Requests made
+    without a timeout get (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT). Responses are
+    requested gzip-compressed and decompressed transparently.
+    :param name: Name of the session, which sends its requests through the pools
+                 of the same name
+    :return:
+    :rtype: requests.Session
+    """
+    adapter = get_adapter(name)
+    with _lock:
+        if name not in _sessions:
+            session = TimeoutSession(
+                (
+                    float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5)),
+                    float(os.environ.get("HTTP_READ_TIMEOUT", 60)),
+                )
+            )
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            mount(session, adapter)
+            _sessions[name] = session
+        return _sessions[name]
+
+
+def mount(session, adapter=None):
+    """
+    Make a session send its requests through the shared connection pools
+    :param session:
+    :param adapter: Default: get_adapter()
+    :return: session
+    """
+    adapter = adapter or get_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if count_received not in session.hooks["response"]:
+        session.hooks["response"].append(count_received)
+    return session
+
+
+def count_received(response, *args, **kwargs):
+    """
+    Response hook adding the size of the response body, compressed if it was sent
+    compressed, to the bytes received from its host
+    :param response:
+    :return:
+    """
+    if kwargs.get("stream") or not hasattr(response.raw, "tell"):
+        return
+    # Read the body now rather than right after the hooks, as requests would
+    response.content
+    url = urlsplit(response.url)
+    port = url.port or (443 if url.scheme == "https" else 80)
+    host = f"{url.hostname}:{port}"
+    with _lock:
+        _received[host] = _received.get(host, 0) + response.raw.tell()
+
+
+def received_bytes():
+    """
+    Total response bytes received through the shared transport
+    :return:
+    :rtype: int
+    """
+    with _lock:
+        return sum(_received.values())
+
+
+def in_flight():
+    """
+    Requests sent through the shared pools and still waiting for their response
+    :return: Counts by name of the pools, "shared" for the default ones
+    :rtype: dict
+    """
+    with _lock:
+        adapters = dict(_adapters)
+    return {name or "shared": adapter.in_flight for name, adapter in adapters.items()}
+
+
+def pool_stats():
+    """
+    Requests sent, connections opened and response bytes received through the
+    shared pools, by host. A host with far fewer connections than requests is
+    reusing its connections.
+    :return: Dicts of requests, connections and received_bytes, by host
+    :rtype: dict
+    """
+    with _lock:
+        adapters = list(_adapters.values())
+        received = dict(_received)
+    stats = {
+        host: {"requests": 0, "connections": 0, "received_bytes": size}
+        for host, size in received.items()
+    }
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            name = f"{pool.host}:{pool.port}" if pool.port else pool.host
+            host = stats.setdefault(
+                name, {"requests": 0, "connections": 0, "received_bytes": 0}
+            )
+            host["requests"] += pool.num_requests
+            host["connections"] += pool.num_connections
+    return stats
@@ -0,0 +1,168 @@
+import threading
+import time
+
+import pytest
+
+from githubapp.pipeline import (
+    CallTimeout,
+    Cancelled,
+    Pipeline,
+    Stage,
+    cancellable,
+    checkpoint,
+    gather,
+)
+
+
+def test_pipeline_runs_every_stage():
+    results = []
+    pipeline = Pipeline(
+        [
+            Stage("double", lambda n: n * 2, workers=3),
+            Stage("odd", lambda n: n if n % 4 else None),
+            Stage("collect", results.append),
+        ],
+        maxsize=2,
+    )
+    pipeline.run(range(10))
+    assert sorted(results) == [2, 6, 10, 14, 18]
+
+
+def test_pipeline_fanout():
+    results = []
+    pipeline = Pipeline(
+        [
+            Stage("split", lambda n: [n] * n, fanout=True),
+            Stage("collect", results.append),
+        ]
+    )
+    pipeline.run([1, 2, 3])
+    assert sorted(results) == [1, 2, 2, 3, 3, 3]
+
+
+def test_pipeline_reports_errors_and_goes_on():
+    errors = []
+    results = []
+
+    def check(n):
+        if n == 3:
+            raise ValueError("three")
+        return n
+
+    pipeline = Pipeline(
+        [Stage("check", check), Stage("collect", results.append)],
+        on_error=lambda stage, item, error: errors.append((stage, item, str(error))),
+    )
+    pipeline.run(range(5))
+    assert sorted(results) == [0, 1, 2, 4]
+    assert errors == [("check", 3, "three")]
+
+
+def test_pipeline_batches():
+    batches = []
+
+    def collect(items):
+        batches.append(items)
+        return items
+
+    results = []
+    pipeline = Pipeline(
+        [
+            Stage("batch", collect, batch=4, linger=0.5),
+            Stage("collect", results.append),
+        ]
+    )
+    pipeline.run(range(10))
+    assert sorted(results) == list(range(10))
+    assert all(len(b) <= 4 for b in batches)
+    assert len(batches) < 10
+
+
+def test_pipeline_partitions():
+    seen = {"even": set(), "odd": set()}
+
+    def record(n):
+        seen["odd" if n % 2 else "even"].add(threading.current_thread().name)
+
+    pipeline = Pipeline(
+        [
+            Stage(
+                "parity",
+                record,
+                partition=lambda n: "odd" if n % 2 else "even",
+                pools={"even": 1, "odd": 2},
+            )
+        ]
+    )
+    pipeline.run(range(20))
+    assert all(name.startswith("parity-even-") for name in seen["even"])
+    assert all(name.startswith("parity-odd-") for name in seen["odd"])
+
+
+def test_gather_returns_results_by_name():
+    assert gather({"a": lambda: 1, "b": lambda: 2}) == {"a": 1, "b": 2}
+
+
+def test_gather_cancels_the_other_calls_on_error():
+    stopped = threading.Event()
+
+    def slow():
+        try:
+            for _ in cancellable(range(1000)):
+                time.sleep(0.01)
+        except Cancelled:
+            stopped.set()
+            raise
+
+    def fail():
+        time.sleep(0.05)
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError, match="failed"):
+        gather({"slow": slow, "fail": fail})
+    assert stopped.wait(1)
+
+
+def test_gather_times_out_and_cancels():
+    stopped = threading.Event()
+
+    def slow():
+        try:
+            while True:
+                time.sleep(0.01)
+                checkpoint()
+        except Cancelled:
+            stopped.set()
+
+    start = time.monotonic()
+    with pytest.raises(CallTimeout, match="slow did not finish within 0.1s"):
+        gather({"slow": slow, "fast": lambda: 1}, timeouts={"slow": 0.1})
+    assert time.monotonic() - start < 1
+    assert stopped.wait(1)
+
+
+def test_checkpoint_outside_gather_does_nothing():
+    checkpoint()
+    assert list(cancellable([1, 2])) == [1, 2]
+
+
+def test_pipeline_partitions_are_bounded():
+    release = threading.Event()
+    pipeline = Pipeline(
+        [
+            Stage(
+                "slow",
+                lambda n: release.wait(1),
+                partition=lambda n: "a",
+                pools={"a": 1},
+            )
+        ],
+        maxsize=2,
+    )
+    thread = threading.Thread(target=pipeline.run, args=(range(20),))
+    thread.start()
+    time.sleep(0.2)
+    # One item in work, and at most maxsize waiting in each queue
+    assert pipeline.depths() == {"slow": 2, "slow[a]": 2}
+    release.set()
+    thread.join()
@@ -0,0 +1,66 @@
+import pytest
+
+from githubapp.plan import PlanWriter, check_plan, read_plan, sync_state
+
+
+def team(add, remove, **extra):
+    return {"owner": "acme", "slug": "web", "add": add, "remove": remove, **extra}
+
+
+def test_check_plan_counts_changes():
+    header = {"attribute": "username"}
+    teams = [team(["a", "b"], ["c"]), team([], ["d"]), {"slug": "x", "error": "boom"}]
+    assert check_plan(header, teams, "username") == 4
+    assert check_plan(header, teams, "username", max_changes=4) == 4
+
+
+def test_check_plan_refuses_too_many_changes():
+    with pytest.raises(ValueError, match="more than PLAN_MAX_CHANGES"):
+        check_plan({"attribute": "username"}, [team(["a", "b"], [])], "username", 1)
+
+
+def test_check_plan_refuses_another_attribute():
+    with pytest.raises(ValueError, match="compares email, not username"):
+        check_plan({"attribute": "email"}, [], "username")
+
+
+def test_plan_round_trip(tmp_path):
+    path = str(tmp_path / "plan.jsonl")
+    plan = PlanWriter(path, "username")
+    state = {
+        "directory_count": 2,
+        "github_count": 1,
+        "action": {"add": ["a"], "remove": []},
+    }
+    plan.add("acme", "web", 1, "web-team", state)
+    plan.add("acme", "ops", 2, "ops", {**state, "action": {"add": [], "remove": []}})
+    plan.add_failure("acme", "db", ValueError("boom"))
+    plan.close()
+    header, teams = read_plan(path)
+    assert header["attribute"] == "username"
+    assert [t["slug"] for t in teams] == ["web", "db"]
+    assert sync_state(teams[0]) == state
+    assert teams[1]["error"] == "boom"
+
+
+def test_read_plan_refuses_other_files(tmp_path):
+    path = tmp_path / "plan.jsonl"
+    path.write_text('{"version": 0}\n')
+    with pytest.raises(ValueError, match="is not a version 1 sync plan"):
+        read_plan(str(path))
+
+
+def test_plan_replaces_the_previous_one_only_when_complete(tmp_path):
+    path = tmp_path / "plan.jsonl"
+    path.write_text("previous\n")
+    plan = PlanWriter(str(path), "username")
+    plan.add_failure("acme", "db", ValueError("boom"))
+    assert path.read_text() == "previous\n"
+    plan.close(complete=False)
+    assert path.read_text() == "previous\n"
+    assert list(tmp_path.iterdir()) == [path]
+    plan = PlanWriter(str(path), "username")
+    plan.close()
+    header, teams = read_plan(str(path))
+    assert teams == []
+    assert list(tmp_path.iterdir()) == [path]
@@ -0,0 +1,61 @@
+import email.utils
+import time
+
+from githubapp.ratelimit import RateLimitBudget
+
+
+def test_unknown_endpoints_are_not_limited():
+    assert RateLimitBudget().reserve_request("/api/v1/groups") == 0
+
+
+def test_spent_budget_waits_for_the_reset():
+    budget = RateLimitBudget()
+    budget.update("groups", 2, time.time() + 30)
+    assert budget.reserve_request("groups") == 0
+    assert budget.reserve_request("groups") == 0
+    wait = budget.reserve_request("groups")
+    assert 29 < wait <= 30
+
+
+def test_reserve_is_left_to_other_clients():
+    budget = RateLimitBudget(reserve=5)
+    budget.update("groups", 6, time.time() + 30)
+    assert budget.reserve_request("groups") == 0
+    assert budget.reserve_request("groups") > 0
+
+
+def test_window_reset_lifts_the_limit():
+    budget = RateLimitBudget()
+    budget.update("groups", 0, time.time() - 1)
+    assert budget.reserve_request("groups") == 0
+    assert budget.snapshot() == {}
+
+
+def test_late_responses_only_lower_the_budget():
+    budget = RateLimitBudget()
+    reset = time.time() + 30
+    budget.update("groups", 10, reset)
+    budget.update("groups", 50, reset)
+    assert budget.snapshot()["groups"]["remaining"] == 10
+    budget.update("groups", 100, reset + 60)
+    assert budget.snapshot()["groups"]["remaining"] == 100
+
+
+def test_reset_is_corrected_for_clock_skew():
+    budget = RateLimitBudget()
+    now = time.time()
+    # The API's clock runs 100 seconds behind ours
+    date = email.utils.formatdate(now - 100, usegmt=True)
+    budget.update("groups", 1, now - 100 + 30, date)
+    assert 28 < budget.snapshot()["groups"]["reset_in"] <= 31
+
+
+def test_update_from_headers():
+    budget = RateLimitBudget()
+    budget.update_from_headers("groups", {})
+    assert budget.snapshot() == {}
+    budget.update_from_headers(
+        "groups",
+        {"X-Rate-Limit-Remaining": "7", "X-Rate-Limit-Reset": str(time.time() + 30)},
+    )
+    assert budget.snapshot()["groups"]["remaining"] == 7
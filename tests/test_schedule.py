@@ -0,0 +1,58 @@
+import threading
+
+from githubapp.schedule import priority, run_deadline, single_run
+
+
+def state(synced_at, changed_at=None, status="synced"):
+    return {"synced_at": synced_at, "changed_at": changed_at, "status": status}
+
+
+def test_priority_order():
+    teams = {
+        "stale": state(100),
+        "fresh": state(900),
+        "changed-long-ago": state(300, changed_at=300),
+        "changed-recently": state(800, changed_at=800),
+        "failed": state(950, status="failed"),
+        "failed-earlier": state(50, status="failed"),
+        "new": None,
+    }
+    order = sorted(teams, key=lambda name: priority(teams[name]))
+    assert order == [
+        "failed-earlier",
+        "failed",
+        "changed-recently",
+        "changed-long-ago",
+        "new",
+        "stale",
+        "fresh",
+    ]
+
+
+def test_priority_of_a_team_unchanged_since():
+    # Changed by an earlier run, and synced again since without changes
+    assert priority(state(500, changed_at=400)) == priority(state(500))
+
+
+def test_single_run_skips_overlapping_runs():
+    started, release = threading.Event(), threading.Event()
+    results = []
+
+    @single_run
+    def run():
+        started.set()
+        release.wait(1)
+        return "done"
+
+    thread = threading.Thread(target=lambda: results.append(run()))
+    thread.start()
+    started.wait(1)
+    assert run() is None
+    release.set()
+    thread.join()
+    assert results == ["done"]
+
+
+def test_run_deadline_without_budget():
+    assert run_deadline(None, "") is None
+    assert run_deadline(None, "0") is None
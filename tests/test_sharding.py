@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+from githubapp.sharding import ShardCoordinator
+
+KEYS = [f"org/team-{n}" for n in range(200)]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "shards.db")
+
+
+@pytest.fixture
+def workers(path):
+    a = ShardCoordinator(path, "worker-a")
+    b = ShardCoordinator(path, "worker-b")
+    for worker in (a, b, a):
+        worker.heartbeat()
+    yield a, b
+    for worker in (a, b):
+        worker.shutdown()
+
+
+def test_ring_splits_keys_between_workers(workers):
+    a, b = workers
+    owned = [a.owns(key) for key in KEYS]
+    assert owned == [not b.owns(key) for key in KEYS]
+    assert 0 < sum(owned) < len(KEYS)
+
+
+def test_claim_only_keys_this_worker_owns(workers):
+    a, b = workers
+    key = next(key for key in KEYS if a.owns(key))
+    assert not b.claim(key)
+    assert a.claim(key)
+    assert a.assigned == 1
+
+
+def test_claim_refuses_a_key_another_worker_is_syncing(workers):
+    a, b = workers
+    key = next(key for key in KEYS if a.owns(key))
+    assert a.claim(key)
+    # b now owns the key, e.g. after a rebalance
+    b.owns = lambda key: True
+    assert not b.claim(key)
+    a.complete(key, success=True)
+    assert b.claim(key)
+
+
+def test_claim_own_lease_again(workers):
+    a, _ = workers
+    key = next(key for key in KEYS if a.owns(key))
+    assert a.claim(key)
+    assert a.claim(key)
+
+
+def test_restarted_worker_claims_completed_keys(path):
+    before = ShardCoordinator(path, "worker-a")
+    before.start()
+    assert before.claim(KEYS[0])
+    before.complete(KEYS[0], success=True)
+    before.shutdown()
+    after = ShardCoordinator(path, "worker-a2")
+    after.start()
+    assert after.claim(KEYS[0])
+    after.shutdown()
+
+
+def test_failed_keys_are_released(workers):
+    a, b = workers
+    key = next(key for key in KEYS if a.owns(key))
+    assert a.claim(key)
+    a.complete(key, success=False)
+    b.owns = lambda key: True
+    assert b.claim(key)
+    assert a.failed == 1
+
+
+def test_shutdown_leaves_the_ring(workers):
+    a, b = workers
+    a.shutdown()
+    b.heartbeat()
+    assert b.live_workers == ["worker-b"]
+    assert all(b.owns(key) for key in KEYS)
+
+
+def test_leases_of_older_databases_are_migrated(path):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE leases (shard TEXT PRIMARY KEY, owner TEXT, expires REAL)"
+    )
+    conn.commit()
+    conn.close()
+    worker = ShardCoordinator(path, "worker-a")
+    worker.heartbeat()
+    assert worker.claim(KEYS[0])
+    worker.complete(KEYS[0], success=True)
+    worker.shutdown()
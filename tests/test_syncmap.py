@@ -0,0 +1,88 @@
+from githubapp.syncmap import PrefixTrie, SyncMap, load_syncmap
+
+
+def test_lookup_exact_entries():
+    syncmap = SyncMap(
+        [
+            {"org": "acme", "github": "web", "directory": "acme-web"},
+            {"github": "web", "directory": "web-team"},
+        ]
+    )
+    assert syncmap.lookup("acme", "web") == "acme-web"
+    assert syncmap.lookup("other", "web") == "web-team"
+    assert syncmap.lookup("acme", "db") is None
+
+
+def test_lookup_patterns_in_file_order():
+    syncmap = SyncMap(
+        [
+            {"github": "web", "directory": "exact"},
+            {"github_pattern": "eng-*-*", "directory": "{1}_{2}"},
+            {"org": "acme", "github_pattern": "eng-*", "directory": "acme-{0}"},
+            {"github_regex": r"team-(?P<n>\d+)", "directory": "group-{n}"},
+        ]
+    )
+    assert syncmap.lookup("any", "web") == "exact"
+    assert syncmap.lookup("any", "eng-web-prod") == "web_prod"
+    assert syncmap.lookup("acme", "eng-web") == "acme-eng-web"
+    assert syncmap.lookup("other", "eng-web") is None
+    assert syncmap.lookup("any", "team-42") == "group-42"
+    assert syncmap.lookup("any", "team-x") is None
+
+
+def test_lookup_rules_that_cannot_be_combined():
+    syncmap = SyncMap(
+        [
+            {"github_regex": r"a-(?P<n>\d+)", "directory": "a{n}"},
+            {"github_regex": r"b-(?P<n>\d+)", "directory": "b{n}"},
+        ]
+    )
+    assert syncmap.matcher is None
+    assert syncmap.lookup("org", "b-2") == "b2"
+
+
+def test_prefix_trie():
+    trie = PrefixTrie(["gh-", "github_", "gh-"])
+    assert trie.matches("gh-web")
+    assert trie.matches("github_ops")
+    assert not trie.matches("git")
+    assert len(trie) == 2
+    assert PrefixTrie([""]).matches("anything")
+
+
+def test_load_syncmap(tmp_path):
+    path = tmp_path / "syncmap.yml"
+    path.write_text(
+        "mapping:\n"
+        "  - github: web\n"
+        "    directory: web-team\n"
+        "group_prefix:\n"
+        "  - gh-\n"
+        "ignore_users:\n"
+        "  - bot\n"
+    )
+    syncmap, prefixes, ignore_users = load_syncmap(str(path))
+    assert syncmap.lookup("org", "web") == "web-team"
+    assert prefixes.matches("gh-web")
+    assert ignore_users == {"bot"}
+    assert load_syncmap(str(path))[0] is syncmap
+    assert len(load_syncmap(str(tmp_path / "missing.yml"))[0]) == 0
+
+
+def test_resolve_returns_the_backend():
+    syncmap = SyncMap(
+        [
+            {"github": "web", "directory": "web-team"},
+            {"github": "ops", "directory": "ops", "backend": "okta"},
+            {"github_pattern": "aad-*", "directory": "{1}", "backend": "aad"},
+        ]
+    )
+    assert syncmap.resolve("acme", "web") == ("web-team", None)
+    assert syncmap.resolve("acme", "ops") == ("ops", "OKTA")
+    assert syncmap.resolve("acme", "aad-web") == ("web", "AAD")
+    assert syncmap.resolve("acme", "db") == (None, None)
+    assert syncmap.backends == {"OKTA", "AAD"}
+
+
+def test_prefix_trie_lists_its_prefixes():
+    assert list(PrefixTrie(["gh-", "github_", "gh-"])) == ["gh-", "github_"]
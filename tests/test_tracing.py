@@ -0,0 +1,24 @@
+import threading
+
+from githubapp import tracing
+
+
+def test_api_calls_of_concurrent_threads_are_all_counted():
+    trace = tracing.TeamTrace("acme", "web")
+
+    @tracing.phase("fetch")
+    def fetch(job):
+        for _ in range(1000):
+            tracing.count_api_call()
+
+    threads = [
+        threading.Thread(target=fetch, args=({"trace": trace},)) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert trace.api_calls == 8000
+    assert "fetch" in trace.phases
+    tracing.count_api_call()
+    assert trace.api_calls == 8000